@@ -0,0 +1,182 @@
+import argparse
+import configparser
+import json
+import random
+import sys
+import time
+import tracemalloc
+from tempfile import TemporaryDirectory
+
+from contacts import Contacts
+from lib import get_replacement_and_update_tokens, get_update_tokens, get_update_token_ints, get_update_token, \
+    get_replacement_token, new_seed
+
+# Microbenchmarks of the data structures in contacts.py, run in process without a server.
+# For each dataset size a data directory is filled through Contacts.send_or_sync, then each operation is timed
+# (best of --repeat runs) and its peak memory measured with tracemalloc, as is the memory held after loading.
+#
+# python benchmark_contacts.py --sizes 1000,10000,100000 --save_baseline    # on the reference build
+# python benchmark_contacts.py --sizes 1000,10000,100000                    # exits 1 if slower than the baseline
+#
+# Timings are only comparable on the same machine, so keep a baseline per machine.
+
+parser = argparse.ArgumentParser(description='Microbenchmark the contacts.py data structures.')
+parser.add_argument('--sizes', default='1000,10000', help='comma separated numbers of contacts (and as many locations) to load')
+parser.add_argument('--repeat', type=int, default=5, help='times to run each operation, the best time is kept')
+parser.add_argument('--baseline', default='benchmark_contacts_baseline.json', help='file of results to compare against')
+parser.add_argument('--save_baseline', action='store_true', help='write the results to the baseline file instead of comparing')
+parser.add_argument('--tolerance', type=float, default=0.25, help='fractional slowdown, or memory growth, allowed over the baseline')
+parser.add_argument('--output', help='file to also write the results to')
+parser.add_argument('--seed', type=int, default=1, help='random seed for the datasets')
+
+# Where the synthetic locations are, and the size of the bounding boxes scanned
+centre_lat, centre_long, spread = 37.7, -122.4, 0.5
+bbox_size = 0.1
+start_time = 1600000000.0
+
+
+def make_contacts(directory, retain_in_cache=120):
+    config_top = configparser.ConfigParser()
+    # Never expire the synthetic dates
+    config_top['DEFAULT'] = {'directory': directory, 'expire_data': 100000, 'retain_in_cache': retain_in_cache}
+    return Contacts(config_top)
+
+
+def fill(contacts, size, batch_size=100):
+    """
+    Insert size contacts and size locations, batch_size at a time each with its own time
+    """
+    for batch_start in range(0, size, batch_size):
+        batch = range(batch_start, min(size, batch_start + batch_size))
+        seed = new_seed()
+        tokens = [get_update_token(get_replacement_token(seed, i)) for i in range(2 * len(batch))]
+        contacts.send_or_sync({
+            'contact_ids': [{'id': '%032X' % random.randrange(0, 2 ** 128), 'update_token': tokens[2 * i], 'status': 1}
+                            for i in range(len(batch))],
+            'locations': [{'lat': round(centre_lat + random.uniform(-spread, spread), 4),
+                           'long': round(centre_long + random.uniform(-spread, spread), 4),
+                           'update_token': tokens[2 * i + 1], 'status': 1} for i in range(len(batch))]
+        }, {}, start_time + batch_start)
+    return
+
+
+def random_bounding_boxes(count):
+    boxes = []
+    for i in range(count):
+        min_lat = round(centre_lat + random.uniform(-spread, spread - bbox_size), 2)
+        min_long = round(centre_long + random.uniform(-spread, spread - bbox_size), 2)
+        boxes.append((min_lat, min_long, round(min_lat + bbox_size, 2), round(min_long + bbox_size, 2)))
+    return boxes
+
+
+def best_time(function, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def peak_memory(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_size(size, repeat):
+    """
+    returns { operation: { seconds, peak_bytes } } for a dataset of size contacts and locations
+    """
+    results = {}
+    with TemporaryDirectory() as directory:
+        contacts = make_contacts(directory)
+        start = time.perf_counter()
+        fill(contacts, size)
+        results['insert'] = {'seconds': time.perf_counter() - start}
+        # Memory held by the in memory indexes of a dataset of this size
+        tracemalloc.start()
+        loaded = make_contacts(directory)
+        current_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        results['indexes'] = {'bytes': current_bytes}
+        del loaded
+
+        # _load is run by each dict's constructor, so this times loading all three from disk
+        operations = {'load': lambda: make_contacts(directory)}
+        now = start_time + size + 1
+        prefixes = ['%03X' % random.randrange(0, 16 ** 3) for i in range(100)]
+        operations['map_over_prefixes'] = lambda: list(contacts.contact_dict.map_over_prefixes(prefixes, 0, now))
+        boxes = random_bounding_boxes(10)
+        bboxs = contacts._split_bounding_boxes(boxes)
+        operations['split_bounding_boxes'] = lambda: contacts._split_bounding_boxes(boxes)
+        operations['list_over_bounding_boxes'] = lambda: contacts.spatial_dict.list_over_bounding_boxes(bboxs, 0, now)
+        all_contacts = list(contacts.contact_dict.sorted_list_by_time_and_serial_number)
+        all_locations = list(contacts.spatial_dict.sorted_list_by_time_and_serial_number)
+        operations['sort_and_truncate'] = lambda: contacts._sort_and_truncate(1000, iter(all_contacts), iter(all_locations))
+        sinces = [start_time + random.uniform(0, size) for i in range(1000)]
+        # Nothing is cached with retain_in_cache 0, so every blob is read from disk
+        uncached = make_contacts(directory, retain_in_cache=0)
+        file_paths = [uncached.contact_dict.time_and_serial_number_to_file_path_map[floating_seconds_and_serial]
+                      for floating_seconds_and_serial in all_contacts[-1000:]]
+        operations['get_blob_from_file_paths_uncached'] = lambda: uncached.contact_dict.get_blob_from_file_paths(file_paths)
+        operations['max_until'] = lambda: [contacts.contact_dict.max_until(since, now, 1000) for since in sinces]
+        seed = new_seed()
+        operations['get_replacement_and_update_tokens'] = lambda: get_replacement_and_update_tokens(seed, 1000)
+        operations['get_update_tokens'] = lambda: get_update_tokens(seed, 1000)
+        operations['get_update_token_ints'] = lambda: get_update_token_ints(seed, 1000)
+        # Half stored tokens, half misses, as a data_points chain looks them up
+        contacts.update_token_index.merge()
+        lows, highs = contacts.update_token_index.arrays[0:2]
+        token_ints = [lows[i] | (highs[i] << 64) for i in random.sample(range(len(lows)), min(500, len(lows)))] + get_update_token_ints(seed, 500)
+        tokens = ['%X' % token_int for token_int in token_ints]
+        operations['get_file_paths_from_update_tokens'] = lambda: contacts.contact_dict.get_file_paths_from_update_tokens(tokens)
+        operations['get_file_paths_from_update_token_ints'] = lambda: contacts.contact_dict.get_file_paths_from_update_tokens(token_ints)
+        operations['get_file_path_from_update_token_each'] = lambda: list(map(contacts.contact_dict.get_file_path_from_update_token, tokens))
+        for name, function in operations.items():
+            results[name] = {'seconds': best_time(function, repeat), 'peak_bytes': peak_memory(function)}
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    returns [description] of each result worse than its baseline by more than tolerance
+    """
+    regressions = []
+    for size, operations in results.items():
+        for name, result in operations.items():
+            for measure, value in result.items():
+                base = baseline.get(size, {}).get(name, {}).get(measure)
+                if base and (value > base * (1 + tolerance)):
+                    regressions.append('%s at size %s: %s %.6g is %.0f%% over baseline %.6g' % (
+                        name, size, measure, value, 100 * (value / base - 1), base))
+    return regressions
+
+
+if __name__ == '__main__':
+    parsed_args = parser.parse_args()
+    random.seed(parsed_args.seed)
+    results = {}
+    for size in [int(s) for s in parsed_args.sizes.split(',')]:
+        results[str(size)] = benchmark_size(size, parsed_args.repeat)
+        for name, result in results[str(size)].items():
+            print('%8d %-36s %s' % (size, name, ' '.join('%s=%.6g' % item for item in result.items())))
+    if parsed_args.output:
+        json.dump(results, open(parsed_args.output, 'w'), indent=2)
+    if parsed_args.save_baseline:
+        json.dump(results, open(parsed_args.baseline, 'w'), indent=2)
+        print('saved baseline to %s' % parsed_args.baseline)
+    else:
+        try:
+            baseline = json.load(open(parsed_args.baseline))
+        except FileNotFoundError:
+            print('no baseline at %s, run with --save_baseline to create one' % parsed_args.baseline)
+            sys.exit(0)
+        regressions = compare(results, baseline, parsed_args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: %s' % regression)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,246 @@
+import argparse
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from lib import inc_current_time_for_testing
+from tests import Server, run_server_in_context
+from tests.conftest import Data
+from tests.test_pseudoclient import Client, ProviderOfTests, Tracer, STATUS_PUI, STATUS_HEALTHY, STATUS_INFECTED
+
+# Load generator, drives many of the simulated clients from tests/test_pseudoclient.py against a server concurrently,
+# with a chosen mix of operations, and writes throughput, latency percentiles and server memory over time to a JSON file
+# so that releases can be compared.
+#
+# python benchmark_load.py --clients 2000 --threads 50 --duration 60 --mix send=20,scan=60,update=10,result=5,data_points=5
+#
+# Each client is only used by one thread at a time, latencies are of the whole operation as the client does it,
+# which is one request except for an occasional extra /status/send or /status/update a scan's results trigger.
+
+parser = argparse.ArgumentParser(description='Benchmark a bct server with simulated clients.')
+parser.add_argument('--server', help='url of a running server, by default one is started in a temporary directory')
+parser.add_argument('--server_pid', type=int, help='process id of the server given by --server, to record its memory')
+parser.add_argument('--workers', type=int, default=0, help='read workers for the server that is started')
+parser.add_argument('--clients', type=int, default=1000, help='number of simulated clients')
+parser.add_argument('--threads', type=int, default=20, help='number of clients making requests at once')
+parser.add_argument('--duration', type=float, default=30, help='seconds to run for, after the clients are created')
+parser.add_argument('--mix', default='send=20,scan=60,update=10,result=5,data_points=5',
+                    help='relative weights of the operations: send, scan, update, result, data_points')
+parser.add_argument('--sample_seconds', type=float, default=1.0, help='how often to record throughput and memory')
+parser.add_argument('--output', default='benchmark_load.json', help='file to write the results to')
+parser.add_argument('--seed', type=int, help='random seed, to repeat a run')
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+
+def rss_kb(pid):
+    """
+    returns resident memory of process pid in kB, or None if it can't be read (e.g. not on Linux)
+    """
+    try:
+        with open('/proc/%d/status' % pid) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except (OSError, TypeError):
+        pass
+    return None
+
+
+class LoadGenerator:
+
+    def __init__(self, server, data, mix):
+        self.server = server
+        self.data = data
+        self.operations = list(mix)
+        self.weights = [mix[operation] for operation in self.operations]
+        self.tester = ProviderOfTests(server, "Benchmark")
+        self.tracer = Tracer(server)
+        self.clients = []
+        self.idle_clients = queue.Queue()
+        self.tested = []  # test_ids with a result, for data_points
+        self.lock = threading.Lock()
+        self.latencies = {operation: [] for operation in self.operations}
+        self.errors = {operation: 0 for operation in self.operations}
+        self.completed = 0
+        return
+
+    def add_client(self, i):
+        client = Client(server=self.server, data=self.data, name="Client-%d" % i)
+        # Spread clients out, so only some are in bluetooth range of each other
+        client.simulate_random_walk(int(10 * len(self.clients) ** 0.5) + 10)
+        with self.lock:
+            self.clients.append(client)
+        self.idle_clients.put(client)
+        return
+
+    def add_clients(self, numbers):
+        for i in numbers:
+            self.add_client(i)
+        return
+
+    def _ensure_seed(self, client):
+        if not client.seed:
+            self.send(client)
+        return
+
+    def send(self, client):
+        client.cron15()  # Rotate id
+        client.listen(random.choice(self.clients).current_id)
+        with self.lock:  # The testing clock is shared by every thread, += on it is not atomic
+            inc_current_time_for_testing()
+        client.simulate_random_walk(10)
+        client._send_to(STATUS_PUI)
+        return
+
+    def scan(self, client):
+        client.poll()
+        return
+
+    def update(self, client):
+        self._ensure_seed(client)
+        client._update_to(random.choice([STATUS_PUI, STATUS_HEALTHY]))
+        return
+
+    def result(self, client):
+        self._ensure_seed(client)
+        provider_id, test_id, pin = self.tester.new_test()
+        client.got_tested(provider_id=provider_id, test_id=test_id, pin=pin)
+        self.tester.result(test_id, STATUS_INFECTED)
+        with self.lock:
+            self.tested.append(test_id)
+        return
+
+    def data_points(self, client):
+        with self.lock:
+            test_id = random.choice(self.tested) if self.tested else None
+        if test_id is None:
+            return self.result(client)
+        self.tracer.receive_test(self.tester.send_test(test_id))
+        return
+
+    def run_thread(self, end_time):
+        while time.time() < end_time:
+            client = self.idle_clients.get()
+            operation = random.choices(self.operations, self.weights)[0]
+            start_time = time.time()
+            try:
+                getattr(self, operation)(client)
+                failed = False
+            except Exception as e:
+                logger.warning('%s failed: %r' % (operation, e))
+                failed = True
+            latency = time.time() - start_time
+            self.idle_clients.put(client)
+            with self.lock:
+                self.completed += 1
+                if failed:
+                    self.errors[operation] += 1
+                else:
+                    self.latencies[operation].append(latency)
+        return
+
+
+def sample(generator, pid, start_time, sample_seconds, stop, timeline):
+    last_completed = 0
+    while not stop.wait(sample_seconds):
+        with generator.lock:
+            completed = generator.completed
+        timeline.append({
+            'seconds': round(time.time() - start_time, 3),
+            'operations_per_second': (completed - last_completed) / sample_seconds,
+            'server_rss_kb': rss_kb(pid)
+        })
+        last_completed = completed
+    return
+
+
+@contextmanager
+def target_server(parsed_args):
+    if parsed_args.server:
+        yield Server(parsed_args.server, None, None), parsed_args.server_pid
+    else:
+        with run_server_in_context(workers=parsed_args.workers) as server:
+            yield server, server.proc.pid
+    return
+
+
+def run(parsed_args):
+    mix = {k.strip(): float(v) for k, v in (item.split('=') for item in parsed_args.mix.split(','))}
+    if parsed_args.seed is not None:
+        random.seed(parsed_args.seed)
+    with target_server(parsed_args) as (server, pid):
+        generator = LoadGenerator(server, Data(), mix)
+        logger.warning('creating %d clients' % parsed_args.clients)
+        creators = [threading.Thread(target=generator.add_clients, args=(range(n, parsed_args.clients, parsed_args.threads),))
+                    for n in range(parsed_args.threads)]
+        for creator in creators:
+            creator.start()
+        for creator in creators:
+            creator.join()
+        initial_rss_kb = rss_kb(pid)
+        logger.warning('running for %s seconds' % parsed_args.duration)
+        timeline = []
+        stop = threading.Event()
+        start_time = time.time()
+        sampler = threading.Thread(target=sample, args=(generator, pid, start_time, parsed_args.sample_seconds, stop, timeline))
+        sampler.start()
+        threads = [threading.Thread(target=generator.run_thread, args=(start_time + parsed_args.duration,))
+                   for i in range(parsed_args.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start_time
+        stop.set()
+        sampler.join()
+        final_rss_kb = rss_kb(pid)
+    operations = {}
+    for operation, latencies in generator.latencies.items():
+        latencies.sort()
+        operations[operation] = {
+            'count': len(latencies),
+            'errors': generator.errors[operation],
+            'per_second': len(latencies) / elapsed,
+            'mean_ms': 1000 * sum(latencies) / len(latencies) if latencies else None,
+            'p50_ms': 1000 * percentile(latencies, 0.50) if latencies else None,
+            'p95_ms': 1000 * percentile(latencies, 0.95) if latencies else None,
+            'p99_ms': 1000 * percentile(latencies, 0.99) if latencies else None
+        }
+    all_latencies = sorted(latency for latencies in generator.latencies.values() for latency in latencies)
+    return {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(start_time)),
+        'arguments': vars(parsed_args),
+        'elapsed_seconds': elapsed,
+        'operations_per_second': len(all_latencies) / elapsed,
+        'errors': sum(generator.errors.values()),
+        'p50_ms': 1000 * percentile(all_latencies, 0.50) if all_latencies else None,
+        'p95_ms': 1000 * percentile(all_latencies, 0.95) if all_latencies else None,
+        'p99_ms': 1000 * percentile(all_latencies, 0.99) if all_latencies else None,
+        'operations': operations,
+        'server_rss_kb': {'initial': initial_rss_kb, 'final': final_rss_kb},
+        'timeline': timeline
+    }
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))  # run_server_in_context starts server.py from here
+    parsed_args = parser.parse_args()
+    results = run(parsed_args)
+    json.dump(results, open(parsed_args.output, 'w'), indent=2)
+    print('%.1f operations/second, p50 %s ms, p95 %s ms, p99 %s ms, %d errors' % (
+        results['operations_per_second'], results['p50_ms'], results['p95_ms'], results['p99_ms'], results['errors']))
+    for name, operation in results['operations'].items():
+        print('  %-12s %s' % (name, json.dumps(operation)))
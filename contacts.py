@@ -1,20 +1,29 @@
 # the module contains the client and server process to manage ids
 
-from twisted.logger import Logger
+from logs import LevelLogger
 import os
 import json
 import copy
 import math
-import random
+import heapq
+from itertools import islice, zip_longest
+from bisect import bisect_left, bisect_right, insort
 import time
-from collections import defaultdict
-from lib import get_update_token, get_replacement_token, current_time, unix_time_from_iso, \
-    iso_time_from_seconds_since_epoch
+import threading
+import queue
+import zlib
+import lzma
+from array import array
+from collections import defaultdict, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from lib import get_update_token_ints, get_replacement_and_update_tokens, current_time, unix_time_from_iso, \
+    iso_time_from_seconds_since_epoch, EncodedJSON, write_json_atomically
 from blist import sortedlist
+from metrics import metrics, RequestTimer
 
 os.umask(0o007)
 
-logger = Logger()
+logger = LevelLogger()
 
 
 # Return a matching date - see issue#57 for discussion of a valid date
@@ -28,6 +37,20 @@ def _good_date(floating_seconds_and_serial_number, since=None, now=None):
     return ((not since) or (since <= date)) and ((not now) or (date < now))
 
 
+# Same test as _good_date, but for a list of floating_seconds_and_serial_number kept in time order
+# returns (left, right) the range of indexes of the list that are good dates
+def _good_dates_range(floating_seconds_and_serial_number_list, since=None, now=None):
+    left = bisect_left(floating_seconds_and_serial_number_list, (since,)) if since else 0
+    right = bisect_left(floating_seconds_and_serial_number_list, (now,)) if now else len(floating_seconds_and_serial_number_list)
+    return left, right
+
+
+# returns iter of the good dates in the list, without copying them, so merging many lists holds none of them
+def _good_dates(floating_seconds_and_serial_number_list, since=None, now=None):
+    return map(floating_seconds_and_serial_number_list.__getitem__,
+               range(*_good_dates_range(floating_seconds_and_serial_number_list, since, now)))
+
+
 # For now, all we do is capture these as statistics, later we could capture in a table and analyse
 init_statistics_fields = ['application_name', 'application_version', 'phone_type', 'region', 'health_provider',
                           'language', 'status']
@@ -55,6 +78,7 @@ init_statistics_fields = ['application_name', 'application_version', 'phone_type
 # FSBackedThreeLevelDict._get_parts_from_file_path(file_path) -> key, floating_seconds_and_serial_number
 # FSBackedThreeLevelDict._get_key_from_file_name(file_name) -> directory_name
 # DICT._get_blob_from_update_token(update_token) -> blob
+# DICT.get_file_path_from_update_token(update_token) -> file_path
 # DICT.get_bottom_level_from_key(key) -> { key: [floating_seconds_and_serial]}
 # DICT.get_floating_seconds_and_serial_number_list_from_key(key) -> [floating_seconds_and_serial] or []
 # DICT.get_blob_from_file_path(file_path) -> blob
@@ -70,26 +94,481 @@ init_statistics_fields = ['application_name', 'application_version', 'phone_type
 # UpdatesDict[key] -> [blob]
 
 
+class UpdateTokenIndex:
+    """
+    Index of update_token -> (floating_seconds, serial_number) shared by the FSBackedThreeLevelDicts, each dict registers
+    as an owner and the (floating_seconds, serial_number) is looked up in its time_and_serial_number_to_file_path_map.
+
+    Tokens in the form made by get_update_token (upper case hex, no leading zeros, up to 80 bits) are held as integers in
+    parallel arrays sorted by the low 64 bits, about 23 bytes a token instead of a str key and file_path str in a dict.
+    New tokens go into a small dict (recent) that is merged into the arrays as it grows,
+    tokens in any other form (they come from clients) stay in a dict keyed by the string.
+    An item deleted while its update token is known is removed, from recent or other, or marked deleted in the arrays.
+    Other deleted items are kept in a set by remove_item, and expire_before marks everything of an owner up to a time as
+    expired, so get leaves them out, without a search for their tokens. The arrays are merged again, dropping all of
+    these, once they add up to a quarter of them.
+    """
+    DELETED = 255  # owner of a removed entry in the arrays, dropped at the next merge
+    MASK64 = 0xFFFFFFFFFFFFFFFF
+
+    def __init__(self, merge_size=65536):
+        self.owners = {}  # { name: owner }
+        self.merge_size = merge_size
+        # (low 64 bits, high 16 bits, owner, floating_seconds, serial_number) replaced as a whole on merge
+        self.arrays = (array('Q'), array('H'), array('B'), array('d'), array('I'))
+        self.deleted_count = 0
+        self.recent = {}  # { (token_int, owner): (floating_seconds, serial_number) }
+        self.other = {}  # { (update_token, owner): (floating_seconds, serial_number) }
+        self.horizons = {}  # { owner: floating_seconds } everything of owner from before it has expired
+        self.removed = set()  # { (owner, floating_seconds, serial_number) } deleted by remove_item
+        self.expired_count = 0  # Items expired by expire_before since the last merge
+        self.lock = threading.Lock()  # Deletion runs in a thread, so changes and merges are done under the lock
+        return
+
+    def __len__(self):
+        """
+        Includes entries of expired items, and of those given to remove_item, not yet dropped by a merge
+        """
+        return len(self.arrays[0]) - self.deleted_count + len(self.recent) + len(self.other)
+
+    @staticmethod
+    def _token_int(update_token):
+        """
+        returns update_token as an int if it is in the form made by get_update_token (or already an int, as from
+        get_update_token_ints), otherwise None
+        """
+        if isinstance(update_token, int):
+            return update_token
+        if (not isinstance(update_token, str)) or (len(update_token) > 20):
+            return None
+        try:
+            token_int = int(update_token, 16)
+        except ValueError:
+            return None
+        return token_int if ('%X' % token_int) == update_token else None
+
+    @staticmethod
+    def _find(arrays, token_int, owner):
+        lows, highs, owners = arrays[0:3]
+        low = token_int & UpdateTokenIndex.MASK64
+        high = token_int >> 64
+        i = bisect_left(lows, low)
+        while i < len(lows) and lows[i] == low:
+            if highs[i] == high and owners[i] == owner:
+                return i
+            i += 1
+        return None
+
+    def register(self, name):
+        """
+        returns the owner number for name, anything it owned before (e.g. a dict being reloaded on reset) is dropped
+        """
+        with self.lock:
+            owner = self.owners.setdefault(name, len(self.owners))
+            self.horizons.pop(owner, None)
+            self.recent = {k: v for k, v in self.recent.items() if k[1] != owner}
+            self.other = {k: v for k, v in self.other.items() if k[1] != owner}
+            self.removed = set(k for k in self.removed if k[0] != owner)
+            owners = self.arrays[2]
+            for i in range(len(owners)):
+                if owners[i] == owner:
+                    owners[i] = UpdateTokenIndex.DELETED
+                    self.deleted_count += 1
+        return owner
+
+    def get(self, owner, update_token):
+        """
+        returns (floating_seconds, serial_number) of update_token in owner, or None
+        """
+        if not update_token:
+            return None
+        token_int = UpdateTokenIndex._token_int(update_token)
+        if token_int is None:
+            return self._live(owner, self.other.get((update_token, owner)))
+        floating_seconds_and_serial_number = self.recent.get((token_int, owner))
+        if floating_seconds_and_serial_number is None:
+            arrays = self.arrays
+            i = UpdateTokenIndex._find(arrays, token_int, owner)
+            if i is not None:
+                floating_seconds_and_serial_number = (arrays[3][i], arrays[4][i])
+        return self._live(owner, floating_seconds_and_serial_number)
+
+    def _live(self, owner, floating_seconds_and_serial_number):
+        """
+        returns floating_seconds_and_serial_number, or None if it has expired or been given to remove_item
+        """
+        if (floating_seconds_and_serial_number is None) or (floating_seconds_and_serial_number[0] < self.horizons.get(owner, 0)) or \
+                ((owner,) + floating_seconds_and_serial_number in self.removed):
+            return None
+        return floating_seconds_and_serial_number
+
+    def get_many(self, owner, update_tokens):
+        """
+        returns [(floating_seconds, serial_number) or None] for each of update_tokens in owner
+        Those not in recent are looked up in the arrays in order, each search starting where the one before ended
+        """
+        ret = [None] * len(update_tokens)
+        probes = []  # [(low 64 bits, high 16 bits, i)]
+        for i, update_token in enumerate(update_tokens):
+            token_int = UpdateTokenIndex._token_int(update_token)
+            if token_int is None:
+                if update_token:
+                    ret[i] = self.other.get((update_token, owner))
+                continue
+            ret[i] = self.recent.get((token_int, owner))
+            if ret[i] is None:
+                probes.append((token_int & UpdateTokenIndex.MASK64, token_int >> 64, i))
+        lows, highs, owners, floating_secondses, serial_numbers = self.arrays
+        start = 0
+        for low, high, i in sorted(probes):
+            start = bisect_left(lows, low, start)
+            j = start
+            while j < len(lows) and lows[j] == low:
+                if highs[j] == high and owners[j] == owner:
+                    ret[i] = (floating_secondses[j], serial_numbers[j])
+                    break
+                j += 1
+        return [self._live(owner, floating_seconds_and_serial_number) for floating_seconds_and_serial_number in ret]
+
+    def add(self, owner, update_token, floating_seconds_and_serial_number):
+        token_int = UpdateTokenIndex._token_int(update_token)
+        with self.lock:
+            if token_int is None:
+                self.other[(update_token, owner)] = floating_seconds_and_serial_number
+            else:
+                self.recent[(token_int, owner)] = floating_seconds_and_serial_number
+                if len(self.recent) > max(self.merge_size, len(self.arrays[0]) // 4):
+                    self._merge()
+        return
+
+    def remove(self, owner, update_token, floating_seconds_and_serial_number):
+        """
+        Drop the entry of update_token in owner if it is of the item at floating_seconds_and_serial_number
+        """
+        token_int = UpdateTokenIndex._token_int(update_token)
+        with self.lock:
+            if token_int is None:
+                if self.other.get((update_token, owner)) == floating_seconds_and_serial_number:
+                    del self.other[(update_token, owner)]
+            elif self.recent.get((token_int, owner)) == floating_seconds_and_serial_number:
+                del self.recent[(token_int, owner)]
+            else:
+                arrays = self.arrays
+                i = UpdateTokenIndex._find(arrays, token_int, owner)
+                if (i is not None) and ((arrays[3][i], arrays[4][i]) == floating_seconds_and_serial_number):
+                    arrays[2][i] = UpdateTokenIndex.DELETED
+                    self.deleted_count += 1
+                    self._merge_if_mostly_deleted()
+        return
+
+    def remove_item(self, owner, floating_seconds_and_serial_number):
+        """
+        The item at floating_seconds_and_serial_number of owner has been deleted, its update token (if it had one) isn't
+        known, so its entry is dropped at the next merge
+        """
+        with self.lock:
+            self.removed.add((owner,) + floating_seconds_and_serial_number)
+            self._merge_if_mostly_deleted()
+        return
+
+    def expire_before(self, owner, floating_seconds, count=0):
+        """
+        Entries of owner from before floating_seconds, count more items, are of expired data, drop them at the next merge
+        """
+        with self.lock:
+            self.horizons[owner] = max(self.horizons.get(owner, 0), floating_seconds)
+            self.expired_count += count
+            self._merge_if_mostly_deleted()
+        return
+
+    def _merge_if_mostly_deleted(self):
+        """
+        Merge if more than a quarter of the arrays (and at least merge_size) are deleted or expired - must hold the lock
+        """
+        if self.deleted_count + len(self.removed) + self.expired_count > max(self.merge_size, len(self.arrays[0]) // 4):
+            self._merge()
+        return
+
+    def merge(self):
+        with self.lock:
+            self._merge()
+        return
+
+    def _merge(self):
+        """
+        Merge recent into a new set of arrays sorted by (low, high, owner), leaving out removed and expired entries,
+        and older entries of a token added again - must hold the lock
+        """
+        horizons, removed = self.horizons, self.removed
+
+        def live(row):  # row: (low, high, owner, floating_seconds, serial_number)
+            return (row[2] != UpdateTokenIndex.DELETED) and (row[3] >= horizons.get(row[2], 0)) and (row[2:5] not in removed)
+
+        new_arrays = (array('Q'), array('H'), array('B'), array('d'), array('I'))
+        existing = filter(live, zip(*self.arrays))
+        recent = sorted(filter(live, ((token_int & UpdateTokenIndex.MASK64, token_int >> 64, owner) + floating_seconds_and_serial_number
+                                      for (token_int, owner), floating_seconds_and_serial_number in self.recent.items())))
+        last = None
+        for row in heapq.merge(existing, recent, key=lambda r: r[0:3]):  # Stable, so a recent row follows an existing one
+            if last == row[0:3]:
+                for column in new_arrays:
+                    column.pop()
+            for column, value in zip(new_arrays, row):
+                column.append(value)
+            last = row[0:3]
+        self.other = {(update_token, owner): floating_seconds_and_serial_number
+                      for (update_token, owner), floating_seconds_and_serial_number in self.other.items()
+                      if (floating_seconds_and_serial_number[0] >= horizons.get(owner, 0)) and
+                      ((owner,) + floating_seconds_and_serial_number not in removed)}
+        self.arrays = new_arrays
+        self.deleted_count = 0
+        self.removed = set()
+        self.expired_count = 0
+        self.recent = {}
+        return
+
+
+class ColdStore:
+    """
+    Compressed segments holding data of a dict that is older than COLD_AFTER, instead of a small file per item.
+
+    Segment SEQ is two files in directory:
+    SEQ.seg blocks of up to block_size items in time order, each a compressed JSON [[floating_seconds, serial_number, blob]]
+    SEQ.idx zlib compressed JSON, written after SEQ.seg so it is only seen complete,
+            { compression, offsets: [start of each block, and end], firsts: [[floating_seconds, serial_number]] of the
+              first item of each block, last: [floating_seconds, serial_number], items: [[key, floating_seconds, serial_number, update_token]] }
+    Only the block index (firsts, offsets and last) of each segment is kept in memory, items are only read at startup
+    Times are as parsed from file_path, i.e. to the microsecond
+    """
+    compressors = {'zlib': (zlib.compress, zlib.decompress), 'lzma': (lzma.compress, lzma.decompress)}
+    block_cache_size = 32  # Decompressed blocks kept, reads of one update token chain are usually in the same block
+
+    def __init__(self, directory, block_size=256, compression='zlib', read_only=False):
+        self.directory = directory
+        self.block_size = block_size
+        self.compression = compression
+        self.read_only = read_only  # Another process writes the segments, so never remove them
+        # ([segment], [first of each segment], [maximum last of the segments up to each]) sorted by first,
+        # replaced as a whole so threads can read it without a lock
+        self.index = ([], [], [])
+        self.block_cache = OrderedDict()  # { (seq, block): [[floating_seconds, serial_number, blob]] }
+        self.lock = threading.Lock()  # For block_cache, and replacing index as compaction and deletion run in threads
+        return
+
+    def __len__(self):
+        return len(self.index[0])
+
+    def _file_path(self, seq, extension):
+        return '%s/%012d.%s' % (self.directory, seq, extension)
+
+    def _sequences(self):
+        try:
+            return sorted(int(file_name[:-4]) for file_name in os.listdir(self.directory) if file_name.endswith('.idx'))
+        except FileNotFoundError:
+            return []
+
+    def _read_segment_index(self, seq):
+        with open(self._file_path(seq, 'idx'), 'rb') as file:
+            return json.loads(zlib.decompress(file.read()))
+
+    @staticmethod
+    def _segment(seq, segment_index):
+        return {'seq': seq, 'compression': segment_index['compression'], 'offsets': segment_index['offsets'],
+                'firsts': [tuple(first) for first in segment_index['firsts']], 'last': tuple(segment_index['last'])}
+
+    def _set_segments(self, segments):
+        segments = sorted(segments, key=lambda segment: segment['firsts'][0])
+        maximum_lasts = []
+        for segment in segments:
+            maximum_lasts.append(max(maximum_lasts[-1], segment['last']) if maximum_lasts else segment['last'])
+        self.index = (segments, [segment['firsts'][0] for segment in segments], maximum_lasts)
+        return
+
+    def load(self):
+        """
+        Read the index of every segment
+        returns [(key, (floating_seconds, serial_number), update_token)] of the items in them
+        """
+        segments = []
+        items = []
+        for seq in self._sequences():
+            segment_index = self._read_segment_index(seq)
+            segments.append(ColdStore._segment(seq, segment_index))
+            items.extend((key, (floating_seconds, serial_number), update_token)
+                         for key, floating_seconds, serial_number, update_token in segment_index['items'])
+        self._set_segments(segments)
+        return items
+
+    def refresh(self):
+        """
+        Pick up segments written, and forget those removed, by another process
+        returns True if there are new segments
+        """
+        sequences = self._sequences()
+        with self.lock:
+            segments = [segment for segment in self.index[0] if segment['seq'] in sequences]
+            known = set(segment['seq'] for segment in segments)
+            new_sequences = [seq for seq in sequences if seq not in known]
+            for seq in new_sequences:
+                try:
+                    segments.append(ColdStore._segment(seq, self._read_segment_index(seq)))
+                except FileNotFoundError:
+                    pass  # Removed since listed
+            self._set_segments(segments)
+        return 0 != len(new_sequences)
+
+    def last(self):
+        """
+        returns the latest (floating_seconds, serial_number) in any segment, or None if there are none
+        """
+        maximum_lasts = self.index[2]
+        return maximum_lasts[-1] if maximum_lasts else None
+
+    def _read_block(self, segment, block):
+        cache_key = (segment['seq'], block)
+        with self.lock:
+            items = self.block_cache.get(cache_key)
+            if items is not None:
+                self.block_cache.move_to_end(cache_key)
+                return items
+        offsets = segment['offsets']
+        with open(self._file_path(segment['seq'], 'seg'), 'rb') as file:
+            file.seek(offsets[block])
+            data = file.read(offsets[block + 1] - offsets[block])
+        metrics.inc('bct_cold_block_reads_total')
+        items = json.loads(ColdStore.compressors[segment['compression']][1](data))
+        with self.lock:
+            self.block_cache[cache_key] = items
+            while len(self.block_cache) > self.block_cache_size:
+                self.block_cache.popitem(last=False)
+        return items
+
+    def get(self, floating_seconds_and_serial_number):
+        """
+        returns the blob stored for floating_seconds_and_serial_number, or None if it is not in a segment
+        """
+        segments, firsts, maximum_lasts = self.index
+        i = bisect_right(firsts, floating_seconds_and_serial_number)
+        while i > 0:
+            i -= 1
+            if maximum_lasts[i] < floating_seconds_and_serial_number:
+                break  # No earlier segment reaches this late
+            segment = segments[i]
+            if segment['last'] < floating_seconds_and_serial_number:
+                continue
+            block = bisect_right(segment['firsts'], floating_seconds_and_serial_number) - 1
+            for floating_seconds, serial_number, blob in self._read_block(segment, block):
+                if (floating_seconds, serial_number) == floating_seconds_and_serial_number:
+                    return blob
+        return None
+
+    def write(self, items):
+        """
+        Write a new segment
+        items: [(key, (floating_seconds, serial_number), update_token, blob)] in time order
+        """
+        compress = ColdStore.compressors[self.compression][0]
+        os.makedirs(self.directory, 0o770, exist_ok=True)
+        sequences = self._sequences()
+        seq = sequences[-1] + 1 if sequences else 1
+        offsets = [0]
+        firsts = []
+        temp_file_path = self._file_path(seq, 'seg.tmp')
+        with open(temp_file_path, 'wb') as file:
+            for i in range(0, len(items), self.block_size):
+                block = items[i:i + self.block_size]
+                data = compress(json.dumps([[floating_seconds_and_serial_number[0], floating_seconds_and_serial_number[1], blob]
+                                            for key, floating_seconds_and_serial_number, update_token, blob in block]).encode())
+                file.write(data)
+                offsets.append(offsets[-1] + len(data))
+                firsts.append(block[0][1])
+        os.replace(temp_file_path, self._file_path(seq, 'seg'))
+        segment_index = {
+            'compression': self.compression,
+            'offsets': offsets,
+            'firsts': firsts,
+            'last': items[-1][1],
+            'items': [[key, floating_seconds_and_serial_number[0], floating_seconds_and_serial_number[1], update_token]
+                      for key, floating_seconds_and_serial_number, update_token, blob in items]
+        }
+        temp_file_path = self._file_path(seq, 'idx.tmp')
+        with open(temp_file_path, 'wb') as file:
+            file.write(zlib.compress(json.dumps(segment_index).encode()))
+        os.replace(temp_file_path, self._file_path(seq, 'idx'))
+        with self.lock:
+            self._set_segments(self.index[0] + [ColdStore._segment(seq, segment_index)])
+        return
+
+    def drop_before(self, oldest):
+        """
+        Remove the segments with nothing at or after oldest, the (floating_seconds, serial_number) of the oldest item
+        still in the dict, or None if it is empty
+        returns number of segments removed
+        """
+        with self.lock:
+            segments = self.index[0]
+            # The dict's own times may be finer than the microseconds kept here
+            dropped = [segment for segment in segments if (oldest is None) or (segment['last'][0] + 0.000001 < oldest[0])]
+            if dropped:
+                self._set_segments([segment for segment in segments if segment not in dropped])
+        if dropped:
+            if not self.read_only:
+                for segment in dropped:
+                    os.remove(self._file_path(segment['seq'], 'idx'))  # First, so another process never finds an idx without its seg
+                    os.remove(self._file_path(segment['seq'], 'seg'))
+        return len(dropped)
+
+
 class FSBackedThreeLevelDict:
 
+    load_progress_seconds = 10  # Log progress of a long load this often
+    parallel_read_minimum = 4  # Fewer blobs than this missing from disk_cache are read one after another
+    parallel_read_chunk = 32  # Blobs read by each task on read_pool
+
     @staticmethod
     def dictionary_factory():
         return defaultdict(FSBackedThreeLevelDict.dictionary_factory)
 
-    def __init__(self, directory, retain_in_cache=120):
+    def __init__(self, directory, retain_in_cache=120, update_token_index=None, change_log=None, read_only=False,
+                 read_pool=None, volumes=None, cold_block_size=256, cold_compression='zlib'):
+        """
+        volumes: [data root] to stripe this dict over instead of directory, e.g. one on each local drive,
+        each holds a directory of the same name as directory, and each AB/CD directory is on one of them
+        cold_block_size, cold_compression: of the segments compact_cold writes
+        """
         # { AA: { BB: { CC: AABBCCDEF123: [(floating_seconds, serial)] } } }
+        self.name = os.path.basename(directory)  # e.g. contact_dict
+        self.directories = ['%s/%s' % (volume, self.name) for volume in volumes] if volumes else [directory]
+        self.change_log = change_log  # If set, inserts are logged to it
+        self.read_only = read_only  # Another process writes the files, so never remove them
+        self.read_pool = read_pool  # If set, an executor shared by the dicts to read many blobs from disk in parallel
         self.items = FSBackedThreeLevelDict.dictionary_factory()
         self.item_count = 0
-        self.update_index = {}  # UT: file_path
+        # UT: (floating_seconds, serial), normally shared with the other dicts
+        self.update_token_index = update_token_index if update_token_index is not None else UpdateTokenIndex()
+        self.update_token_owner = self.update_token_index.register(directory)
         # [ (floating_seconds, serial_number)* ] used to order data by time
         self.sorted_list_by_time_and_serial_number = sortedlist(key=lambda key: key[0])
         # { (floating_seconds, serial_number): file_path }
         self.time_and_serial_number_to_file_path_map = {}  # TODO-42 scaling issue ?
-        self.directory = directory
+        self.directory = self.directories[0]
         self.disk_cache = {}
+        # [(floating_seconds, file_path)] roughly in time order, used to drop old items from disk_cache a few at a time
+        self.disk_cache_order = deque()
         self.disk_cache_retention_time = retain_in_cache*60
-        os.makedirs(directory, 0o770, exist_ok=True)
+        for volume_directory in self.directories:
+            os.makedirs(volume_directory, 0o770, exist_ok=True)
+        # Older data compacted into compressed segments, see compact_cold
+        self.cold_store = ColdStore(self.directory + '/.cold', cold_block_size, cold_compression, read_only)
+        self.cold_horizon = None  # (floating_seconds, serial_number) of the latest item compacted, None if none are
+        self.late_file_paths = set()  # Items inserted at or before cold_horizon (e.g. by a late sync), still in files
+        self.missing_file_paths = set()  # In a read_only process, files the writer deleted first, see forget_missing
+        # { files, bytes, json_errors, cold_items, items, seconds, files_per_second } of loading from disk, for /admin/status
+        self.load_statistics = {'files': 0, 'bytes': 0, 'json_errors': 0, 'cold_items': 0}
+        load_start = time.time()
         self._load()
+        self.update_token_index.merge()
+        self._finish_load_statistics(time.time() - load_start)
         # file paths that are pending deletion
         self.file_paths_to_delete = []
         return
@@ -123,8 +602,8 @@ class FSBackedThreeLevelDict:
 
     def _add_to_items(self, key, floating_seconds_and_serial_number):
         bottom_level = self.get_bottom_level_from_key(key)  # { key: [(floating_seconds, serial)]
-        if key in bottom_level:  # Already at least one item for this key
-            bottom_level[key].append(floating_seconds_and_serial_number)
+        if key in bottom_level:  # Already at least one item for this key, keep them in time order for merging
+            insort(bottom_level[key], floating_seconds_and_serial_number)
         else:
             bottom_level[key] = [floating_seconds_and_serial_number]
         self.item_count += 1
@@ -134,37 +613,133 @@ class FSBackedThreeLevelDict:
         self._add_to_items(key, floating_seconds_and_serial_number)
         self.sorted_list_by_time_and_serial_number.add(floating_seconds_and_serial_number)
         if update_token:
-            self.update_index[update_token] = file_path
+            self.update_token_index.add(self.update_token_owner, update_token, floating_seconds_and_serial_number)
 
     def _should_cache(self, floating_seconds_and_serial_number):
         return (current_time() - floating_seconds_and_serial_number[0]) < self.disk_cache_retention_time
 
+    def _cache(self, file_path, floating_seconds_and_serial_number, blob):
+        self.disk_cache[file_path] = blob
+        self.disk_cache_order.append((floating_seconds_and_serial_number[0], file_path))
+
+    def _uncache_expired(self, maximum_items=None):
+        """
+        Drop up to maximum_items that are too old from disk_cache
+        """
+        until = current_time() - self.disk_cache_retention_time
+        count = 0
+        while self.disk_cache_order and (self.disk_cache_order[0][0] < until) and ((maximum_items is None) or (count < maximum_items)):
+            self.disk_cache.pop(self.disk_cache_order.popleft()[1], None)
+            count += 1
+        return
+
     def _load(self):
         """
         This creates the data structures that correspond to what is on disk
+        Each volume is read by its own thread, while this thread parses the files and builds the indexes
+        """
+        statistics = self.load_statistics
+        for key, floating_seconds_and_serial_number, update_token in self.cold_store.load():
+            file_path = '%s/%s' % (FSBackedThreeLevelDict.get_directory_name_from_key(key),
+                                   FSBackedThreeLevelDict._get_file_name_from_parts(key, floating_seconds_and_serial_number))
+            self._add_to_items_and_indexes(key, floating_seconds_and_serial_number, file_path, update_token)
+            statistics['cold_items'] += 1
+        self.cold_horizon = self.cold_store.last()
+        last_progress = time.time()
+        batches = queue.Queue(maxsize=100)
+        for volume_directory in self.directories:
+            threading.Thread(target=self._read_volume, args=(volume_directory, batches), name='load-%s' % volume_directory,
+                             daemon=True).start()
+        volumes_loading = len(self.directories)
+        while volumes_loading:
+            batch = batches.get()
+            if batch is None:
+                volumes_loading -= 1
+                continue
+            if isinstance(batch, Exception):
+                raise batch  # Put a breakpoint here if seeing this fail
+            for root, file_name, contents in batch:
+                key, floating_seconds_and_serial_number = FSBackedThreeLevelDict._get_parts_from_file_name(file_name)
+                file_path = FSBackedThreeLevelDict._get_file_path_from_file_name(file_name)
+                if (len(self.directories) > 1) and not root.startswith(self._get_volume_directory(file_path) + '/'):
+                    raise ValueError('%s/%s is not on the volume DATA_DIRECTORIES places it on, %s, move the files to '
+                                     'match the volumes before starting' % (root, file_name, self._get_volume_directory(file_path)))
+                # Note this is expensive, it has to read each file to find update_tokens
+                # - maintaining an index would be better.
+
+                if floating_seconds_and_serial_number in self.time_and_serial_number_to_file_path_map:
+                    # Already in a cold segment, left by compact_cold being interrupted before removing it
+                    if not self.read_only:
+                        os.remove('/'.join([root, file_name]))
+                    continue
+                if self.cold_horizon and (floating_seconds_and_serial_number <= self.cold_horizon):
+                    self.late_file_paths.add(file_path)
+                statistics['files'] += 1
+                statistics['bytes'] += len(contents)
+                if (0 == statistics['files'] % 10000) and (time.time() - last_progress > self.load_progress_seconds):
+                    last_progress = time.time()
+                    logger.warn('Loading {name}: {files} files, {bytes} bytes so far', name=self.name,
+                                files=statistics['files'], bytes=statistics['bytes'])
+                try:
+                    blob = json.loads(contents)
+                except json.JSONDecodeError:
+                    logger.error("Bad JSON file at {file_path}", file_path='/'.join([root, file_name]))
+                    statistics['json_errors'] += 1
+                    blob = None
+                    # Ignore file, leave for diagnosis
+                if blob:
+                    if self._should_cache(floating_seconds_and_serial_number):
+                        self._cache(file_path, floating_seconds_and_serial_number, blob)
+                    update_token = blob.get('update_token')
+                    self._add_to_items_and_indexes(key, floating_seconds_and_serial_number, file_path, update_token)
+                    self._load_key(key, blob)
+        self.disk_cache_order = deque(sorted(self.disk_cache_order))  # os.walk order is not time order
+        return
+
+    def _read_volume(self, volume_directory, batches, batch_size=1000):
+        """
+        Read the .data files under volume_directory, putting them on batches as [(root, file_name, contents)],
+        then None when done, or the exception if reading fails
         """
-        for root, sub_dirs, files in os.walk(self.directory):
-            for file_name in files:
-                if file_name.endswith('.data'):
-                    key, floating_seconds_and_serial_number = FSBackedThreeLevelDict._get_parts_from_file_name(file_name)
-                    file_path = FSBackedThreeLevelDict._get_file_path_from_file_name(file_name)
-                    # Note this is expensive, it has to read each file to find update_tokens
-                    # - maintaining an index would be better.
-
-                    try:
-                        blob = json.load(open('/'.join([root, file_name])))
-                    except json.JSONDecodeError:
-                        logger.error("Bad JSON file at {file_path}", file_path='/'.join([root, file_name]))
-                        blob = None
-                        # Ignore file, leave for diagnosis
-                    except Exception as e:
-                        raise e  # Put a breakpoint here if seeing this fail
-                    if blob:
-                        if self._should_cache(floating_seconds_and_serial_number):
-                            self.disk_cache[file_path] = blob
-                        update_token = blob.get('update_token')
-                        self._add_to_items_and_indexes(key, floating_seconds_and_serial_number, file_path, update_token)
-                        self._load_key(key, blob)
+        try:
+            batch = []
+            for root, sub_dirs, files in os.walk(volume_directory):
+                for file_name in files:
+                    if file_name.endswith('.tmp') and not self.read_only:
+                        os.remove('/'.join([root, file_name]))  # Left by a write interrupted before its rename
+                    elif file_name.endswith('.data'):
+                        with open('/'.join([root, file_name]), 'rb') as file:
+                            batch.append((root, file_name, file.read()))
+                        if len(batch) >= batch_size:
+                            batches.put(batch)
+                            batch = []
+            batches.put(batch)
+            batches.put(None)
+        except Exception as e:
+            batches.put(e)
+        return
+
+    def _get_volume_directory(self, file_path):
+        """
+        returns the directory of the volume file_path is on, chosen by its AB/CD directory, rather than just AB,
+        because the spatial keys of a city share their AB
+        This depends on the list of volumes, so _load refuses files that are not where it says they are
+        """
+        if 1 == len(self.directories):
+            return self.directory
+        return self.directories[zlib.crc32(file_path[0:5].encode()) % len(self.directories)]
+
+    def _get_full_path(self, file_path):
+        return '%s/%s' % (self._get_volume_directory(file_path), file_path)
+
+    def _finish_load_statistics(self, seconds):
+        statistics = self.load_statistics
+        statistics['items'] = self.item_count
+        statistics['seconds'] = round(seconds, 3)
+        statistics['files_per_second'] = round(statistics['files'] / seconds) if seconds else None
+        # Intentionally at warn level, it is needed to size restart windows
+        logger.warn('Loaded {name}: {items} items from {files} files, {bytes} bytes, {json_errors} bad JSON, '
+                    'in {seconds} seconds, {files_per_second} files/second', name=self.name, **statistics)
         return
 
     def _load_key(self, key, blob):
@@ -217,7 +792,7 @@ class FSBackedThreeLevelDict:
 
     def insert(self, key, value, floating_seconds_and_serial_number):
         """
-        Insert value object at key with date, keep various indexes to it (update_index)
+        Insert value object at key with date, keep various indexes to it (update_token_index)
 
         Parameters:
         -----------
@@ -233,7 +808,7 @@ class FSBackedThreeLevelDict:
         #    logger.warning('%s already in data for %s' % (value, key))
         #    return
         update_token = value.get('update_token')
-        if update_token in self.update_index:
+        if self.get_file_path_from_update_token(update_token) is not None:
             logger.info('Silently ignoring duplicate of update token: {update_token}', update_token=update_token)
         else:
             if 6 > len(key):
@@ -242,15 +817,23 @@ class FSBackedThreeLevelDict:
             dir_name = FSBackedThreeLevelDict.get_directory_name_from_key(key)
             file_name = FSBackedThreeLevelDict._get_file_name_from_parts(key, floating_seconds_and_serial_number)
             file_path = '%s/%s' % (dir_name, file_name)
-            # Put in the in-memory data structures
+            # Put in the file system first, and atomically, so anything that finds file_path in the indexes can read it
+            full_path = self._get_full_path(file_path)
+            os.makedirs(os.path.dirname(full_path), 0o770, exist_ok=True)
+            logger.payload('writing {value} to {directory}', value=value, directory=full_path)
+            try:
+                write_json_atomically(full_path, value)
+            except FileNotFoundError:  # compact_cold removed the directory, as it had emptied it, since makedirs
+                os.makedirs(os.path.dirname(full_path), 0o770, exist_ok=True)
+                write_json_atomically(full_path, value)
+            self._cache(file_path, floating_seconds_and_serial_number, value)
+            # Now put in the in-memory data structures
+            if self.cold_horizon and (floating_seconds_and_serial_number <= self.cold_horizon):
+                self.late_file_paths.add(file_path)
             self._add_to_items_and_indexes(key, floating_seconds_and_serial_number, file_path, update_token)
-            # Now put in the file system
-            os.makedirs(self.directory + '/' + dir_name, 0o770, exist_ok=True)
-            logger.info('writing {value} to {directory}', value=value, directory=self.directory + '/' + file_path)
-            self.disk_cache[file_path] = value
-            with open(self.directory + '/' + file_path, 'w') as file:
-                json.dump(value, file)
             self._insert_disk(key)   # Depends on get_key_from_blob above
+            if self.change_log:
+                self.change_log.append(self.name, key, floating_seconds_and_serial_number, update_token)
         return
 
     def __len__(self):
@@ -259,63 +842,225 @@ class FSBackedThreeLevelDict:
     def get_blob_from_file_path(self, file_path):
         res = self.disk_cache.get(file_path)  # Don't use the "in disk_cache" structure as would not be thread safe
         if res:
+            metrics.inc('bct_blob_cache_hits_total', (('dict', self.name),))
             return res
         else:
+            metrics.inc('bct_blob_cache_misses_total', (('dict', self.name),))
             (key, floating_seconds_and_serial_number) = FSBackedThreeLevelDict._get_parts_from_file_path(file_path)
             blob = self.get_blob_from_file_path_disk(file_path)
-            if self._should_cache(floating_seconds_and_serial_number):
-                self.disk_cache[file_path] = blob
+            if (blob is not None) and self._should_cache(floating_seconds_and_serial_number):
+                self._cache(file_path, floating_seconds_and_serial_number, blob)
             return blob
 
     def get_blob_from_file_path_disk(self, file_path):  # TODO-177 handle errors gracefully esp JSON ones, though should not happen.
-        max_tries = 100
+        """
+        Files are written atomically and before they are indexed, so are never seen part written, an error is retried
+        once straight away, in case of a transient file system error, and otherwise raised rather than waited out
+        Older data is looked for in the cold segments first
+        returns None in a read_only process if the writer has deleted the file, e.g. expired it before this process did
+        """
+        if len(self.cold_store) and (file_path not in self.late_file_paths):
+            blob = self._get_blob_from_cold_store(file_path)
+            if blob is not None:
+                return blob
+        tries = 2
         while True:  # Exits via return or raise
-            max_tries -= 1
+            tries -= 1
+            metrics.inc('bct_disk_reads_total', (('dict', self.name),))
             try:
-                return json.load(open('/'.join([self.directory, file_path])))
+                with open(self._get_full_path(file_path)) as file:
+                    return json.load(file)
             except json.JSONDecodeError as e:
-                logger.error("Bad JSON file at {file_path}", file_path='/'.join([self.directory, file_path]))
+                logger.error("Bad JSON file at {file_path}", file_path=self._get_full_path(file_path))
                 raise e
-            except Exception as e:
-                logger.error("Error in get_blob_from_file_path_disk {file_path} {e}", file_path=self.directory + '/' + file_path, e=str(e))
-                if max_tries == 0:
+            except OSError as e:
+                # Compacted into a cold segment since file_path was looked up, by the writer if this is a read worker
+                if isinstance(e, FileNotFoundError) and (not self.read_only or self.cold_store.refresh()):
+                    blob = self._get_blob_from_cold_store(file_path)
+                    if blob is not None:
+                        return blob
+                if isinstance(e, FileNotFoundError) and self.read_only:
+                    logger.info('{file_path} was deleted by the writer', file_path=file_path)
+                    self.missing_file_paths.add(file_path)
+                    return None
+                logger.error("Error in get_blob_from_file_path_disk {file_path} {e}", file_path=self._get_full_path(file_path), e=str(e))
+                if tries == 0:
+                    metrics.inc('bct_disk_read_errors_total', (('dict', self.name),))
                     raise e  # Put a breakpoint here if seeing this fail
-                time.sleep(random.uniform(0, 0.500))   # Wait a little while and try again
+                metrics.inc('bct_disk_read_retries_total', (('dict', self.name),))
+
+    def _get_blob_from_cold_store(self, file_path):
+        """
+        returns blob for file_path from the cold segments, or None if it isn't in them
+        """
+        (key, floating_seconds_and_serial_number) = FSBackedThreeLevelDict._get_parts_from_file_path(file_path)
+        last = self.cold_store.last()
+        if (last is None) or (floating_seconds_and_serial_number > last):
+            return None
+        return self.cold_store.get(floating_seconds_and_serial_number)
 
     def get_blob_from_file_name(self, file_name):
         return self.get_blob_from_file_path(FSBackedThreeLevelDict._get_file_path_from_file_name(file_name))
 
     def get_blob_from_file_paths(self, file_paths):
-        for file_path in file_paths:
-            yield self.get_blob_from_file_path(file_path)
-        return
+        """
+        returns [blob] in the order of file_paths, None for any get_blob_from_file_path_disk found deleted
+        Those not in disk_cache are read in parallel on read_pool, in file_path order so reads in the same directory
+        are issued together, and with the runs from each volume interleaved so all the volumes are read from at once
+        """
+        blobs = [self.disk_cache.get(file_path) for file_path in file_paths]
+        missing = sorted((file_path, i) for i, (file_path, blob) in enumerate(zip(file_paths, blobs)) if not blob)
+        metrics.inc('bct_blob_cache_hits_total', (('dict', self.name),), len(file_paths) - len(missing))
+        metrics.inc('bct_blob_cache_misses_total', (('dict', self.name),), len(missing))
+        if (self.read_pool is None) or (len(missing) < self.parallel_read_minimum):
+            read_blobs = map(self.get_blob_from_file_path_disk, [file_path for file_path, i in missing])
+        else:
+            # Each task reads a run of neighbouring files, one task per file costs more than a cached read
+            missing_by_volume = defaultdict(list)
+            for file_path, i in missing:
+                missing_by_volume[self._get_volume_directory(file_path)].append((file_path, i))
+            volume_chunks = [[volume_missing[j:j + self.parallel_read_chunk] for j in range(0, len(volume_missing), self.parallel_read_chunk)]
+                             for volume_missing in missing_by_volume.values()]
+            chunks = [chunk for chunks in zip_longest(*volume_chunks) for chunk in chunks if chunk]
+            missing = [item for chunk in chunks for item in chunk]  # The order they are read in
+            read_blobs = (blob for chunk_blobs in self.read_pool.map(self._get_blobs_from_file_paths_disk, chunks) for blob in chunk_blobs)
+        for (file_path, i), blob in zip(missing, read_blobs):
+            (key, floating_seconds_and_serial_number) = FSBackedThreeLevelDict._get_parts_from_file_path(file_path)
+            if (blob is not None) and self._should_cache(floating_seconds_and_serial_number):
+                self._cache(file_path, floating_seconds_and_serial_number, blob)
+            blobs[i] = blob
+        return blobs
+
+    def _get_blobs_from_file_paths_disk(self, chunk):
+        return [self.get_blob_from_file_path_disk(file_path) for file_path, i in chunk]
 
     def _delete(self, file_path):
         logger.info("deleting {file_path}", file_path=file_path)
-        blob = self.get_blob_from_file_path(file_path)
-        update_token = blob.get('update_token')
-        if update_token:
-            del self.update_index[update_token]
-        os.remove(self.directory + "/" + file_path)
+        self.late_file_paths.discard(file_path)
+        if not self.read_only:
+            try:
+                os.remove(self._get_full_path(file_path))
+            except FileNotFoundError:
+                if not len(self.cold_store):
+                    raise
+                # Otherwise it is in a cold segment, which is removed once nothing in it is left
+        return
+
+    def _delete_all(self, file_paths):
+        for file_path in file_paths:
+            self._delete(file_path)
         return
 
+    def apply_change(self, key, floating_seconds_and_serial_number, update_token):
+        """
+        Add an item inserted by another process (from a ChangeLog) to the in memory data structures
+        returns True if it wasn't already known
+        """
+        if floating_seconds_and_serial_number in self.time_and_serial_number_to_file_path_map:
+            return False  # Already loaded from disk
+        file_path = '%s/%s' % (FSBackedThreeLevelDict.get_directory_name_from_key(key),
+                               FSBackedThreeLevelDict._get_file_name_from_parts(key, floating_seconds_and_serial_number))
+        self._add_to_items_and_indexes(key, floating_seconds_and_serial_number, file_path, update_token)
+        return True
+
     def delete_from_deletion_list(self):
         logger.info('there are {count} items to delete', count=len(self.file_paths_to_delete))
+        deletions_by_volume = defaultdict(list)
         while 0 != len(self.file_paths_to_delete):
             file_path = self.file_paths_to_delete.pop()
-            self._delete(file_path)
+            deletions_by_volume[self._get_volume_directory(file_path)].append(file_path)
+        if len(deletions_by_volume) > 1:
+            # Delete from each volume at once
+            with ThreadPoolExecutor(len(deletions_by_volume), thread_name_prefix='delete') as executor:
+                list(executor.map(self._delete_all, deletions_by_volume.values()))
+        else:
+            for deletions in deletions_by_volume.values():
+                self._delete_all(deletions)
+        if len(self.cold_store):
+            sorted_list = self.sorted_list_by_time_and_serial_number
+            self.cold_store.drop_before(sorted_list[0] if len(sorted_list) else None)
         return
 
+    def forget_missing(self):
+        """
+        In a read_only process, drop the items whose files get_blob_from_file_path_disk found the writer had deleted
+        Run in the reactor, like move_expired_data_to_deletion_list
+        returns [(floating_seconds, serial_number)] dropped
+        """
+        forgotten = []
+        while self.missing_file_paths:
+            file_path = self.missing_file_paths.pop()
+            key = FSBackedThreeLevelDict._get_key_from_file_name(FSBackedThreeLevelDict._get_file_name_from_file_path(file_path))
+            for floating_seconds_and_serial_number in self.get_floating_seconds_and_serial_number_list_from_key(key):
+                if self.time_and_serial_number_to_file_path_map.get(floating_seconds_and_serial_number) == file_path:
+                    forgotten.append(floating_seconds_and_serial_number)
+                    break
+        self.move_data_list_to_deletion(forgotten)
+        return forgotten
+
+    def select_cold(self, until, maximum_items):
+        """
+        Choose items to compact_cold, up to maximum_items of the oldest not yet compacted from before until, and any
+        inserted since that are older than the ones that were
+        Run in the reactor, like move_expired_data_to_deletion_list
+        returns [file_path]
+        """
+        cold_horizon = self.cold_horizon
+        selected = [floating_seconds_and_serial_number for floating_seconds_and_serial_number in
+                    self.sorted_list_by_time_and_serial_number_range(cold_horizon[0] if cold_horizon else 0, until, maximum_items)
+                    if (cold_horizon is None) or (floating_seconds_and_serial_number > cold_horizon)]
+        if selected:
+            self.cold_horizon = selected[-1]
+        late_file_paths = list(self.late_file_paths)[0:maximum_items]
+        return [self.time_and_serial_number_to_file_path_map[floating_seconds_and_serial_number]
+                for floating_seconds_and_serial_number in selected] + late_file_paths
+
+    def compact_cold(self, file_paths):
+        """
+        Move the items at file_paths, from select_cold, out of their files into a new cold segment
+        Run in a thread, the files are only removed once the segment is written
+        returns number of items moved
+        """
+        items = []
+        for file_path in file_paths:
+            try:
+                with open(self._get_full_path(file_path)) as file:
+                    blob = json.load(file)
+            except FileNotFoundError:
+                continue  # Expired and deleted since it was selected
+            key, floating_seconds_and_serial_number = FSBackedThreeLevelDict._get_parts_from_file_path(file_path)
+            items.append((key, floating_seconds_and_serial_number, blob.get('update_token'), blob))
+        if items:
+            items.sort(key=lambda item: item[1])
+            self.cold_store.write(items)
+        for file_path in file_paths:
+            self.late_file_paths.discard(file_path)
+            try:
+                os.remove(self._get_full_path(file_path))
+            except FileNotFoundError:
+                pass
+        # Empty directories take as much space as the small files did
+        for dir_name in sorted(set(file_path[0:8] for file_path in file_paths), reverse=True):
+            for parent_dir_name in [dir_name, dir_name[0:5], dir_name[0:2]]:
+                try:
+                    os.rmdir('%s/%s' % (self._get_volume_directory(dir_name), parent_dir_name))
+                except OSError:
+                    break  # Not empty
+        return len(items)
+
     def get_floating_seconds_and_serial_number_list_from_key(self, key):
         return self.get_bottom_level_from_key(key).get(key) or []  # Could be None
 
+    def _remove_from_items(self, key, floating_seconds_and_serial_number):
+        self.get_floating_seconds_and_serial_number_list_from_key(key).remove(floating_seconds_and_serial_number)
+
     def move_data_by_key_to_deletion(self, key):
         bottom_level = self.get_bottom_level_from_key(key)
         if key in bottom_level:
-            self.move_data_list_to_deletion(bottom_level[key])
+            self.move_data_list_to_deletion(list(bottom_level[key]))  # Copy as move_data_list_to_deletion removes from it
             del bottom_level[key]
 
-    def move_expired_data_to_deletion_list(self, since, until):
+    def move_expired_data_to_deletion_list(self, since, until, maximum_items=None):
         """ 
         take old data and move it to the deletion list, but don't do the deletion 
 
@@ -323,24 +1068,37 @@ class FSBackedThreeLevelDict:
         ----------
         since -- unix time 
         until -- unix time
+        maximum_items -- int move at most this many, so that expiry can be done in small slices (None for all)
+        returns number of items moved
+        """
+        self._uncache_expired(maximum_items)
+        deletion_list = list(self.sorted_list_by_time_and_serial_number_range(since, until, maximum_items))
+        self.move_data_list_to_deletion(deletion_list, expired=True)
+        if deletion_list:
+            # The slice may have stopped part way through the items at the time of its last one
+            self.update_token_index.expire_before(self.update_token_owner, deletion_list[-1][0], len(deletion_list))
+        return len(deletion_list)
+
+    def count_before(self, until):
         """
-        # TODO-181 not deleting this fast enough
-        for file_path in self.disk_cache:
-            (key, floating_seconds_and_serial_number) = self._get_parts_from_file_path(file_path)
-            if not self._should_cache(floating_seconds_and_serial_number):
-                del self.disk_cache[file_path]
-        deletion_list = list(self.sorted_list_by_time_and_serial_number_range(since, until, None))
-        self.move_data_list_to_deletion(deletion_list)
+        returns number of items older than until
+        """
+        return self._sorted_idx(until)
 
-    def move_data_list_to_deletion(self, deletion_list):
+    def move_data_list_to_deletion(self, deletion_list, expired=False):
         for floating_seconds_and_serial_number in deletion_list:
             self.sorted_list_by_time_and_serial_number.remove(floating_seconds_and_serial_number)
-            file_path = self.time_and_serial_number_to_file_path_map[floating_seconds_and_serial_number]
+            file_path = self.time_and_serial_number_to_file_path_map.pop(floating_seconds_and_serial_number)
             logger.info("moving {file_path} to deletion list", file_path=file_path)
-            key, floating_seconds_and_serial_number = FSBackedThreeLevelDict._get_parts_from_file_path(file_path)
-            self.get_floating_seconds_and_serial_number_list_from_key(key).remove(floating_seconds_and_serial_number)
+            # The key is the start of the file name, its time can't be used as it is rounded to the microsecond
+            key = FSBackedThreeLevelDict._get_key_from_file_name(FSBackedThreeLevelDict._get_file_name_from_file_path(file_path))
+            self._remove_from_items(key, floating_seconds_and_serial_number)
+            blob = self.disk_cache.pop(file_path, None)
+            if blob and blob.get('update_token'):
+                self.update_token_index.remove(self.update_token_owner, blob['update_token'], floating_seconds_and_serial_number)
+            elif not expired:  # Expired entries are left out by the horizon move_expired_data_to_deletion_list sets
+                self.update_token_index.remove_item(self.update_token_owner, floating_seconds_and_serial_number)
             self.file_paths_to_delete.append(file_path)
-            del self.time_and_serial_number_to_file_path_map[floating_seconds_and_serial_number]
             self.item_count -= 1
         return
 
@@ -357,8 +1115,23 @@ class FSBackedThreeLevelDict:
         dir_name = FSBackedThreeLevelDict.get_directory_name_from_key(FSBackedThreeLevelDict._get_key_from_file_name(file_name))
         return "%s/%s" % (dir_name, file_name)
 
+    def get_file_paths_from_update_tokens(self, update_tokens):
+        """
+        update_tokens: [str, or int as from get_update_token_ints]
+        returns [file_path or None] for each of update_tokens
+        """
+        file_path_map = self.time_and_serial_number_to_file_path_map
+        return [file_path_map.get(floating_seconds_and_serial_number)
+                for floating_seconds_and_serial_number in self.update_token_index.get_many(self.update_token_owner, update_tokens)]
+
+    def get_file_path_from_update_token(self, update_token):
+        floating_seconds_and_serial_number = self.update_token_index.get(self.update_token_owner, update_token)
+        if floating_seconds_and_serial_number is None:
+            return None
+        return self.time_and_serial_number_to_file_path_map.get(floating_seconds_and_serial_number)
+
     def _get_blob_from_update_token(self, update_token):
-        file_path = self.update_index.get(update_token)
+        file_path = self.get_file_path_from_update_token(update_token)
         if file_path:
             return self.get_blob_from_file_path(file_path)
         else:
@@ -415,7 +1188,7 @@ class ContactDict(FSBackedThreeLevelDict):
 
     def _map_over_matching_contacts(self, prefix, ids, since, now, start_pos=0):
         """
-        returns iter [ floating_time_and_serial ]
+        returns iter [ iter floating_time_and_serial ] one in time order for each matching contact
         """
         logger.info('_map_over_matching_contacts called with {prefix}, {keys}', prefix=prefix, keys=ids.keys())
         if start_pos < 6:
@@ -436,23 +1209,62 @@ class ContactDict(FSBackedThreeLevelDict):
                         yield from self._map_over_matching_contacts(prefix, these_ids, since, now, start_pos + 2)
         else:
             for contact_id in filter(lambda x: x.startswith(prefix.upper()), ids.keys()):
-                for floating_seconds_and_serial_number in ids[contact_id]:
-                    if _good_date(floating_seconds_and_serial_number, since, now):
-                        yield floating_seconds_and_serial_number
+                yield _good_dates(ids[contact_id], since, now)
         return
 
     def map_over_prefixes(self, prefixes, since, now):
         """
-        Return iter [(floating_seconds,serial)] that match the prefix and are between the times
+        Return iter [(floating_seconds,serial)] that match the prefix and are between the times, in time order
         """
-        for prefix in prefixes:
-            yield from self._map_over_matching_contacts(prefix, self.items, since, now)
-        return
+        return heapq.merge(*[floating_seconds_and_serial_number_list for prefix in prefixes
+                             for floating_seconds_and_serial_number_list in self._map_over_matching_contacts(prefix, self.items, since, now)])
 
     def get_key_from_blob(self, blob):
         return blob.get('id')
 
 
+# The spatial key functions are outside SpatialDict as the router (router.py) uses them to find the shard for a location
+
+def spatial_key_from_bbox(bbox, bb_min_dp):
+    """
+    bbox: (lat, long) as ints * 10**bb_min_dp
+    """
+    lat, long = bbox
+    return "%0*X%0*X" % (bb_min_dp + 2, (lat + 90 * 10 ** bb_min_dp), bb_min_dp + 2, (long + 180 * 10 ** bb_min_dp))
+
+
+def spatial_key_from_lat_long(key_tuple, bb_min_dp):
+    """
+    key_tuple: (float lat, float long)
+    """
+    bbox = [math.floor(lat_or_long_float * 10 ** bb_min_dp) for lat_or_long_float in key_tuple]
+    return spatial_key_from_bbox(bbox, bb_min_dp)
+
+
+def split_bounding_boxes(bounding_boxes, bb_min_dp):
+    """
+    Split a bounding_box into an array of bounding boxes each BOUNDING_BOX_MINIMUM_DP size (2DP)
+    Adjust parameters to be integers
+    bounding_box: (minLat, minLong, maxLat, maxLong)
+    Edge case at -180° latitude, and also if minLong > maxLong (e.g. because use 17900->-17900 as 2° of latitude, not 358°
+    """
+    if bounding_boxes is None:
+        return None
+    bboxs = []
+    for bounding_box in bounding_boxes:
+        bb1 = [int(x * 10 ** bb_min_dp) for x in bounding_box]  # Turn into integers at desired resolution of bbox
+        if bb1[3] < bb1[1]:  # Swap if have min and max lat around other way (check for 180° edge case below)
+            s = bb1[3]
+            bb1[3] = bb1[1]
+            bb1[1] = s
+        if (bb1[3]-bb1[1]) > (180 * 10 ** bb_min_dp):  # Handle bounding boxes around the 180° date-line
+            bboxs.extend([(lat, long) for lat in range(bb1[0], bb1[2]) for long in range(-180 * 10 ** bb_min_dp, bb1[1])])
+            bboxs.extend([(lat, long) for lat in range(bb1[0], bb1[2]) for long in range(bb1[3], 180 * 10 ** bb_min_dp)])
+        else:
+            bboxs.extend([(lat, long) for lat in range(bb1[0], bb1[2]) for long in range(bb1[1], bb1[3])])  # [(int lat*10^2, int long*10^2)]
+    return bboxs
+
+
 class SpatialDict(FSBackedThreeLevelDict):
     """
     Data is stored as
@@ -481,8 +1293,7 @@ class SpatialDict(FSBackedThreeLevelDict):
         """"
         bbox: (lat, long) as ints * 10**bb_min_do
         """
-        lat, long = bbox
-        return "%0*X%0*X" % (self.bb_min_dp + 2, (lat + 90 * 10 ** self.bb_min_dp), self.bb_min_dp + 2, (long + 180 * 10 ** self.bb_min_dp))
+        return spatial_key_from_bbox(bbox, self.bb_min_dp)
 
     def _get_key_from_lat_long(self, key_tuple):
         """ 
@@ -497,8 +1308,7 @@ class SpatialDict(FSBackedThreeLevelDict):
         key_tuple -- (float lat, float long)
 
         """
-        bbox = [math.floor(lat_or_long_float * 10 ** self.bb_min_dp) for lat_or_long_float in key_tuple]
-        return self.get_key_from_bbox(bbox)
+        return spatial_key_from_lat_long(key_tuple, self.bb_min_dp)
 
     def _insert_disk(self, key_string):
         """
@@ -506,16 +1316,23 @@ class SpatialDict(FSBackedThreeLevelDict):
         """
         pass
 
-    def _intersections(self, bboxs):  # TODO-42 maybe compress into a single yield
-        # returns iter [ (floating_seconds, serial) ]
+    def _intersections(self, bboxs):
+        # returns iter [ [ (floating_seconds, serial) ] ] one list in time order for each bbox
         # logger.warn("XXX _intersections bboxs size={size}", size=len(bboxs))
         for bbox in bboxs:
             key = self.get_key_from_bbox(bbox)
-            yield from self.get_floating_seconds_and_serial_number_list_from_key(key)
+            yield self.get_floating_seconds_and_serial_number_list_from_key(key)
         return
 
+    def map_over_bounding_boxes(self, bboxs, since, now):
+        """
+        Return iter [(floating_seconds,serial)] inside the bboxs and between the times, in time order
+        """
+        return heapq.merge(*[_good_dates(floating_seconds_and_serial_number_list, since, now)
+                             for floating_seconds_and_serial_number_list in self._intersections(bboxs)])
+
     def list_over_bounding_boxes(self, bboxs, since, now):
-        return [floating_time_and_serial for floating_time_and_serial in self._intersections(bboxs) if _good_date(floating_time_and_serial, since, now)]
+        return list(self.map_over_bounding_boxes(bboxs, since, now))
 
     def get_key_from_blob(self, blob):
         key_tuple = SpatialDict._get_lat_long_from_blob(blob)
@@ -535,11 +1352,22 @@ class SimpleFSBackedDict(FSBackedThreeLevelDict):
 
     def __init__(self, directory, subdir, **kwargs):
         directory = directory + subdir
+        # Keys that have data, so "x in dict" (which nearly always misses) doesn't walk, and grow, the three levels
+        self.keys = set()
         super().__init__(directory, **kwargs)
 
     def _insert_disk(self, key):  # Not required
         return
 
+    def _add_to_items(self, key, floating_seconds_and_serial_number):
+        super()._add_to_items(key, floating_seconds_and_serial_number)
+        self.keys.add(key)
+
+    def _remove_from_items(self, key, floating_seconds_and_serial_number):
+        super()._remove_from_items(key, floating_seconds_and_serial_number)
+        if not self.get_floating_seconds_and_serial_number_list_from_key(key):
+            self.keys.discard(key)
+
     def map_over_matching_data(self, key, since, now):
         """
         returns: [file_path]
@@ -554,7 +1382,7 @@ class SimpleFSBackedDict(FSBackedThreeLevelDict):
         raise NotImplementedError
 
     def __contains__(self, key):
-        return key in self.get_bottom_level_from_key(key)
+        return key in self.keys
 
     def __getitem__(self, key):
         for file_path in self.map_over_matching_data(key, None, None):
@@ -562,6 +1390,7 @@ class SimpleFSBackedDict(FSBackedThreeLevelDict):
 
     def __delitem__(self, key):
         self.move_data_by_key_to_deletion(key)
+        self.keys.discard(key)
 
 
 # noinspection PyAbstractClass
@@ -573,6 +1402,324 @@ class UpdatesDict(SimpleFSBackedDict):
         logger.info('Loading Updates dict from disk')
         super().__init__(directory, '/updates_dict', **kwargs)
 
+
+class ChangeLog:
+    """
+    Append only log of every insert into the dicts, so other processes can follow what is being inserted without
+    walking the directories.
+    Each entry has a sequence number, starting at 1, entries are stored one JSON line each
+    [dict_name, key, floating_seconds, serial_number, update_token]
+    in segment files directory/.changes/SEQ.log named by the sequence number of their first entry.
+    Every index_interval entries the byte offset of the entry is added to SEQ.idx, one "seq offset" line each, so a
+    follower can seek close to any entry rather than read the segment from its start.
+    """
+
+    def __init__(self, directory, segment_size=100000, retention_seconds=45*24*60*60, index_interval=1000):
+        self.directory = directory + '/.changes'
+        self.segment_size = segment_size
+        self.retention_seconds = retention_seconds
+        self.index_interval = index_interval
+        self.file = None  # Opened on first append, so processes that only follow the log never write to it
+        self.next_seq = None
+        self.segment_count = 0  # Entries in the segment being appended to
+        self.segment_bytes = 0  # Length of the segment being appended to
+        return
+
+    def segments(self):
+        """
+        returns [first_seq] of each segment in order
+        """
+        try:
+            return sorted(int(file_name[:-4]) for file_name in os.listdir(self.directory) if file_name.endswith('.log'))
+        except FileNotFoundError:
+            return []
+
+    def segment_path(self, first_seq):
+        return '%s/%012d.log' % (self.directory, first_seq)
+
+    def index_path(self, first_seq):
+        return '%s/%012d.idx' % (self.directory, first_seq)
+
+    def checkpoint(self, first_seq, seq):
+        """
+        returns (seq, offset) of the latest indexed entry of segment first_seq at or before seq, (first_seq, 0) if none
+        """
+        found = (first_seq, 0)
+        try:
+            with open(self.index_path(first_seq)) as index:
+                for line in index:
+                    if not line.endswith('\n'):  # Still being written
+                        break
+                    checkpoint_seq, offset = map(int, line.split())
+                    if checkpoint_seq > seq:
+                        break
+                    found = (checkpoint_seq, offset)
+        except FileNotFoundError:
+            pass
+        return found
+
+    def reset(self):
+        """
+        Forget the open segment, e.g. if the directory has been cleared when testing
+        """
+        if self.file:
+            self.file.close()
+        self.file = None
+        return
+
+    def _open(self):
+        os.makedirs(self.directory, 0o770, exist_ok=True)
+        segments = self.segments()
+        if segments:
+            with open(self.segment_path(segments[-1])) as segment:
+                self.segment_count = sum(1 for line in segment if line.endswith('\n'))
+            self.next_seq = segments[-1] + self.segment_count
+            self.segment_bytes = os.path.getsize(self.segment_path(segments[-1]))
+            if self.segment_count < self.segment_size:
+                self.file = open(self.segment_path(segments[-1]), 'a')
+                return
+        else:
+            self.next_seq = 1
+        self._new_segment()
+        return
+
+    def _new_segment(self):
+        if self.file:
+            self.file.close()
+        self.file = open(self.segment_path(self.next_seq), 'a')
+        self.segment_count = 0
+        self.segment_bytes = 0
+        # Drop segments that can only refer to expired data
+        oldest_allowed = time.time() - self.retention_seconds
+        for first_seq in self.segments()[:-1]:
+            if os.path.getmtime(self.segment_path(first_seq)) < oldest_allowed:
+                logger.info('removing change log segment {first_seq}', first_seq=first_seq)
+                os.remove(self.segment_path(first_seq))
+                try:
+                    os.remove(self.index_path(first_seq))
+                except FileNotFoundError:
+                    pass
+        return
+
+    def append(self, dict_name, key, floating_seconds_and_serial_number, update_token):
+        """
+        returns sequence number of the entry
+        """
+        if not self.file:
+            self._open()
+        elif self.segment_count >= self.segment_size:
+            self._new_segment()
+        seq = self.next_seq
+        line = json.dumps([dict_name, key, floating_seconds_and_serial_number[0], floating_seconds_and_serial_number[1], update_token]) + '\n'
+        self.file.write(line)
+        self.file.flush()  # Followers must see whole lines
+        if self.segment_count and not self.segment_count % self.index_interval:  # Indexed once written, as followers trust it
+            with open(self.index_path(seq - self.segment_count), 'a') as index:
+                index.write('%d %d\n' % (seq, self.segment_bytes))
+        self.next_seq += 1
+        self.segment_count += 1
+        self.segment_bytes += len(line)  # json.dumps only writes ASCII, so characters are bytes
+        return seq
+
+
+class ChangeLogFollower:
+    """
+    Reads new entries from a ChangeLog as they are appended, possibly by another process
+    """
+
+    def __init__(self, change_log):
+        self.change_log = change_log
+        self.segment = None  # first_seq of the segment being read
+        self.offset = 0  # bytes of that segment already read
+        self.next_seq = None
+        return
+
+    def start_at_end(self):
+        """
+        Only follow entries appended from now on
+        """
+        segments = self.change_log.segments()
+        if segments:
+            self.segment = segments[-1]
+            checkpoint_seq, checkpoint_offset = self.change_log.checkpoint(self.segment, float('inf'))
+            with open(self.change_log.segment_path(self.segment), 'rb') as segment:
+                segment.seek(checkpoint_offset)
+                data = segment.read()
+            self.offset = checkpoint_offset + data.rfind(b'\n') + 1  # Leave any partly written line to be read later
+            self.next_seq = checkpoint_seq + data[:self.offset - checkpoint_offset].count(b'\n')
+        return
+
+    def start_after(self, seq):
+        """
+        Follow entries after seq, if they have been pruned start at the oldest entry there is
+        """
+        segments = self.change_log.segments()
+        earlier_segments = [first_seq for first_seq in segments if first_seq <= seq + 1]
+        if not earlier_segments:
+            return  # read_new starts at the first segment
+        self.segment = earlier_segments[-1]
+        self.next_seq, self.offset = self.change_log.checkpoint(self.segment, seq + 1)
+        try:
+            with open(self.change_log.segment_path(self.segment), 'rb') as segment:
+                segment.seek(self.offset)
+                for line in segment:
+                    if (self.next_seq > seq) or not line.endswith(b'\n'):
+                        break
+                    self.offset += len(line)
+                    self.next_seq += 1
+        except FileNotFoundError:
+            self.segment = None
+        return
+
+    def read_new(self):
+        """
+        returns iter [(seq, [dict_name, key, floating_seconds, serial_number, update_token])] appended since last called
+        """
+        while True:
+            segments = self.change_log.segments()
+            if self.segment is None:
+                if not segments:
+                    return
+                self.segment, self.offset, self.next_seq = segments[0], 0, segments[0]
+            try:
+                with open(self.change_log.segment_path(self.segment), 'rb') as segment:
+                    segment.seek(self.offset)
+                    data = segment.read()
+            except FileNotFoundError:  # Directory cleared while testing, start again
+                self.segment = None
+                return
+            complete = data.rfind(b'\n') + 1
+            for line in data[:complete].splitlines():
+                yield self.next_seq, json.loads(line)
+                self.next_seq += 1
+            self.offset += complete
+            later_segments = [first_seq for first_seq in segments if first_seq > self.segment]
+            if complete != len(data) or not later_segments:
+                return
+            self.segment, self.offset, self.next_seq = later_segments[0], 0, later_segments[0]
+
+
+class SyncPageCache:
+    """
+    Holds the JSON encoded contact_ids and locations of recent /sync pages, so that many neighbors pulling the same
+    cursor cost one encode per page rather than one per neighbor.
+
+    pages: { (since, number_to_return, with_times): { now, latest_time, contact_ids, locations } }
+    A page with more_data (latest_time set) covers [since, latest_time) and only changes if a write lands in that range
+    or data expires, an open page (latest_time None) covers [since, now) and is dropped by any write.
+    A page is only the answer for a request whose now (lowered by until) is past the end of the range it covers.
+    """
+
+    def __init__(self, max_pages=100):
+        self.max_pages = max_pages
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+        # Incremented whenever an open page, or a page with more_data, may have been invalidated, encodes running in a
+        # thread check these didn't change since the page was computed before storing it
+        self.open_generation = 0
+        self.closed_generation = 0
+        # Latest latest_time of any page computed, writes before this might land inside a page with more_data
+        self.high_water = 0
+        return
+
+    def clear(self):
+        with self.lock:
+            self.pages.clear()
+            self.open_generation += 1
+            self.closed_generation += 1
+        return
+
+    def get(self, since, number_to_return, now, with_times=False):
+        """
+        returns response suitable for /sync built from an encoded page, or None if not cached
+        """
+        if not self.max_pages:
+            return None
+        with self.lock:
+            page = self.pages.get((since, number_to_return, with_times))
+            if not page:
+                return None
+            if page['latest_time'] is None:
+                if now < page['now']:  # Asked for less than the page has, or time went backwards in testing
+                    return None
+            elif now <= page['latest_time']:  # The item at latest_time, and maybe some before it, are not wanted
+                return None
+            self.pages.move_to_end((since, number_to_return, with_times))
+        logger.info('sync page cache hit for {since}', since=since)
+        return {
+            'since': iso_time_from_seconds_since_epoch(since),
+            'more_data': page['latest_time'] is not None,
+            'until': iso_time_from_seconds_since_epoch(page['latest_time'] or now),
+            'contact_ids': page['contact_ids'],
+            'locations': page['locations']
+        }
+
+    def encode_and_store(self, ret, since, number_to_return, now, with_times=False, timer=None):
+        """
+        Replace contact_ids and locations in a /sync response from _scan_or_sync with functions that also JSON encode
+        the data, once both are encoded the page is stored unless a write has invalidated it in the meantime
+        timer: RequestTimer to add the time encoding to
+        """
+        if not self.max_pages:
+            return ret
+        timer = timer or RequestTimer()
+        latest_time = unix_time_from_iso(ret['until']) if ret['more_data'] else None
+        with self.lock:
+            generation = (self.open_generation, self.closed_generation)
+            if latest_time is not None:
+                self.high_water = max(self.high_water, latest_time)
+        page = {'now': now, 'latest_time': latest_time}
+
+        def encoder(key, value):
+            def encode():
+                data = value() if callable(value) else value
+                with timer.phase('encode'):
+                    page[key] = EncodedJSON(json.dumps(data).encode())
+                if ('contact_ids' in page) and ('locations' in page):
+                    self._store((since, number_to_return, with_times), page, generation)
+                return page[key]
+            return encode
+
+        for key in ['contact_ids', 'locations']:
+            ret[key] = encoder(key, ret[key])
+        return ret
+
+    def _store(self, page_key, page, generation):
+        with self.lock:
+            index = 0 if page['latest_time'] is None else 1
+            if (self.open_generation, self.closed_generation)[index] != generation[index]:
+                logger.info('not caching sync page for {since} as data changed while encoding', since=page_key[0])
+                return
+            self.pages[page_key] = page
+            self.pages.move_to_end(page_key)
+            while len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+        return
+
+    def note_write(self, floating_seconds):
+        """
+        Drop pages that a write at floating_seconds lands in, that is all open pages and any others covering it
+        """
+        with self.lock:
+            self.open_generation += 1
+            if floating_seconds <= self.high_water:
+                self.closed_generation += 1
+            for page_key in [page_key for page_key, page in self.pages.items()
+                             if (page['latest_time'] is None) or (page_key[0] <= floating_seconds <= page['latest_time'])]:
+                del self.pages[page_key]
+        return
+
+    def note_expiry(self, until):
+        """
+        Drop pages that may contain data from before until, which is being expired
+        """
+        with self.lock:
+            self.open_generation += 1
+            self.closed_generation += 1
+            for page_key in [page_key for page_key in self.pages if page_key[0] < until]:
+                del self.pages[page_key]
+        return
+
 # contains both the code for the in memory and on disk version of the database
 # The in memory is a four deep hash table where the leaves of the hash are:
 #   list of dates (as integers for since compares) of when contact data# has come in.
@@ -586,11 +1733,18 @@ class UpdatesDict(SimpleFSBackedDict):
 # (accuracy is to minutes).  The date strings are 'YYYYMMDDHHmm'
 
 registry = {}
+# Routes that are also given the RequestTimer of the request, to time their phases
+timed_routes = set()
+
+# Expiry moves items to the deletion list this many at a time, checking its time budget in between
+expiry_chunk_size = 100
 
 
-def register_method(_func=None, *, route):
+def register_method(_func=None, *, route, timed=False):
     def decorator(func):
         registry[route] = func
+        if timed:
+            timed_routes.add(route)
 
         def wrapper(*args, **kwargs):
             return func(*args, **kwargs)
@@ -605,18 +1759,56 @@ def register_method(_func=None, *, route):
 
 class Contacts:
 
-    def __init__(self, config_top):
+    def __init__(self, config_top, read_only=False):
+        """
+        read_only is set in read worker processes, they never write to the directory and instead follow the change log
+        of the process that does
+        """
         config = config_top['DEFAULT']
         self.config = config
         self.directory_root = config['directory']
         self.testing = ('True' == config.get('testing', ''))
-        self.contact_dict = ContactDict(self.directory_root, retain_in_cache=config.getint('retain_in_cache', 120))
+        self.read_only = read_only
+        self.change_log = ChangeLog(self.directory_root, segment_size=config.getint('change_log_segment_size', 100000),
+                                    retention_seconds=config.getint('expire_data', 45) * 24 * 60 * 60,
+                                    index_interval=config.getint('change_log_index_interval', 1000))
+        self.change_log_follower = None
+        if read_only:
+            # Find the end of the log before loading, anything appended while loading is applied afterwards
+            self.change_log_follower = ChangeLogFollower(self.change_log)
+            self.change_log_follower.start_at_end()
+        # All three dicts share one compact index of update tokens, and the threads reading blobs in parallel
+        self.update_token_index = UpdateTokenIndex()
+        # DATA_DIRECTORIES stripes the dicts over several data roots, e.g. one per drive, DIRECTORY keeps the rest
+        self.volumes = [volume.strip() for volume in config.get('data_directories', '').split(',') if volume.strip()]
+        volumes_file_path = self._check_volumes()
+        read_threads = config.getint('disk_read_threads', 8)
+        self.read_pool = ThreadPoolExecutor(read_threads, thread_name_prefix='disk-read') if read_threads else None
+        self.dict_kwargs = {
+            'retain_in_cache': config.getint('retain_in_cache', 120),
+            'update_token_index': self.update_token_index,
+            'read_pool': self.read_pool,
+            'volumes': self.volumes or None,
+            'cold_block_size': config.getint('cold_block_size', 256),
+            'cold_compression': config.get('cold_compression', 'zlib'),
+            'change_log': None if read_only else self.change_log,
+            'read_only': read_only
+        }
+        self.contact_dict = ContactDict(self.directory_root, **self.dict_kwargs)
         self.bb_min_dp = config.getint('bounding_box_minimum_dp', 2)
-        self.spatial_dict = SpatialDict(self.directory_root, bb_min_dp=self.bb_min_dp, retain_in_cache=config.getint('retain_in_cache', 120))
+        self.spatial_dict = SpatialDict(self.directory_root, bb_min_dp=self.bb_min_dp, **self.dict_kwargs)
         self.bb_max_size = config.getfloat('bounding_box_maximum_size', 4)
         self.location_resolution = config.getint('location_resolution', 4)
-        self.unused_update_tokens = UpdatesDict(self.directory_root, retain_in_cache=config.getint('retain_in_cache', 120))
+        self.unused_update_tokens = UpdatesDict(self.directory_root, **self.dict_kwargs)
+        if not read_only:  # Every file was on the volume the list places it on
+            os.makedirs(self.directory_root, 0o770, exist_ok=True)
+            write_json_atomically(volumes_file_path, [os.path.normpath(volume) for volume in self.volumes])
+        # server.py adds the timing of its own startup phases
+        self.startup_statistics = {'dicts': {the_dict.name: the_dict.load_statistics for the_dict in
+                                             [self.contact_dict, self.spatial_dict, self.unused_update_tokens]}}
         self.max_missing_updates = config.getint('max_missing_updates', 10)
+        self.sync_page_cache = SyncPageCache(config.getint('sync_cache_pages', 100))
+        self.expiry_statistics = {'expired_count': 0, 'last_expired': None}
         # self.config_apps = config_top['APPS'] # Not used yet as not doing app versioning in config
         # See TODO-76 re saving statistics
         self.statistics = {}
@@ -624,10 +1816,32 @@ class Contacts:
             self.statistics[k] = 0
         return
 
-    def execute_route(self, name, *args):
-        return registry[name](self, *args)
+    def _check_volumes(self):
+        """
+        Files are placed on DATA_DIRECTORIES by a hash over the list, so it can't change without moving the files.
+        The list is recorded in DIRECTORY/.volumes once the data has loaded, and starting with a different one is refused
+        returns path of that file
+        """
+        file_path = '%s/.volumes' % self.directory_root
+        volumes = [os.path.normpath(volume) for volume in self.volumes]
+        try:
+            with open(file_path) as file:
+                recorded_volumes = json.load(file)
+        except FileNotFoundError:
+            return file_path
+        if recorded_volumes != volumes:
+            raise ValueError('DATA_DIRECTORIES is %s but the data was stored on %s, recorded in %s, move the files to match '
+                             'the new volumes and then remove it' % (volumes, recorded_volumes, file_path))
+        return file_path
+
+    def execute_route(self, name, data, args, timer=None):
+        if name in timed_routes:
+            return registry[name](self, data, args, timer=timer or RequestTimer())
+        return registry[name](self, data, args)
 
     def close(self):
+        if self.read_pool:
+            self.read_pool.shutdown(wait=False)
         return
 
     def _insert_blob_with_optional_replacement(self, table, blob, floating_seconds_and_serial_number):
@@ -672,6 +1886,7 @@ class Contacts:
             self._insert_blob_with_optional_replacement(self.spatial_dict, location, (floating_seconds, serial_number))
             # increase by two each time to deal with potential second insert
             serial_number += 2
+        self.sync_page_cache.note_write(floating_seconds)
         return serial_number
 
     def _update(self, update_token, updates, floating_time_and_serial_number):
@@ -704,9 +1919,7 @@ class Contacts:
             update_tokens = []
         consecutive_missed_updates = 0
         if length:
-            for i in range(length):
-                rt = get_replacement_token(replaces, i)
-                ut = get_update_token(rt)
+            for i, (rt, ut) in enumerate(get_replacement_and_update_tokens(replaces, length)):
                 updates = {
                     'replaces': rt,
                     'status': status,
@@ -721,16 +1934,21 @@ class Contacts:
                 else:
                     consecutive_missed_updates += 1
                     if consecutive_missed_updates <= max_missing_updates:
-                        logger.info("Holding update tokens for later {update_token}:{updates}", update_token=ut, updates=str(updates))
+                        logger.payload("Holding update tokens for later {update_token}:{updates}", update_token=ut, updates=updates)
                         self.unused_update_tokens.insert(ut, updates, new_floating_seconds_and_serial_number)
                 serial_number += 1
+            self.sync_page_cache.note_write(floating_seconds)
         return serial_number
 
     # scan_status post
-    @register_method(route='/status/scan')
-    def scan_status(self, data, args):
+    @register_method(route='/status/scan', timed=True)
+    def scan_status(self, data, args, timer):
         since_string = data.get('since')
         now = current_time()
+        # until is optional, the router (router.py) uses it so all shards return data up to the same time
+        until_string = data.get('until')
+        if until_string:
+            now = min(now, unix_time_from_iso(until_string))
         req_locations = data.get('locations', [])
         if not self.check_bounding_box(req_locations):
             return {
@@ -750,7 +1968,7 @@ class Contacts:
         bounding_boxes = map(lambda l: (l['min_lat'], l['min_long'], l['max_lat'], l['max_long']),
                              req_locations) if req_locations else None
         number_to_return = int(self.config.get('MAX_SCAN_COUNT', 50))
-        return self._scan_or_sync(prefixes, bounding_boxes, since, now, number_to_return)
+        return self._scan_or_sync(prefixes, bounding_boxes, since, now, number_to_return, timer, with_times=bool(data.get('with_times')))
 
     # status/result POST
     @register_method(route='/status/result')
@@ -781,46 +1999,55 @@ class Contacts:
         return {"status": "ok"}
 
     # POST status/data_points
-    @register_method(route='/status/data_points')
-    def status_data_points(self, data, args):
+    @register_method(route='/status/data_points', timed=True)
+    def status_data_points(self, data, args, timer):
         seed = data.get('seed')
         ret = {}
         locations = []
         contact_ids = []
         consecutive_missed_updates = 0
         i = 0
-        while consecutive_missed_updates < self.max_missing_updates:
-            update_token = get_update_token(get_replacement_token(seed, i))
-            file_path = self.spatial_dict.update_index.get(update_token)
-            if file_path:
-                locations.append(file_path)
-                consecutive_missed_updates = 0
-            else:
-                file_path = self.contact_dict.update_index.get(update_token)
-                if file_path:
-                    contact_ids.append(file_path)
-                    consecutive_missed_updates = 0
-                else:
-                    consecutive_missed_updates += 1
-            i += 1
+        # Work along the chain in batches of max_missing_updates, a whole batch of misses is enough to stop
+        with timer.phase('index'):
+            while consecutive_missed_updates < self.max_missing_updates:
+                update_tokens = get_update_token_ints(seed, self.max_missing_updates, i)
+                spatial_file_paths = self.spatial_dict.get_file_paths_from_update_tokens(update_tokens)
+                contact_file_paths = self.contact_dict.get_file_paths_from_update_tokens(update_tokens)
+                for spatial_file_path, contact_file_path in zip(spatial_file_paths, contact_file_paths):
+                    if spatial_file_path:
+                        locations.append(spatial_file_path)
+                        consecutive_missed_updates = 0
+                    elif contact_file_path:
+                        contact_ids.append(contact_file_path)
+                        consecutive_missed_updates = 0
+                    else:
+                        consecutive_missed_updates += 1
+                        if consecutive_missed_updates >= self.max_missing_updates:
+                            break
+                i += self.max_missing_updates
 
         # TODO-MITRA should use file-paths so dnt have to go back into data
         def get_location_id_data():
-            return list(self.spatial_dict.get_blob_from_file_paths(locations))
+            with timer.phase('blob_read'):
+                return [blob for blob in self.spatial_dict.get_blob_from_file_paths(locations) if blob is not None]
         ret['locations'] = get_location_id_data
 
         def get_contact_id_data():
-            return list(self.contact_dict.get_blob_from_file_paths(contact_ids))
+            with timer.phase('blob_read'):
+                return [blob for blob in self.contact_dict.get_blob_from_file_paths(contact_ids) if blob is not None]
         ret['contact_ids'] = get_contact_id_data
         return ret
 
     # sync get
-    @register_method(route='/sync')
-    def sync(self, data, args):
+    @register_method(route='/sync', timed=True)
+    def sync(self, data, args, timer):
         # Note that any replaced items will be sent as new items, so there is no need for a separate list of update_tokens.
         # Do this at the start of the process, we want to guarantee have all before this time (even if multi-threading)
         now = current_time()
         since_string = args.get('since')
+        until_string = args.get('until')  # Optional, as for scan_status
+        if until_string:
+            now = min(now, unix_time_from_iso(until_string[0].decode()))
 
         earliest_allowed = self.config.getint('DAYS_OLDEST_DATA_SENT', 21) * 24 * 60 * 60
 
@@ -828,86 +2055,105 @@ class Contacts:
         # the decode is to turn it into a string
         since = max(unix_time_from_iso(since_string[0].decode()) if since_string else 1, earliest_allowed)
         number_to_return = int(self.config.get('MAX_SYNC_COUNT', 1000))
-        return self._scan_or_sync(None, None, since, now, number_to_return)
+        with_times = b'true' == args.get('with_times', [b''])[0].lower()  # Optional, as for scan_status
+        # Neighbors often ask for the same cursor, so reuse an encoded page if no write has landed in its range
+        ret = self.sync_page_cache.get(since, number_to_return, now, with_times)
+        if ret is None:
+            ret = self.sync_page_cache.encode_and_store(self._scan_or_sync(None, None, since, now, number_to_return, timer, with_times),
+                                                        since, number_to_return, now, with_times, timer)
+        return ret
 
-    def _sort_and_truncate(self, number_to_return, contacts, locations):
+    # changes get
+    @register_method(route='/changes')
+    def changes(self, data, args):
         """
-        contacts [(floating_seconds, serial)]
-        locations [(floating_seconds, serial)
-        returns [ contacts, locations ] with max length items
+        Entries of the change log after sequence number 'after', in order, so replicas and neighbors can follow inserts
+        and resume exactly where they left off.
+        Entries that have been pruned are skipped, so a first seq greater than after + 1 means the caller has missed some,
+        and entries whose data has since expired are returned without data.
+        returns { after, last, more_data, changes: [{ seq, dict, key, floating_seconds, serial_number, data }] }
         """
-        if len(contacts) + len(locations) <= number_to_return:
-            return contacts, locations, None
-        else:
-            data = []
-            data.extend(map(lambda floating_seconds_and_serial: (floating_seconds_and_serial, self.contact_dict), contacts))
-            data.extend(map(lambda floating_seconds_and_serial: (floating_seconds_and_serial, self.spatial_dict), locations))
-
-            # create a dict index by either contact_dict or spatial_dict
-            lists_to_return = {self.contact_dict: [],  # file_paths
-                               self.spatial_dict: []}  # file_paths
-            data.sort(key=lambda k: k[0])
-            truncated_data = data[0:number_to_return]
-
-            for datum in truncated_data:
-                lists_to_return[datum[1]].append(datum[0])
-
-            contacts = lists_to_return[self.contact_dict]   # [(floating_seconds, serial_number)
-            locations = lists_to_return[self.spatial_dict]  # [(floating_seconds, serial_number)
-            latest_time = data[number_to_return][0][0]
-            return contacts, locations, latest_time
+        after_string = args.get('after')
+        after = int(after_string[0].decode()) if after_string else 0
+        number_to_return = self.config.getint('MAX_CHANGES_COUNT', 1000)
+        follower = ChangeLogFollower(self.change_log)
+        follower.start_after(after)
+        entries = list(islice(follower.read_new(), number_to_return + 1))
+        more_data = len(entries) > number_to_return
+        entries = entries[:number_to_return]
+        the_dicts = {the_dict.name: the_dict for the_dict in [self.contact_dict, self.spatial_dict, self.unused_update_tokens]}
+
+        def get_changes():
+            ret = []
+            for seq, (dict_name, key, floating_seconds, serial_number, update_token) in entries:
+                the_dict = the_dicts[dict_name]
+                file_path = the_dict.time_and_serial_number_to_file_path_map.get((floating_seconds, serial_number))
+                ret.append({'seq': seq, 'dict': dict_name, 'key': key, 'floating_seconds': floating_seconds,
+                            'serial_number': serial_number, 'data': the_dict.get_blob_from_file_path(file_path) if file_path else None})
+            return ret
+        return {
+            'after': after,
+            'last': entries[-1][0] if entries else after,
+            'more_data': more_data,
+            'changes': get_changes
+        }
 
-    def _split_bounding_boxes(self, bounding_boxes):
+    def _sort_and_truncate(self, number_to_return, contacts, locations):
         """
-        Split a bounding_box into an array of bounding boxes each BOUNDING_BOX_MINIMUM_DP size (2DP)
-        Adjust parameters to be integers
-        bounding_box: (minLat, minLong, maxLat, maxLong)
-        Edge case at -180° latitude, and also if minLong > maxLong (e.g. because use 17900->-17900 as 2° of latitude, not 358°
+        contacts iter [(floating_seconds, serial)] in time order
+        locations iter [(floating_seconds, serial)] in time order
+        returns [ contacts, locations ] with max length items, and floating_seconds of the next item if truncated
+        The two are merged lazily, so no more than number_to_return + 1 items are looked at
         """
-        if bounding_boxes is None:
-            return None
-        bboxs = []
-        for bounding_box in bounding_boxes:
-            bb1 = [int(x * 10 ** self.bb_min_dp) for x in bounding_box]  # Turn into integers at desired resolution of bbox
-            if bb1[3] < bb1[1]:  # Swap if have min and max lat around other way (check for 180° edge case below)
-                s = bb1[3]
-                bb1[3] = bb1[1]
-                bb1[1] = s
-            if (bb1[3]-bb1[1]) > (180 * 10 ** self.bb_min_dp):  # Handle bounding boxes around the 180° date-line
-                bboxs.extend([(lat, long) for lat in range(bb1[0], bb1[2]) for long in range(-180 * 10 ** self.bb_min_dp, bb1[1])])
-                bboxs.extend([(lat, long) for lat in range(bb1[0], bb1[2]) for long in range(bb1[3], 180 * 10 ** self.bb_min_dp)])
-            else:
-                bboxs.extend([(lat, long) for lat in range(bb1[0], bb1[2]) for long in range(bb1[1], bb1[3])])  # [(int lat*10^2, int long*10^2)]
-        return bboxs
+        # create a dict index by either contact_dict or spatial_dict
+        lists_to_return = {self.contact_dict: [],  # [(floating_seconds, serial_number)
+                           self.spatial_dict: []}  # [(floating_seconds, serial_number)
+        data = heapq.merge(
+            map(lambda floating_seconds_and_serial: (floating_seconds_and_serial, self.contact_dict), contacts),
+            map(lambda floating_seconds_and_serial: (floating_seconds_and_serial, self.spatial_dict), locations),
+            key=lambda k: k[0])
+        latest_time = None
+        for count, datum in enumerate(data):
+            if count == number_to_return:
+                latest_time = datum[0][0]
+                break
+            lists_to_return[datum[1]].append(datum[0])
+        return lists_to_return[self.contact_dict], lists_to_return[self.spatial_dict], latest_time
 
-    def _scan_or_sync(self, prefixes, bounding_boxes, since, now, maximum_results):
+    def _split_bounding_boxes(self, bounding_boxes):
+        return split_bounding_boxes(bounding_boxes, self.bb_min_dp)
+
+    def _scan_or_sync(self, prefixes, bounding_boxes, since, now, maximum_results, timer, with_times=False):
         """
         Common part of /status/sync and /sync
         returns data structure suitable for Response { contact_ids, locations, since, until, more_data }
         Data contains at most maximum_results oldest data
         If there is too much data, then more_data=True, and until is the floating_seconds of the next item to return
+        with_times returns each item as [floating_seconds, serial_number, data], so the router can merge shards in time order
+        timer: RequestTimer to add the time finding the items in the index, and reading them, to
         Note there might be an issue if there are two items with the same floating_seconds (different serial numbers) but we dedupe on arrival anyway
         """
-        bboxs = self._split_bounding_boxes(bounding_boxes)
-        # First figure out the max possible "until" time
-        contacts_max_until = self.contact_dict.max_until(since, now, maximum_results)
-        locations_max_until = self.spatial_dict.max_until(since, now, maximum_results)
-        max_until = min(contacts_max_until, locations_max_until)
-        # Generate full lists, either filtered by prefixes & bounding boxes or the complete set - can use max_until to make sure no more than 2x total results
-        contacts_full = list(self.contact_dict.map_over_prefixes(prefixes, since, now)) \
-            if prefixes is not None else \
-            self.contact_dict.sorted_list_by_time_and_serial_number_range(since, max_until, maximum_results)
-        locations_full = self.spatial_dict.list_over_bounding_boxes(bboxs, since, now) \
-            if bounding_boxes is not None else \
-            self.spatial_dict.sorted_list_by_time_and_serial_number_range(since, max_until, maximum_results)
-
-        contacts_floating_seconds_and_serial, locations_floating_seconds_and_serial, latest_time = \
-            self._sort_and_truncate(maximum_results, contacts_full, locations_full)
-
-        contacts_file_path = [self.contact_dict.time_and_serial_number_to_file_path_map[floating_seconds_and_serial]
-                              for floating_seconds_and_serial in contacts_floating_seconds_and_serial]
-        locations_file_path = [self.spatial_dict.time_and_serial_number_to_file_path_map[floating_seconds_and_serial]
-                               for floating_seconds_and_serial in locations_floating_seconds_and_serial]
+        with timer.phase('index'):
+            bboxs = self._split_bounding_boxes(bounding_boxes)
+            # First figure out the max possible "until" time
+            contacts_max_until = self.contact_dict.max_until(since, now, maximum_results)
+            locations_max_until = self.spatial_dict.max_until(since, now, maximum_results)
+            max_until = min(contacts_max_until, locations_max_until)
+            # Generate time ordered iterators, either filtered by prefixes & bounding boxes or the complete set - can use max_until to make sure no more than 2x total results
+            contacts_full = self.contact_dict.map_over_prefixes(prefixes, since, now) \
+                if prefixes is not None else \
+                self.contact_dict.sorted_list_by_time_and_serial_number_range(since, max_until, maximum_results)
+            locations_full = self.spatial_dict.map_over_bounding_boxes(bboxs, since, now) \
+                if bounding_boxes is not None else \
+                self.spatial_dict.sorted_list_by_time_and_serial_number_range(since, max_until, maximum_results)
+
+            contacts_floating_seconds_and_serial, locations_floating_seconds_and_serial, latest_time = \
+                self._sort_and_truncate(maximum_results, contacts_full, locations_full)
+
+            contacts_file_path = [self.contact_dict.time_and_serial_number_to_file_path_map[floating_seconds_and_serial]
+                                  for floating_seconds_and_serial in contacts_floating_seconds_and_serial]
+            locations_file_path = [self.spatial_dict.time_and_serial_number_to_file_path_map[floating_seconds_and_serial]
+                                   for floating_seconds_and_serial in locations_floating_seconds_and_serial]
 
         ret = {
             'since': iso_time_from_seconds_since_epoch(since),
@@ -917,20 +2163,32 @@ class Contacts:
 
         if 0 != len(contacts_file_path):
             def get_contact_id_data():
-                return list(self.contact_dict.get_blob_from_file_paths(contacts_file_path))
+                return self._blobs_with_optional_times(self.contact_dict, contacts_file_path, contacts_floating_seconds_and_serial,
+                                                       timer, with_times)
 
             ret['contact_ids'] = get_contact_id_data
         else:
             ret['contact_ids'] = []
         if 0 != len(locations_file_path):
             def get_location_id_data():
-                return list(self.spatial_dict.get_blob_from_file_paths(locations_file_path))
+                return self._blobs_with_optional_times(self.spatial_dict, locations_file_path, locations_floating_seconds_and_serial,
+                                                       timer, with_times)
 
             ret['locations'] = get_location_id_data
         else:
             ret['locations'] = []
         return ret
 
+    @staticmethod
+    def _blobs_with_optional_times(the_dict, file_paths, floating_seconds_and_serials, timer, with_times):
+        # Items deleted since the scan read as None and are left out
+        with timer.phase('blob_read'):
+            blobs = the_dict.get_blob_from_file_paths(file_paths)
+        if with_times:
+            return [[floating_seconds, serial_number, blob]
+                    for (floating_seconds, serial_number), blob in zip(floating_seconds_and_serials, blobs) if blob is not None]
+        return [blob for blob in blobs if blob is not None]
+
     # admin_config get
     @register_method(route='/admin/config')
     def admin_config(self, data, args):
@@ -948,6 +2206,12 @@ class Contacts:
             'contacts_count': len(self.contact_dict),
             'unused_updates_count': len(self.unused_update_tokens)
         }
+        until = self._expire_until()
+        the_dicts = [self.contact_dict, self.spatial_dict, self.unused_update_tokens]
+        ret['expiry_backlog'] = sum(the_dict.count_before(until) for the_dict in the_dicts)
+        ret['expiry_pending_deletion'] = self.deletion_list_length()
+        ret.update(self.expiry_statistics)
+        ret['startup'] = self.startup_statistics
         return ret
 
     # POST /init
@@ -970,8 +2234,10 @@ class Contacts:
     def reset(self):
         if self.testing:
             logger.info('resetting ids')
-            self.spatial_dict = SpatialDict(self.directory_root)
-            self.contact_dict = ContactDict(self.directory_root)
+            self.change_log.reset()
+            self.spatial_dict = SpatialDict(self.directory_root, bb_min_dp=self.bb_min_dp, **self.dict_kwargs)
+            self.contact_dict = ContactDict(self.directory_root, **self.dict_kwargs)
+            self.sync_page_cache.clear()
         return
 
     def check_bounding_box(self, bb_arr):
@@ -985,12 +2251,105 @@ class Contacts:
                 return False
         return True
 
-    def move_expired_data_to_deletion_list(self):
-        until = current_time() - self.config.getint('expire_data', 45) * 24 * 60 * 60
+    def _expire_until(self):
+        return current_time() - self.config.getint('expire_data', 45) * 24 * 60 * 60
+
+    def move_expired_data_to_deletion_list(self, maximum_items=None, maximum_seconds=None):
+        """
+        Move expired data to the deletion lists, in a slice of at most maximum_items or maximum_seconds (None for no limit)
+        so it can be called often from the reactor without stalling requests
+        returns number of items moved
+        """
+        until = self._expire_until()
+        start_time = time.time()
+        moved = 0
+        for the_dict in [self.contact_dict, self.spatial_dict, self.unused_update_tokens]:
+            while (maximum_items is None) or (moved < maximum_items):
+                chunk_size = expiry_chunk_size if maximum_items is None else min(expiry_chunk_size, maximum_items - moved)
+                chunk_moved = the_dict.move_expired_data_to_deletion_list(0, until, chunk_size)
+                moved += chunk_moved
+                if chunk_moved < chunk_size:
+                    break  # Nothing more to expire in this dict
+                if maximum_seconds and (time.time() - start_time) >= maximum_seconds:
+                    break
+            if maximum_seconds and (time.time() - start_time) >= maximum_seconds:
+                break
+        if moved:
+            self.sync_page_cache.note_expiry(until)
+            self.expiry_statistics['expired_count'] += moved
+            self.expiry_statistics['last_expired'] = iso_time_from_seconds_since_epoch(current_time())
+        return moved
+
+    def apply_changes(self):
+        """
+        In a read_only process, apply inserts made by the writing process since last called, and drop items that reads
+        found it had deleted
+        returns number of items applied
+        """
+        applied = 0
+        the_dicts = {the_dict.name: the_dict for the_dict in [self.contact_dict, self.spatial_dict, self.unused_update_tokens]}
+        for the_dict in the_dicts.values():
+            for floating_seconds, serial_number in the_dict.forget_missing():
+                self.sync_page_cache.note_write(floating_seconds)
+        for seq, (dict_name, key, floating_seconds, serial_number, update_token) in self.change_log_follower.read_new():
+            if the_dicts[dict_name].apply_change(key, (floating_seconds, serial_number), update_token):
+                self.sync_page_cache.note_write(floating_seconds)
+                applied += 1
+        return applied
+
+    def apply_replicated_changes(self, changes):
+        """
+        In a replica, insert the entries of the primary's /changes directly into the dicts, the primary has already
+        done any update token replacement so that is not repeated
+        returns number of items inserted
+        """
+        applied = 0
+        the_dicts = {the_dict.name: the_dict for the_dict in [self.contact_dict, self.spatial_dict, self.unused_update_tokens]}
+        for change in changes:
+            the_dict = the_dicts[change['dict']]
+            floating_seconds_and_serial_number = (change['floating_seconds'], change['serial_number'])
+            if change['data'] is None:
+                continue  # Expired on the primary before we got to it
+            if floating_seconds_and_serial_number in the_dict.time_and_serial_number_to_file_path_map:
+                continue  # Already applied, e.g. before a restart
+            the_dict.insert(change['key'], change['data'], floating_seconds_and_serial_number)
+            self.sync_page_cache.note_write(change['floating_seconds'])
+            applied += 1
+        return applied
+
+    def metrics_gauges(self):
+        """
+        returns iter [(name, labels, value)] of the sizes of the in memory indexes, for /admin/metrics
+        """
         for the_dict in [self.contact_dict, self.spatial_dict, self.unused_update_tokens]:
-            the_dict.move_expired_data_to_deletion_list(0, until)
+            yield 'bct_index_items', (('dict', the_dict.name),), len(the_dict)
+            yield 'bct_blob_cache_items', (('dict', the_dict.name),), len(the_dict.disk_cache)
+            yield 'bct_pending_deletions', (('dict', the_dict.name),), len(the_dict.file_paths_to_delete)
+            yield 'bct_cold_segments', (('dict', the_dict.name),), len(the_dict.cold_store)
+        yield 'bct_update_token_index_size', (), len(self.update_token_index)
+        yield 'bct_sync_cache_pages', (), len(self.sync_page_cache.pages)
         return
 
+    def select_cold_data(self, maximum_items=None):
+        """
+        Choose data older than COLD_AFTER minutes to move into cold segments, at most maximum_items from each dict
+        returns [(dict, [file_path])] for compact_cold_data, which is run in a thread
+        """
+        until = current_time() - self.config.getfloat('cold_after', 0) * 60
+        selections = [(the_dict, the_dict.select_cold(until, maximum_items))
+                      for the_dict in [self.contact_dict, self.spatial_dict, self.unused_update_tokens]]
+        return [(the_dict, file_paths) for the_dict, file_paths in selections if file_paths]
+
+    @staticmethod
+    def compact_cold_data(selections):
+        """
+        returns number of items moved into cold segments
+        """
+        return sum(the_dict.compact_cold(file_paths) for the_dict, file_paths in selections)
+
+    def deletion_list_length(self):
+        return sum(len(the_dict.file_paths_to_delete) for the_dict in [self.contact_dict, self.spatial_dict, self.unused_update_tokens])
+
     def delete_from_deletion_list(self):
         for the_dict in [self.contact_dict, self.spatial_dict, self.unused_update_tokens]:
             the_dict.delete_from_deletion_list()
@@ -0,0 +1,141 @@
+import argparse
+import json
+import math
+import os
+import random
+import time
+from multiprocessing import Pool
+
+from contacts import FSBackedThreeLevelDict, spatial_key_from_lat_long
+from lib import get_replacement_and_update_tokens, new_seed
+
+# Writes a synthetic data directory in the format ContactDict, SpatialDict and UpdatesDict load from, without going
+# through a server, so startup, expiry and storage can be tried at production scale.
+#
+# python generate_data.py --directory /data/bct --sends 10000000 --processes 16 --hotspots 50
+#
+# The data is a series of /status/send calls spread evenly over the last EXPIRE_DATA days, each with a few contacts and
+# locations sharing its time, with consecutive serial numbers, as send_or_sync stores them.
+# A fraction of the sends carry update tokens from a seed's chain (the rest have none), and a fraction of those chains
+# also have updates held in updates_dict for tokens further along the chain, as if the update arrived before the data.
+# Nothing is written to the change log, as if the data had been there before it.
+
+parser = argparse.ArgumentParser(description='Write a synthetic bct data directory.')
+parser.add_argument('--directory', required=True, help='data directory to write to, as DIRECTORY in the server config')
+parser.add_argument('--sends', type=int, default=100000, help='number of /status/send calls to simulate')
+parser.add_argument('--contacts_per_send', type=float, default=5, help='average contacts in each send')
+parser.add_argument('--locations_per_send', type=float, default=5, help='average locations in each send')
+parser.add_argument('--expire_data', type=float, default=45, help='days the data is spread over, as EXPIRE_DATA')
+parser.add_argument('--now', type=float, help='time of the newest data, seconds since the epoch, default now')
+parser.add_argument('--hot_prefixes', type=int, default=0, help='number of two hex digit contact id prefixes that are hot')
+parser.add_argument('--hot_prefix_fraction', type=float, default=0.5, help='fraction of contact ids with a hot prefix')
+parser.add_argument('--hotspots', type=int, default=20, help='number of geographic hot spots')
+parser.add_argument('--hotspot_fraction', type=float, default=0.8, help='fraction of locations near a hot spot')
+parser.add_argument('--hotspot_radius', type=float, default=0.05, help='standard deviation in degrees of locations around a hot spot')
+parser.add_argument('--chain_fraction', type=float, default=0.9, help='fraction of sends with update tokens from a seed chain')
+parser.add_argument('--held_update_fraction', type=float, default=0.1, help='fraction of chains with updates held in updates_dict')
+parser.add_argument('--held_updates', type=int, default=5, help='number of held updates for each of those chains')
+parser.add_argument('--bounding_box_minimum_dp', type=int, default=2, help='as BOUNDING_BOX_MINIMUM_DP in the server config')
+parser.add_argument('--location_resolution', type=int, default=4, help='as LOCATION_RESOLUTION in the server config')
+parser.add_argument('--processes', type=int, default=os.cpu_count(), help='number of processes writing in parallel')
+parser.add_argument('--chunk_size', type=int, default=10000, help='sends written by a process at a time')
+parser.add_argument('--seed', type=int, default=1, help='random seed, the same seed gives the same directory')
+
+
+def write_blob(directory, key, floating_seconds_and_serial_number, blob):
+    key = key.upper()
+    dir_name = '%s/%s' % (directory, FSBackedThreeLevelDict.get_directory_name_from_key(key))
+    os.makedirs(dir_name, 0o770, exist_ok=True)
+    with open('%s/%s' % (dir_name, FSBackedThreeLevelDict._get_file_name_from_parts(key, floating_seconds_and_serial_number)), 'w') as file:
+        json.dump(blob, file)
+    return
+
+
+def random_contact_id(rng, hot_prefixes, args):
+    contact_id = '%032X' % rng.randrange(0, 2 ** 128)
+    if hot_prefixes and (rng.random() < args.hot_prefix_fraction):
+        contact_id = rng.choice(hot_prefixes) + contact_id[2:]
+    return contact_id
+
+
+def random_location(rng, hotspots, args):
+    if hotspots and (rng.random() < args.hotspot_fraction):
+        lat, long = rng.choice(hotspots)
+        lat = max(-89.9999, min(89.9999, rng.gauss(lat, args.hotspot_radius)))
+        long = (rng.gauss(long, args.hotspot_radius) + 180) % 360 - 180
+    else:
+        lat = math.degrees(math.asin(rng.uniform(-1, 1)))  # Uniform over the surface, not bunched at the poles
+        long = rng.uniform(-180, 180)
+    return round(lat, args.location_resolution), round(long, args.location_resolution)
+
+
+def write_chunk(job):
+    """
+    Write sends first .. first + count - 1, returns (contacts, locations, held updates) written
+    """
+    args, first, count, hot_prefixes, hotspots = job
+    rng = random.Random('%s:%s' % (args.seed, first))
+    now = args.now
+    span = args.expire_data * 24 * 60 * 60
+    slot = span / args.sends  # Each send gets its own slot of time, so no two share a time
+    counts = [0, 0, 0]
+    for send in range(first, first + count):
+        # Rounded to the microseconds kept in file names, so a load gives back exactly the same times
+        floating_seconds = round(now - span + (send + rng.random() * 0.999) * slot, 6)
+        n_contacts = rng.randint(0, int(2 * args.contacts_per_send))
+        n_locations = rng.randint(0 if n_contacts else 1, max(1, int(2 * args.locations_per_send)))
+        tokens = None
+        if rng.random() < args.chain_fraction:
+            # Seed from rng, rather than new_seed's use of random, so the directory is reproducible
+            seed = new_seed('%032X' % rng.randrange(0, 2 ** 128))
+            held = args.held_updates if rng.random() < args.held_update_fraction else 0
+            tokens = get_replacement_and_update_tokens(seed, n_contacts + n_locations + held)
+        status = rng.choice([1, 2])
+        serial_number = 0
+        for i in range(n_contacts):
+            blob = {'id': random_contact_id(rng, hot_prefixes, args), 'status': status, 'duration': 15}
+            if tokens:
+                blob['update_token'] = tokens[serial_number][1]
+            write_blob(args.directory + '/contact_dict', blob['id'], (floating_seconds, serial_number), blob)
+            serial_number += 1
+        for i in range(n_locations):
+            lat, long = random_location(rng, hotspots, args)
+            blob = {'lat': lat, 'long': long, 'status': status}
+            if tokens:
+                blob['update_token'] = tokens[serial_number][1]
+            key = spatial_key_from_lat_long((lat, long), args.bounding_box_minimum_dp)
+            write_blob(args.directory + '/spatial_dict', key, (floating_seconds, serial_number), blob)
+            serial_number += 1
+        counts[0] += n_contacts
+        counts[1] += n_locations
+        if tokens:
+            for replacement_token, update_token in tokens[serial_number:]:
+                updates = {'replaces': replacement_token, 'status': 1, 'update_token': '%016X' % rng.randrange(0, 2 ** 64),
+                           'message': None}
+                write_blob(args.directory + '/updates_dict', update_token, (floating_seconds, serial_number), updates)
+                serial_number += 1
+                counts[2] += 1
+    return counts
+
+
+def main():
+    args = parser.parse_args()
+    if args.now is None:
+        args.now = time.time()
+    rng = random.Random(args.seed)
+    hot_prefixes = ['%02X' % prefix for prefix in rng.sample(range(256), min(256, args.hot_prefixes))]
+    hotspots = [(rng.uniform(-60, 70), rng.uniform(-180, 180)) for i in range(args.hotspots)]
+    jobs = [(args, first, min(args.chunk_size, args.sends - first), hot_prefixes, hotspots)
+            for first in range(0, args.sends, args.chunk_size)]
+    totals = [0, 0, 0]
+    start_time = time.time()
+    with Pool(args.processes) as pool:
+        for i, counts in enumerate(pool.imap_unordered(write_chunk, jobs)):
+            totals = [total + count for total, count in zip(totals, counts)]
+            print('%d/%d chunks, %d contacts, %d locations, %d held updates, %.0f seconds' % (
+                i + 1, len(jobs), totals[0], totals[1], totals[2], time.time() - start_time))
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,14 @@
 # the module contains the client and server process to manage ids
 
 import hashlib
+import os
 import string
 import random
 import time
 import logging
 import datetime
+import json
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -61,6 +64,39 @@ def get_update_token(rt):
     return fold_hash(hash_seed(rt))
 
 
+# Batch version of get_replacement_token and get_update_token for n = start .. start + length - 1
+# The hash of the seed is only calculated once, and the fold is done on the digest rather than re-parsing hex strings
+# returns [(replacement_token, update_token)]
+def get_replacement_and_update_tokens(seed, length, start=0):
+    seed_hash = hashlib.sha1(seed.encode())
+    tokens = []
+    for n in range(start, start + length):
+        replacement_hash = seed_hash.copy()
+        replacement_hash.update(str(n).encode())
+        rt = replacement_hash.hexdigest().upper()
+        digest = hashlib.sha1(rt.encode()).digest()
+        tokens.append((rt, "%X" % (int.from_bytes(digest[:10], 'big') ^ int.from_bytes(digest[10:], 'big'))))
+    return tokens
+
+
+# Batch version of int(get_update_token(get_replacement_token(seed, n)), 16), the form the update token index keeps
+# tokens in, so looking up a chain needs no hex strings formatting and parsing again
+def get_update_token_ints(seed, length, start=0):
+    seed_hash = hashlib.sha1(seed.encode())
+    token_ints = []
+    for n in range(start, start + length):
+        replacement_hash = seed_hash.copy()
+        replacement_hash.update(str(n).encode())
+        digest = hashlib.sha1(replacement_hash.hexdigest().upper().encode()).digest()
+        token_ints.append(int.from_bytes(digest[:10], 'big') ^ int.from_bytes(digest[10:], 'big'))
+    return token_ints
+
+
+# Batch version of get_update_token(get_replacement_token(seed, n))
+def get_update_tokens(seed, length, start=0):
+    return ['%X' % token_int for token_int in get_update_token_ints(seed, length, start)]
+
+
 # Check that the rt is a correct rt for the ut.
 def confirm_update_token(ut, rt):
     return get_update_token(rt) == ut
@@ -108,3 +144,28 @@ def flatten(list_of_iterators):
         yield from it
     return
 
+
+class EncodedJSON(bytes):
+    """ A value that has already been JSON encoded, dumps_response splices it into a response without encoding it again """
+    pass
+
+
+def write_json_atomically(file_path, value):
+    """
+    Write value as JSON to a temporary file and rename it to file_path, so a reader sees all of the file or none of it
+    The temporary file ends .tmp, so is never taken for a .data file
+    """
+    temp_file_path = '%s.%d-%d.tmp' % (file_path, os.getpid(), threading.get_ident())
+    with open(temp_file_path, 'w') as file:
+        json.dump(value, file)
+    os.replace(temp_file_path, file_path)
+    return
+
+
+def dumps_response(ret):
+    """ JSON encode a response dictionary as bytes, copying any EncodedJSON values straight into the output """
+    if isinstance(ret, dict) and any(isinstance(value, EncodedJSON) for value in ret.values()):
+        return b'{' + b', '.join(
+            json.dumps(key).encode() + b': ' + (value if isinstance(value, EncodedJSON) else json.dumps(value).encode())
+            for key, value in ret.items()) + b'}'
+    return json.dumps(ret).encode()
@@ -0,0 +1,85 @@
+import threading
+from collections import deque
+
+from twisted.logger import Logger, LogLevel
+from twisted.python.logfile import LogFile
+
+# Cheap logging for the hot paths:
+# LevelLogger drops events below the level set with set_log_level before any event is built, rather than leaving it to
+# the FilteringLogObserver, and only logs bulky payloads (request bodies, results, blobs) with payload() when
+# set_log_payloads(True), BatchedLogFile writes the access log in batches from a background thread to a rotating file.
+
+_priorities = {level: priority for priority, level in enumerate(LogLevel.iterconstants())}
+_settings = {'minimum_priority': 0, 'payloads': False}  # Everything is emitted until set_log_level is called
+
+
+def set_log_level(level_name):
+    _settings['minimum_priority'] = _priorities[LogLevel.levelWithName(level_name.lower())]
+    return
+
+
+def set_log_payloads(payloads):
+    _settings['payloads'] = payloads
+    return
+
+
+def log_level_enabled(level):
+    return _priorities[level] >= _settings['minimum_priority']
+
+
+class LevelLogger(Logger):
+
+    def emit(self, level, format=None, **kwargs):
+        if _priorities.get(level, 0) < _settings['minimum_priority']:
+            return
+        super().emit(level, format, **kwargs)
+        return
+
+    def payload(self, format, **kwargs):
+        """
+        Log at info level, only if payload logging is on, for events carrying whole bodies or results
+        """
+        if _settings['payloads']:
+            self.emit(LogLevel.info, format, **kwargs)
+        return
+
+
+class BatchedLogFile:
+    """
+    File like object for the HTTP access log, write only queues the line, a background thread writes them out every
+    flush_seconds to path, which is rotated at rotate_length bytes keeping max_rotated_files old files
+    """
+
+    def __init__(self, path, flush_seconds=1.0, rotate_length=10000000, max_rotated_files=10):
+        self.log_file = LogFile.fromFullPath(path, rotateLength=rotate_length, maxRotatedFiles=max_rotated_files)
+        self.flush_seconds = flush_seconds
+        self.lines = deque()  # Appends and pops from either end are thread safe
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='access-log', daemon=True)
+        self.thread.start()
+        return
+
+    def write(self, line):
+        self.lines.append(line)
+        return
+
+    def _flush(self):
+        batch = []
+        while self.lines:
+            batch.append(self.lines.popleft())
+        if batch:
+            self.log_file.write(''.join(batch))
+            self.log_file.flush()
+        return
+
+    def _run(self):
+        while not self.stopping.wait(self.flush_seconds):
+            self._flush()
+        self._flush()
+        return
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
+        self.log_file.close()
+        return
@@ -0,0 +1,149 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Counters and histograms for /admin/metrics, in the Prometheus text format.
+# They are updated on every request so are kept cheap: each thread adds to its own copy without locking, and the
+# copies are only added together when the metrics are read.
+
+# Upper bounds, in seconds, of the latency histogram buckets
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics:
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        self.local = threading.local()
+        self.lock = threading.Lock()  # Only taken when a thread first records something, and when reading
+        self.per_thread = []  # [(counters, histograms)] one per thread that has recorded something
+        self.help = {}  # { name: (type, help text) }
+        return
+
+    def _thread_data(self):
+        try:
+            return self.local.data
+        except AttributeError:
+            self.local.data = ({}, {})
+            with self.lock:
+                self.per_thread.append(self.local.data)
+            return self.local.data
+
+    def describe(self, name, metric_type, help_text):
+        self.help[name] = (metric_type, help_text)
+        return
+
+    def inc(self, name, labels=(), amount=1):
+        """
+        labels: ((label_name, value),)
+        """
+        counters = self._thread_data()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + amount
+        return
+
+    def observe(self, name, value, labels=()):
+        histograms = self._thread_data()[1]
+        key = (name, labels)
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(self.buckets) + 2)  # a count for each bucket, +Inf, then the sum
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                histogram[i] += 1
+                break
+        else:
+            histogram[-2] += 1
+        histogram[-1] += value
+        return
+
+    def _totals(self):
+        counters = {}
+        histograms = {}
+        with self.lock:
+            per_thread = list(self.per_thread)
+        for thread_counters, thread_histograms in per_thread:
+            for key, value in list(thread_counters.items()):
+                counters[key] = counters.get(key, 0) + value
+            for key, value in list(thread_histograms.items()):
+                total = histograms.setdefault(key, [0] * len(value))
+                for i, v in enumerate(value):
+                    total[i] += v
+        return counters, histograms
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+    def _header(self, lines, name, default_type, described):
+        if name not in described:
+            described.add(name)
+            metric_type, help_text = self.help.get(name, (default_type, None))
+            if help_text:
+                lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+        return
+
+    def render(self, gauges=()):
+        """
+        gauges: iter [(name, labels, value)] read at the time of the call, e.g. index sizes
+        returns the metrics in the Prometheus text format
+        """
+        counters, histograms = self._totals()
+        lines = []
+        described = set()
+        for (name, labels), value in sorted(counters.items()):
+            self._header(lines, name, 'counter', described)
+            lines.append('%s%s %s' % (name, Metrics._labels(labels), value))
+        for (name, labels), histogram in sorted(histograms.items()):
+            self._header(lines, name, 'histogram', described)
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ['+Inf'], histogram[:-1]):
+                cumulative += count
+                lines.append('%s_bucket%s %s' % (name, Metrics._labels(labels, [('le', bound)]), cumulative))
+            lines.append('%s_sum%s %s' % (name, Metrics._labels(labels), histogram[-1]))
+            lines.append('%s_count%s %s' % (name, Metrics._labels(labels), cumulative))
+        for name, labels, value in gauges:
+            self._header(lines, name, 'gauge', described)
+            lines.append('%s%s %s' % (name, Metrics._labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class RequestTimer:
+    """
+    Time spent in each phase of one request, for the Server-Timing header and the slow request log
+    Phases with the same name, e.g. several waits for a thread, are added together
+    Phases may be inside others, e.g. the index phase of a scan is inside route, and blob_read inside contact_ids
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = {}  # { name: seconds } in the order first seen
+        return
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+        return
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def total(self):
+        return time.time() - self.start
+
+    def server_timing(self):
+        """
+        returns value for a Server-Timing header, durations in milliseconds
+        """
+        return ', '.join('%s;dur=%.3f' % (name, seconds * 1000) for name, seconds in list(self.phases.items()) + [('total', self.total())])
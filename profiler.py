@@ -0,0 +1,117 @@
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+# Profiling of a live server, nothing here runs until asked for:
+# SamplingProfiler samples the stacks of every thread (the reactor and the thread pool) for a number of seconds and
+# writes them in the collapsed format used by flame graph tools, RouteProfiler runs cProfile over a sample of requests
+# to chosen routes and keeps a pstats file per route.
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '%s:%s' % (os.path.basename(code.co_filename), code.co_name)
+
+
+class SamplingProfiler:
+
+    def __init__(self, directory, interval=0.005):
+        self.directory = directory
+        self.interval = interval
+        self.thread = None
+        return
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds):
+        """
+        Sample for seconds in a background thread
+        returns path of the file the collapsed stacks will be written to, or None if already running
+        """
+        if self.running():
+            return None
+        os.makedirs(self.directory, 0o770, exist_ok=True)
+        file_path = '%s/profile-%s.collapsed' % (self.directory, time.strftime('%Y%m%dT%H%M%S'))
+        self.thread = threading.Thread(target=self._sample, args=(seconds, file_path), name='sampling-profiler', daemon=True)
+        self.thread.start()
+        return file_path
+
+    def _sample(self, seconds, file_path):
+        stacks = Counter()
+        thread_names = {}
+        own_id = threading.get_ident()
+        end_time = time.time() + seconds
+        while time.time() < end_time:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                names = []
+                while frame is not None:
+                    names.append(_frame_name(frame))
+                    frame = frame.f_back
+                if thread_id not in thread_names:
+                    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+                names.append(thread_names.get(thread_id, str(thread_id)))
+                stacks[';'.join(reversed(names))] += 1
+            time.sleep(self.interval)
+        with open(file_path, 'w') as file:
+            for stack, count in stacks.most_common():
+                file.write('%s %d\n' % (stack, count))
+        return
+
+
+class RouteProfiler:
+    """
+    Deterministic profiling of one in every sample_every requests to routes, accumulated into directory/ROUTE.pstats
+    by collect and write, which the server calls every PROFILE_WRITE_PERIOD seconds
+    """
+
+    def __init__(self, directory, routes, sample_every=100):
+        self.directory = directory
+        self.sample_every = sample_every
+        self.profiles = {route: cProfile.Profile() for route in routes}
+        self.counts = Counter()
+        self.profiled = set()  # Routes profiled since last collected
+        return
+
+    def should_profile(self, route):
+        if route not in self.profiles:
+            return False
+        self.counts[route] += 1
+        return 0 == self.counts[route] % self.sample_every
+
+    def profile(self, route, function, *args):
+        """
+        returns function(*args) run under the profiler for route
+        """
+        profile = self.profiles[route]
+        profile.enable()
+        try:
+            return function(*args)
+        finally:
+            profile.disable()
+            self.profiled.add(route)
+
+    def collect(self):
+        """
+        Must be called from the thread that calls profile, it copies the stats so they can be written from another
+        returns [(file_path, pstats.Stats)] of the routes profiled since last called, for write
+        """
+        collected = [('%s/%s.pstats' % (self.directory, route.strip('/').replace('/', '_').replace(':', '_')),
+                      pstats.Stats(self.profiles[route])) for route in sorted(self.profiled)]
+        self.profiled.clear()
+        return collected
+
+    def write(self, collected):
+        """
+        Write out what collect returned, can be slow so run in a thread
+        """
+        os.makedirs(self.directory, 0o770, exist_ok=True)
+        for file_path, stats in collected:
+            stats.dump_stats(file_path)
+        return
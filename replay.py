@@ -0,0 +1,112 @@
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Plays back requests captured by a server with CAPTURE_FILE_PATH set, against another server, at the original pacing
+# or N times faster, to reproduce performance problems locally.
+#
+# python replay.py capture.jsonl --server http://localhost:8080 --speed 10 --testing_time
+#
+# With --testing_time each request carries its original time as X-Testing-Time, so a server with Testing = True
+# makes the same time dependent decisions (expiry, since/until) as the original did. The server sets one clock from
+# the header of each request, so these requests are sent one at a time, in order, whatever --threads is.
+
+parser = argparse.ArgumentParser(description='Replay requests captured by a bct server.')
+parser.add_argument('capture_file', help='file written by a server with CAPTURE_FILE_PATH set')
+parser.add_argument('--server', default='http://localhost:8080', help='url of the server to replay against')
+parser.add_argument('--speed', type=float, default=1.0, help='times faster than the original pacing, 0 for as fast as possible')
+parser.add_argument('--testing_time', action='store_true', help='send the original times as X-Testing-Time')
+parser.add_argument('--threads', type=int, default=20, help='most requests in progress at once, 1 with --testing_time')
+parser.add_argument('--output', help='file to write a JSON summary to')
+
+
+def read_capture(file_path):
+    """
+    returns iter [floating_seconds, method, uri, content_type, body] in time order
+    """
+    with open(file_path) as capture:
+        entries = [json.loads(line) for line in capture if line.endswith('\n')]  # Skip a partly written last line
+    entries.sort(key=lambda entry: entry[0])
+    return entries
+
+
+class Replay:
+
+    def __init__(self, server, testing_time):
+        self.server = server
+        self.testing_time = testing_time
+        self.sessions = threading.local()  # A requests.Session is not safe to share between threads
+        self.lock = threading.Lock()
+        self.status_codes = {}
+        self.latencies = {}  # { method path: [seconds] }
+        self.late = 0  # Requests that started behind schedule
+        return
+
+    def send(self, entry):
+        floating_seconds, method, uri, content_type, body = entry
+        headers = {'content-type': content_type} if content_type else {}
+        if self.testing_time:
+            headers['X-Testing-Time'] = repr(floating_seconds)
+        if not hasattr(self.sessions, 'session'):
+            self.sessions.session = requests.Session()
+        start_time = time.time()
+        try:
+            status_code = self.sessions.session.request(method, self.server + uri, data=body.encode(), headers=headers).status_code
+        except requests.RequestException:
+            status_code = 'error'
+        latency = time.time() - start_time
+        with self.lock:
+            self.status_codes[status_code] = self.status_codes.get(status_code, 0) + 1
+            self.latencies.setdefault('%s %s' % (method, uri.split('?')[0]), []).append(latency)
+        return
+
+    def run(self, entries, speed, threads):
+        if not entries:
+            return
+        first_time = entries[0][0]
+        start_time = time.time()
+        # One thread sends the requests with X-Testing-Time in order, as the executor's queue is first in first out
+        with ThreadPoolExecutor(max_workers=1 if self.testing_time else threads) as executor:
+            for entry in entries:
+                if speed:
+                    delay = start_time + (entry[0] - first_time) / speed - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                    elif delay < -0.1:
+                        self.late += 1
+                executor.submit(self.send, entry)
+        return
+
+    def summary(self, elapsed):
+        routes = {}
+        for route, latencies in self.latencies.items():
+            latencies.sort()
+            routes[route] = {
+                'count': len(latencies),
+                'p50_ms': 1000 * latencies[len(latencies) // 2],
+                'p99_ms': 1000 * latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))],
+                'max_ms': 1000 * latencies[-1]
+            }
+        return {
+            'elapsed_seconds': elapsed,
+            'requests': sum(self.status_codes.values()),
+            'status_codes': {str(k): v for k, v in self.status_codes.items()},
+            'late': self.late,
+            'routes': routes
+        }
+
+
+if __name__ == '__main__':
+    parsed_args = parser.parse_args()
+    entries = read_capture(parsed_args.capture_file)
+    replay = Replay(parsed_args.server.rstrip('/'), parsed_args.testing_time)
+    start = time.time()
+    replay.run(entries, parsed_args.speed, parsed_args.threads)
+    summary = replay.summary(time.time() - start)
+    if parsed_args.output:
+        json.dump(summary, open(parsed_args.output, 'w'), indent=2)
+    print(json.dumps(summary, indent=2))
@@ -0,0 +1,339 @@
+import argparse
+import configparser
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from twisted.logger import globalLogPublisher, Logger, globalLogBeginner
+from twisted.logger import LogLevelFilterPredicate, LogLevel
+from twisted.logger import textFileLogObserver, FilteringLogObserver
+from twisted.web import resource, server as twserver
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThread
+
+from contacts import spatial_key_from_bbox, spatial_key_from_lat_long, split_bounding_boxes
+from lib import current_time, set_current_time_for_testing, iso_time_from_seconds_since_epoch, unix_time_from_iso
+
+# The router sits in front of several bct servers (shards) each of which owns a range of contact ids and spatial cells,
+# by the first two hex digits of the contact id or the spatial key.
+# Writes go to the owning shard, scans and syncs go to every shard that could have matching data and are merged.
+
+parser = argparse.ArgumentParser(description='Run bct shard router.')
+parser.add_argument('--config_file', default='router_config.ini', help='config file name')
+parser.add_argument('--log_level', help='logging level', choices=['debug', 'info', 'warn', 'error', 'critical'])
+
+parsed_args = parser.parse_args()
+
+config_top = configparser.ConfigParser()
+config_top.read(parsed_args.config_file)
+config = config_top['DEFAULT']
+
+log_level = parsed_args.log_level or config.get('log_level', 'info')
+log_file_path = config.get('log_file_path')
+globalLogPublisher.addObserver(FilteringLogObserver(textFileLogObserver(open(log_file_path, 'a+') if log_file_path else sys.stderr),
+                                                    predicates=[LogLevelFilterPredicate(LogLevel.levelWithName(log_level.lower()))]))
+logger = Logger()
+globalLogBeginner.beginLoggingTo([])
+
+testing = 'True' == config.get('Testing')
+bb_min_dp = config.getint('bounding_box_minimum_dp', 2)
+max_missing_updates = config.getint('max_missing_updates', 10)
+max_scan_count = config.getint('max_scan_count', 50)
+max_sync_count = config.getint('max_sync_count', 1000)
+
+
+class Shard:
+    """
+    One bct server, and the ranges of the first byte of contact ids and spatial keys that it owns
+    """
+
+    def __init__(self, description):
+        """
+        description: "URL CONTACT_RANGE [SPATIAL_RANGE]" e.g. "http://localhost:8081 00-7F 00-22",
+        the spatial range defaults to the contact range
+        """
+        parts = description.split()
+        self.url = parts[0]
+        self.contact_range = Shard._parse_range(parts[1])
+        self.spatial_range = Shard._parse_range(parts[2]) if len(parts) > 2 else self.contact_range
+        return
+
+    def __repr__(self):
+        return '<Shard %s>' % self.url
+
+    @staticmethod
+    def _parse_range(range_string):
+        low, high = range_string.split('-')
+        return int(low, 16), int(high, 16)
+
+    @staticmethod
+    def _in_range(the_range, prefix):
+        """
+        True if any key starting with prefix (a hex string) is in the_range
+        """
+        prefix = prefix.upper()
+        if len(prefix) >= 2:
+            low = high = int(prefix[0:2], 16)
+        elif len(prefix) == 1:
+            low = int(prefix, 16) * 16
+            high = low + 15
+        else:
+            low, high = 0, 255
+        return (low <= the_range[1]) and (high >= the_range[0])
+
+    def owns_contact(self, prefix):
+        return Shard._in_range(self.contact_range, prefix)
+
+    def owns_spatial(self, key):
+        return Shard._in_range(self.spatial_range, key)
+
+
+shards = [Shard(description) for description in config['shards'].split(',')]
+for first_byte in range(256):
+    for range_name in ['contact_range', 'spatial_range']:
+        owners = [shard for shard in shards if getattr(shard, range_name)[0] <= first_byte <= getattr(shard, range_name)[1]]
+        if 1 != len(owners):
+            raise Exception('%02X must be in the %s of exactly one shard, not %s' % (first_byte, range_name, owners))
+
+# Requests to shards are made in parallel from this pool
+shard_executor = ThreadPoolExecutor(max_workers=len(shards))
+
+
+def shard_for_contact(contact_id):
+    return next(shard for shard in shards if shard.owns_contact(contact_id))
+
+
+def shard_for_location(location):
+    return next(shard for shard in shards if shard.owns_spatial(spatial_key_from_lat_long((float(location['lat']), float(location['long'])), bb_min_dp)))
+
+
+def post(shard, endpoint_name, data, headers):
+    resp = requests.post(shard.url + endpoint_name, json=data, headers=headers)
+    return resp.status_code, resp.json()
+
+
+def get(shard, endpoint_name, params, headers):
+    resp = requests.get(shard.url + endpoint_name, params=params, headers=headers)
+    return resp.status_code, resp.json()
+
+
+def on_shards(the_shards, function):
+    """
+    Run function(shard) on each of the_shards in parallel
+    returns [(status_code, response)] in the same order, or the first error as (status_code, response)
+    """
+    results = list(shard_executor.map(function, the_shards))
+    for result in results:
+        if 200 != result[0]:
+            logger.error('error from shard: {result}', result=result)
+            return result
+    return results
+
+
+def scan_or_sync_shards(the_shards, query, maximum_results):
+    """
+    Merge a /status/scan or /sync over the_shards,
+    query(shard, until) does the request on one shard returning data only up to until, with the times of each item.
+    Each shard returns its oldest data, so the merged result can only go up to the earliest until of any shard,
+    shards that returned data later than that are asked again with it as until.
+    The items are then merged by time and serial number and, as on a shard, only the oldest maximum_results are returned
+    with until the time of the first left out.
+    """
+    until = iso_time_from_seconds_since_epoch(current_time())
+    results = on_shards(the_shards, lambda shard: query(shard, until))
+    if not isinstance(results, list):
+        return results
+    responses = dict(zip(the_shards, [response for status_code, response in results]))
+    asked_until = dict.fromkeys(the_shards, until)
+    while True:
+        until = min((response['until'] for response in responses.values()), key=unix_time_from_iso)
+        stale_shards = [shard for shard, response in responses.items() if unix_time_from_iso(response['until']) > unix_time_from_iso(until)]
+        if not stale_shards:
+            break
+        if any(asked_until[shard] == until for shard in stale_shards):  # Asking again would get the same answer
+            logger.error('{shards} returned data after until {until}', shards=stale_shards, until=until)
+            return 502, {'error': 'shard returned data after until'}
+        asked_until.update(dict.fromkeys(stale_shards, until))
+        logger.info('asking {shards} again for data until {until}', shards=stale_shards, until=until)
+        results = on_shards(stale_shards, lambda shard: query(shard, until))
+        if not isinstance(results, list):
+            return results
+        responses.update(zip(stale_shards, [response for status_code, response in results]))
+    ret = {
+        'since': next(iter(responses.values()))['since'],
+        'until': until,
+        'more_data': any(response['more_data'] for response in responses.values()),
+        'contact_ids': [],
+        'locations': []
+    }
+    # (floating_seconds, serial_number, shard index, key, data), serial numbers are per shard so the index breaks ties
+    items = sorted(((floating_seconds, serial_number, index, key, datum)
+                    for index, response in enumerate(responses.values())
+                    for key in ['contact_ids', 'locations']
+                    for floating_seconds, serial_number, datum in response.get(key, [])),
+                   key=lambda item: item[0:3])
+    if len(items) > maximum_results:
+        ret['until'] = iso_time_from_seconds_since_epoch(items[maximum_results][0])
+        ret['more_data'] = True
+    for floating_seconds, serial_number, index, key, datum in items[:maximum_results]:
+        ret[key].append(datum)
+    return 200, ret
+
+
+def route_send(data, args, headers):
+    """
+    Split the contacts and locations by the shard that owns them
+    """
+    shard_data = {}
+    common = {k: v for k, v in data.items() if k not in ['contact_ids', 'locations']}
+    for contact in data.get('contact_ids', []):
+        shard_data.setdefault(shard_for_contact(contact['id']), dict(common)).setdefault('contact_ids', []).append(contact)
+    for location in data.get('locations', []):
+        shard_data.setdefault(shard_for_location(location), dict(common)).setdefault('locations', []).append(location)
+    results = on_shards(list(shard_data), lambda shard: post(shard, '/status/send', shard_data[shard], headers))
+    return results if not isinstance(results, list) else (200, {"status": "ok"})
+
+
+def route_update(data, args, headers):
+    # The data being updated could be on any shard
+    results = on_shards(shards, lambda shard: post(shard, '/status/update', data, headers))
+    return results if not isinstance(results, list) else (200, {"status": "ok"})
+
+
+def route_result(data, args, headers):
+    """
+    The tested contact goes to the shard owning it, the rest of the update tokens update data on any shard,
+    so the other shards get them as a /status/update, holding no more of those not found than the owner does
+    """
+    owner = shard_for_contact(data['id'])
+    update_tokens = data.get('update_tokens', [])[1:]  # status_result uses the first one for the contact itself
+    update = {'length': len(update_tokens), 'update_tokens': update_tokens, 'replaces': data.get('replaces'),
+              'status': data.get('status'), 'message': data.get('message'), 'max_missing_updates': max_missing_updates}
+
+    def result_or_update(shard):
+        if shard is owner:
+            return post(shard, '/status/result', data, headers)
+        return post(shard, '/status/update', update, headers)
+    results = on_shards(shards, result_or_update)
+    return results if not isinstance(results, list) else (200, {"status": "ok"})
+
+
+def route_data_points(data, args, headers):
+    results = on_shards(shards, lambda shard: post(shard, '/status/data_points', data, headers))
+    if not isinstance(results, list):
+        return results
+    return 200, {
+        'locations': [location for status_code, response in results for location in response.get('locations', [])],
+        'contact_ids': [contact for status_code, response in results for contact in response.get('contact_ids', [])]
+    }
+
+
+def route_scan(data, args, headers):
+    """
+    A scan without contact_prefixes returns every contact, and one without locations every location, so those go to
+    every shard, otherwise only to the shards owning the prefixes and bounding boxes
+    """
+    prefixes = data.get('contact_prefixes')
+    locations = data.get('locations')
+    the_shards = shards
+    if prefixes is not None and locations:
+        bboxs = split_bounding_boxes([(l['min_lat'], l['min_long'], l['max_lat'], l['max_long']) for l in locations], bb_min_dp)
+        first_bytes = set(spatial_key_from_bbox(bbox, bb_min_dp)[0:2] for bbox in bboxs)
+        the_shards = [shard for shard in shards if any(shard.owns_contact(prefix) for prefix in prefixes)
+                      or any(shard.owns_spatial(first_byte) for first_byte in first_bytes)]
+    scan_data = dict(data, with_times=True)
+    return scan_or_sync_shards(the_shards, lambda shard, until: post(shard, '/status/scan', dict(scan_data, until=until), headers),
+                               max_scan_count)
+
+
+def route_sync(data, args, headers):
+    params = {'since': args['since'][0]} if args.get('since') else {}
+    return scan_or_sync_shards(shards, lambda shard, until: get(shard, '/sync', dict(params, until=until, with_times='true'), headers),
+                               max_sync_count)
+
+
+def route_to_first(endpoint_name, method):
+    # Configuration is the same on every shard, so ask the first
+    def route(data, args, headers):
+        if 'GET' == method:
+            return get(shards[0], endpoint_name, {}, headers)
+        return post(shards[0], endpoint_name, data, headers)
+    return route
+
+
+def route_admin_status(data, args, headers):
+    results = on_shards(shards, lambda shard: get(shard, '/admin/status', {}, headers))
+    if not isinstance(results, list):
+        return results
+    ret = {}
+    for status_code, response in results:
+        for k, v in response.items():
+            if isinstance(v, (int, float)) and not isinstance(v, bool):
+                ret[k] = ret.get(k, 0) + v
+    return 200, ret
+
+
+routes = {
+    '/status/send:POST': route_send,
+    '/status/update:POST': route_update,
+    '/status/result:POST': route_result,
+    '/status/data_points:POST': route_data_points,
+    '/status/scan:POST': route_scan,
+    '/sync:GET': route_sync,
+    '/init:POST': route_to_first('/init', 'POST'),
+    '/admin/config:GET': route_to_first('/admin/config', 'GET'),
+    '/admin/status:GET': route_admin_status,
+}
+
+
+def routed_response(result, request):
+    status_code, ret = result
+    request.setResponseCode(status_code)
+    request.write(json.dumps(ret).encode())
+    request.finish()
+    return
+
+
+def routed_error(failure, request):
+    logger.failure("Logging an uncaught exception", failure=failure)
+    request.setResponseCode(400)
+    request.write(json.dumps({'error': 'internal error'}).encode())
+    request.finish()
+    return
+
+
+class Router(resource.Resource):
+    isLeaf = True
+
+    def render(self, request):
+        path_method = '%s:%s' % (request.path.decode(), request.method.decode())
+        logger.info('routing {path_method}', path_method=path_method)
+        request.responseHeaders.addRawHeader(b"content-type", b"application/json")
+        route = routes.get(path_method)
+        if not route:
+            request.setResponseCode(402)
+            return json.dumps({"error": "no such request"}).encode()
+        headers = {}
+        x_time_for_testing = request.requestHeaders.getRawHeaders('X-Testing-Time')
+        if testing and x_time_for_testing:
+            set_current_time_for_testing(float(x_time_for_testing[0]))
+            headers['X-Testing-Time'] = x_time_for_testing[0]
+        content_type_headers = request.requestHeaders.getRawHeaders('content-type')
+        try:
+            data = json.load(request.content) if content_type_headers and ('application/json' in content_type_headers) else {}
+        except json.JSONDecodeError:
+            request.setResponseCode(500)
+            return json.dumps({"error": "Bad JSON in request"}).encode()
+        args = {k.decode(): [item.decode() for item in v] for k, v in request.args.items()}
+        deferred = deferToThread(route, data, args, headers)
+        deferred.addCallback(routed_response, request)
+        deferred.addErrback(routed_error, request)
+        return twserver.NOT_DONE_YET
+
+
+port = config.getint('port', 8080)
+reactor.listenTCP(port, twserver.Site(Router()))
+# This is intentionally at warn level to allow when debugging to wait for it to be ready
+logger.warn('Router alive and listening on port %s for %s' % (port, shards))
+reactor.run()
@@ -1,15 +1,19 @@
 import argparse
 import os
 
-from twisted.logger import globalLogPublisher, Logger, globalLogBeginner
+from twisted.logger import globalLogPublisher, globalLogBeginner
 from twisted.logger import LogLevelFilterPredicate, LogLevel
 from twisted.logger import textFileLogObserver, FilteringLogObserver
 from twisted.web import resource, server as twserver
 from twisted.internet import reactor, task
 from twisted.internet.threads import deferToThread
-from twisted.web.client import Agent, readBody
+from twisted.web.client import Agent, readBody, FileBodyProducer
 from twisted.web.http_headers import Headers
+from io import BytesIO
 import json
+import socket
+import subprocess
+import threading
 from contacts import Contacts
 import configparser
 import urllib.request
@@ -17,13 +21,23 @@ import uuid
 import signal
 import atexit
 import sys
-from lib import set_current_time_for_testing
+import time
+import random
+from lib import set_current_time_for_testing, dumps_response, current_time, unix_time_from_iso, write_json_atomically
+from metrics import metrics, RequestTimer
+from profiler import SamplingProfiler, RouteProfiler
+from logs import LevelLogger, BatchedLogFile, set_log_level, set_log_payloads, log_level_enabled
 
 parser = argparse.ArgumentParser(description='Run bct server.')
 parser.add_argument('--config_file', default='config.ini',
                     help='config file name, if an http url then the config file contents are fetched over http')
 parser.add_argument('--log_level', 
                     help='logging level', choices=['debug', 'info', 'warn', 'error', 'critical'])
+parser.add_argument('--workers', type=int,
+                    help='number of read worker processes sharing the port, overrides WORKERS in the config file')
+# These are used when starting read workers, not by hand
+parser.add_argument('--role', default='standalone', choices=['standalone', 'reader'], help=argparse.SUPPRESS)
+parser.add_argument('--writer_url', help=argparse.SUPPRESS)
 
 parsed_args = parser.parse_args()
 
@@ -42,7 +56,10 @@ def get_config():
     return conf
 
 
-config_top = get_config()
+# Time each phase of startup, they are logged once listening and kept for /admin/status
+startup_timer = RequestTimer()
+with startup_timer.phase('config'):
+    config_top = get_config()
 config = config_top['DEFAULT']
 
 mlog_file_path = config.get('log_file_path')
@@ -55,6 +72,8 @@ def reset_log_file():
         print('removing log observer')
         globalLogPublisher.removeObserver(log_observer)
     log_level = parsed_args.log_level or config['log_level']
+    set_log_level(log_level)  # So events below log_level are never built
+    set_log_payloads('True' == config.get('log_payloads'))
     info_predicate = LogLevelFilterPredicate(LogLevel.levelWithName(log_level.lower()))
     if mlog_file_path:
         mlog_file = open(mlog_file_path, 'a+')
@@ -68,11 +87,19 @@ def reset_log_file():
     return
 
 
-reset_log_file()
-logger = Logger()
+with startup_timer.phase('log'):
+    reset_log_file()
+logger = LevelLogger()
 globalLogBeginner.beginLoggingTo([])
 
-contacts = Contacts(config_top)
+# A reader is one of several worker processes started with --workers, it serves reads from its own index of the data
+# directory, kept up to date from the change log, and forwards anything else to the process that started it (the writer)
+read_only = 'reader' == parsed_args.role
+# A replica tails the /changes of the PRIMARY server, serves reads itself and forwards (or refuses) writes to it
+primary_url = config.get('primary')
+workers = 0 if read_only else (parsed_args.workers if parsed_args.workers is not None else config.getint('workers', 0))
+with startup_timer.phase('load'):
+    contacts = Contacts(config_top, read_only=read_only)
 
 
 # noinspection PyUnusedLocal
@@ -92,6 +119,23 @@ def receive_signal(signal_number, frame):
 
 signal.signal(signal.SIGUSR1, receive_signal)
 
+# Profiles are written to DIRECTORY/.profiles, /admin/profile is only allowed if ALLOW_PROFILING is set
+allow_profiling = 'True' == config.get('allow_profiling')
+sampling_profiler = SamplingProfiler('%s/.profiles' % config['directory'])
+route_profiler = RouteProfiler('%s/.profiles' % config['directory'],
+                               [route.strip() for route in config.get('profile_routes', '').split(',') if route.strip()],
+                               config.getint('profile_sample_every', 100))
+
+
+# noinspection PyUnusedLocal
+def receive_profile_signal(signal_number, frame):
+    file_path = sampling_profiler.start(config.getfloat('profile_seconds', 30))
+    logger.warn('Received signal: {signal_number}, profiling to {file_path}', signal_number=signal_number, file_path=file_path)
+    return
+
+
+signal.signal(signal.SIGUSR2, receive_profile_signal)
+
 atexit.register(contacts.close)
 
 servers_file_path = '%s/.servers' % config['directory']
@@ -99,28 +143,89 @@ servers_file_path = '%s/.servers' % config['directory']
 
 logger.info('loading server')
 
-try:
-    servers = json.load(open(servers_file_path))
-    logger.info('read last read date from server neighbors from {servers_file_path}', servers_file_path=servers_file_path)
-except json.JSONDecodeError:
-    logger.error("Bad JSON in server file at {file_path} recovering automatically", file_path=servers_file_path)
-    servers = {}
-except FileNotFoundError as err:
-    servers = {}
+with startup_timer.phase('servers'):
+    try:
+        servers = json.load(open(servers_file_path))
+        logger.info('read last read date from server neighbors from {servers_file_path}', servers_file_path=servers_file_path)
+    except json.JSONDecodeError:
+        logger.error("Bad JSON in server file at {file_path} recovering automatically", file_path=servers_file_path)
+        servers = {}
+    except FileNotFoundError as err:
+        servers = {}
 if config.get('servers'):
     for server in config.get('servers').split(','):
         if server not in servers:
             servers[server] = '1970-01-01T00:00Z'
 
+reader_methods = ['/status/scan:POST', '/sync:GET']
+replica_methods = ['/status/scan:POST', '/sync:GET', '/status/data_points:POST', '/changes:GET', '/admin/config:GET',
+                   '/admin/status:GET']
 allowable_methods = ['/status/scan:POST', '/status/send:POST', '/status/update:POST', '/sync:GET', '/admin/config:GET',
-                     '/admin/status:GET', '/status/result:POST', '/status/data_points:POST', '/init:POST']
+                     '/admin/status:GET', '/status/result:POST', '/status/data_points:POST', '/init:POST',
+                     '/changes:GET']
+
+
+metrics.describe('bct_requests_total', 'counter', 'Requests by route and response code')
+metrics.describe('bct_request_duration_seconds', 'histogram', 'Time from receiving a request to finishing its response')
+metrics.describe('bct_thread_wait_seconds', 'histogram', 'Time work waited for a thread after deferToThread')
+metrics.describe('bct_blob_cache_hits_total', 'counter', 'Blobs found in the in memory cache')
+metrics.describe('bct_blob_cache_misses_total', 'counter', 'Blobs not in the in memory cache, so read from disk')
+metrics.describe('bct_disk_reads_total', 'counter', 'Attempts to read a blob from disk, including retries')
+metrics.describe('bct_disk_read_retries_total', 'counter', 'Failed attempts to read a blob from disk that were retried')
+metrics.describe('bct_disk_read_errors_total', 'counter', 'Blobs that could not be read from disk after the retry')
+metrics.describe('bct_cold_block_reads_total', 'counter', 'Blocks of cold segments read from disk and decompressed')
+metrics.describe('bct_neighbor_sync_lag_seconds', 'gauge', 'Time since the until of the last sync from each neighbor')
+
+
+# Send a Server-Timing header with the time spent in each phase of a request
+server_timing = 'True' == config.get('server_timing')
+# Requests taking longer than this are logged with their phase timings, to SLOW_REQUEST_LOG_FILE_PATH if set
+slow_request_seconds = config.getfloat('slow_request_milliseconds', 0) / 1000
+slow_request_log = open(config['slow_request_log_file_path'], 'a') if config.get('slow_request_log_file_path') else None
+
+
+# Opt in capture of requests for replay.py, CAPTURE_SAMPLE_RATE of them are appended to CAPTURE_FILE_PATH one JSON line each
+# [floating_seconds, method, uri, content_type, body], line buffered so read workers can append to the same file
+capture_file = open(config['capture_file_path'], 'a', buffering=1) if config.get('capture_file_path') else None
+capture_sample_rate = config.getfloat('capture_sample_rate', 1.0)
+
 
+def capture_request(request, path_method):
+    if (path_method not in allowable_methods) or (random.random() >= capture_sample_rate):
+        return
+    body = request.content.read()
+    request.content.seek(0)
+    capture_file.write(json.dumps([current_time(), request.method.decode(), request.uri.decode(),
+                                   request.getHeader('content-type') or '', body.decode('utf-8', 'replace')]) + '\n')
+    return
+
+
+# Functions from deferred_function given to deferToThread that have not yet started running in a thread
+queued_functions = 0
+queued_functions_lock = threading.Lock()
+
+
+def deferred_function(function, timer=None, phase_name=None):
+    """
+    timer: RequestTimer to add the time waiting for a thread, and running function as phase_name, to
+    """
+    global queued_functions
+    queued_time = time.time()  # deferred_function is called just before deferToThread
+    with queued_functions_lock:
+        queued_functions += 1
 
-def deferred_function(function):
     def _deferred_function():
+        global queued_functions
+        with queued_functions_lock:
+            queued_functions -= 1
+        start_time = time.time()
+        metrics.observe('bct_thread_wait_seconds', start_time - queued_time)
         logger.info('in thread, running {function}', function=function)
         result = function()
-        logger.info('ran, result is {result}', result=result)
+        logger.payload('ran, result is {result}', result=result)
+        if timer:
+            timer.add('thread_wait', start_time - queued_time)
+            timer.add(phase_name, time.time() - start_time)
         return result
 
     return _deferred_function
@@ -135,7 +240,7 @@ def resolve_all_functions(ret, request):
     """
     for key, value in ret.items():
         if 'function' == type(value).__name__:
-            function_to_run_in_thread = deferred_function(value)
+            function_to_run_in_thread = deferred_function(value, request.timer, key)
             logger.info('found a function for key {key}, running as a deferred', key=key)
             deferred = deferToThread(function_to_run_in_thread)
             deferred.addCallback(deferred_result_available, key, ret, request)
@@ -153,22 +258,127 @@ def deferred_result_error(failure, request):
 
 
 def deferred_result_available(result, key, ret, request):
-    logger.info('got result for key {key} of {result}', key=key, result=result)
+    logger.payload('got result for key {key} of {result}', key=key, result=result)
     ret[key] = result
     ret = resolve_all_functions(ret, request)
     if twserver.NOT_DONE_YET != ret:
         # ok, finally done, let's return it
-        logger.info('writing HTTP result of {ret}', ret=ret)
-        request.write(json.dumps(ret).encode())
+        logger.payload('writing HTTP result of {ret}', ret=ret)
+        request.write(encode_response(ret, request))
         request.finish()
     return
 
 
+def encode_response(ret, request):
+    with request.timer.phase('encode'):
+        body = dumps_response(ret)
+    if server_timing:
+        request.responseHeaders.addRawHeader(b"Server-Timing", request.timer.server_timing().encode())
+    return body
+
+
+def query_shape(data, args):
+    """
+    Describe a request for the slow request log without the data in it: sizes of lists, and the times asked for
+    """
+    shape = {}
+    for k, v in list(data.items() if isinstance(data, dict) else []) + list(args.items()):
+        if k in ['since', 'until', 'after']:
+            shape[k] = v[0].decode() if isinstance(v, list) and v and isinstance(v[0], bytes) else v
+        elif isinstance(v, (list, dict)):
+            shape[k] = len(v)
+    return shape
+
+
+def request_finished(result, request, route):
+    total = request.timer.total()
+    metrics.inc('bct_requests_total', (('route', route), ('code', request.code)))
+    metrics.observe('bct_request_duration_seconds', total, (('route', route),))
+    if slow_request_seconds and (total > slow_request_seconds):
+        slow_request = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(request.timer.start)),
+            'route': route, 'uri': request.uri.decode(), 'code': request.code, 'total_ms': round(total * 1000, 3),
+            'phases_ms': {name: round(seconds * 1000, 3) for name, seconds in request.timer.phases.items()},
+            'shape': getattr(request, 'query_shape', {})
+        }
+        if slow_request_log:
+            slow_request_log.write(json.dumps(slow_request) + '\n')
+            slow_request_log.flush()
+        else:
+            logger.warn('slow request: {slow_request}', slow_request=json.dumps(slow_request))
+    return None  # Also called, with a failure, if the connection was lost
+
+
+def metrics_gauges():
+    """
+    returns iter [(name, labels, value)] read when /admin/metrics is called
+    """
+    yield from contacts.metrics_gauges()
+    thread_pool = reactor.getThreadPool()
+    yield 'bct_thread_pool_queue_depth', (), queued_functions
+    yield 'bct_thread_pool_busy_threads', (), len(thread_pool.working)
+    yield 'bct_thread_pool_max_threads', (), thread_pool.max
+    now = current_time()
+    for remote_server, last_request in list(servers.items()):
+        yield 'bct_neighbor_sync_lag_seconds', (('neighbor', remote_server),), now - unix_time_from_iso(last_request)
+    return
+
+
+def forward_request(request, url):
+    """
+    In a read worker or replica, pass a request that isn't a read on to the writer or primary at url, and its response back
+    """
+    logger.info('forwarding {uri} to {url}', uri=request.uri, url=url)
+    headers = Headers({name: request.requestHeaders.getRawHeaders(name)
+                       for name in [b'content-type', b'X-Testing-Time'] if request.requestHeaders.hasHeader(name)})
+    deferred = Agent(reactor).request(request.method, url.encode() + request.uri, headers,
+                                      FileBodyProducer(BytesIO(request.content.read())))
+    deferred.addCallback(forwarded_response, request)
+    deferred.addErrback(deferred_result_error, request)
+    return twserver.NOT_DONE_YET
+
+
+def forwarded_response(response, request):
+    request.setResponseCode(response.code)
+    deferred = readBody(response)
+    deferred.addCallback(forwarded_body, request)
+    deferred.addErrback(deferred_result_error, request)
+    return deferred
+
+
+def forwarded_body(body, request):
+    request.write(body)
+    request.finish()
+    return
+
+
 class Simple(resource.Resource):
     isLeaf = True
 
     def render(self, request):
         logger.info('in render, request: {request}, post_path is {post_path}', request=request, post_path=request.postpath)
+        path_method = '%s:%s' % (request.path.decode(), request.method.decode())
+        request.timer = RequestTimer()
+        request.notifyFinish().addBoth(request_finished, request, path_method if path_method in allowable_methods else 'other')
+        if '/admin/metrics:GET' == path_method:
+            request.responseHeaders.addRawHeader(b"content-type", b"text/plain; version=0.0.4")
+            return metrics.render(metrics_gauges()).encode()
+        if allow_profiling and ('/admin/profile:GET' == path_method):
+            request.responseHeaders.addRawHeader(b"content-type", b"application/json")
+            try:
+                seconds = float(request.args.get(b'seconds', [config.get('profile_seconds', '30')])[0])
+            except ValueError:
+                seconds = None
+            if not (seconds and seconds > 0):  # Also refuses nan
+                request.setResponseCode(400)
+                return json.dumps({"error": "seconds must be a positive number"}).encode()
+            seconds = min(seconds, config.getfloat('profile_max_seconds', 300))
+            file_path = sampling_profiler.start(seconds)
+            if not file_path:
+                request.setResponseCode(409)
+                return json.dumps({"error": "already profiling"}).encode()
+            return json.dumps({"status": "profiling", "seconds": seconds, "file_path": file_path}).encode()
+
         x_self_string_headers = request.requestHeaders.getRawHeaders('X-Self-String')
         if x_self_string_headers and (self_string in x_self_string_headers):
             logger.info('called by self, returning 302')
@@ -182,10 +392,22 @@ class Simple(resource.Resource):
             logger.info('In testing and current time is being overridden with {time}', time=x_time_for_testing)
             set_current_time_for_testing(x_time_for_testing)
 
+        if read_only and (request.method != b'OPTIONS') and (path_method not in reader_methods):
+            return forward_request(request, parsed_args.writer_url)
+        if primary_url and (request.method != b'OPTIONS') and (path_method not in replica_methods):
+            if 'refuse' == config.get('replica_writes', 'forward'):
+                request.setResponseCode(403)
+                return json.dumps({"error": "read only replica"}).encode()
+            return forward_request(request, primary_url)
+
+        if capture_file:
+            capture_request(request, path_method)
+
         content_type_headers = request.requestHeaders.getRawHeaders('content-type')
         if content_type_headers and ('application/json' in content_type_headers):
             try:
-                data = json.load(request.content)
+                with request.timer.phase('parse'):
+                    data = json.load(request.content)
             except json.JSONDecodeError:
                 logger.error('Passed bad JSON in request: {content}', content=request.content)
                 request.setResponseCode(500)
@@ -193,9 +415,10 @@ class Simple(resource.Resource):
                 return ret
         else:
             data = request.content.read()
-        logger.info('request content: {data}', data=data)
+        logger.payload('request content: {data}', data=data)
 
         args = {k.decode(): [item for item in v] for k, v in request.args.items()}
+        request.query_shape = query_shape(data, args)
 
         path = request.path.decode()
         method = request.method.decode()
@@ -218,7 +441,11 @@ class Simple(resource.Resource):
             # before this gets commented back in, the origins should come from config file
             # request.responseHeaders.addRawHeader(b"access-control-allow-origin", b"*")
             if path_method in allowable_methods:
-                ret = contacts.execute_route(path, data, args)
+                with request.timer.phase('route'):
+                    if route_profiler.should_profile(path_method):
+                        ret = route_profiler.profile(path_method, contacts.execute_route, path, data, args, request.timer)
+                    else:
+                        ret = contacts.execute_route(path, data, args, request.timer)
                 if 'error' in ret:
                     request.setResponseCode(ret.get('status', 400))
                     ret = ret['error']
@@ -228,13 +455,13 @@ class Simple(resource.Resource):
                     # if they aren't then return ret
 
                     ret = resolve_all_functions(ret, request)
-                    logger.info('legal return is {ret}', ret=ret)
+                    logger.payload('legal return is {ret}', ret=ret)
             else:
                 request.setResponseCode(402)
                 ret = {"error": "no such request"}
                 logger.error('return is {ret}', ret=ret)
             if twserver.NOT_DONE_YET != ret:
-                return json.dumps(ret).encode()
+                return encode_response(ret, request)
             else:
                 return ret
 
@@ -242,7 +469,7 @@ class Simple(resource.Resource):
 def sync_body(body, remote_server):
     server_name = remote_server  # TODO-119 TODO-67 this will be replaced with a certified name once certificates implemented
     data = json.loads(body)  # TODO-DAN need to handle error (json.JSONDecodeError) here
-    logger.info('Response body in sync: {data}, calling send status', data=data)
+    logger.payload('Response body in sync: {data}, calling send status', data=data)
     json_data = json.loads(body)  # TODO-DAN why do we convert the sync result here as well as 2 lines above and sometimes use json_data and sometimes data below?
     for o in json_data.get('contact_ids', []) + json_data.get('locations', []):
         if not o.get('path'):
@@ -250,7 +477,7 @@ def sync_body(body, remote_server):
         o['path'].append(server_name)
     contacts.send_or_sync(json_data, {})
     servers[remote_server] = data['until']
-    json.dump(servers, open(servers_file_path, 'w'))
+    write_json_atomically(servers_file_path, servers)
     return
 
 
@@ -288,34 +515,224 @@ def get_data_from_neighbors():
     return
 
 
+# True while a thread is deleting files on the deletion lists, so only one runs at once
+deletion_running = False
+
+
 def delete_expired_data_success(result):
+    global deletion_running
+    deletion_running = False
     logger.info('finished deleting from expired data')
     return
 
 
 def delete_expired_data_failure(failure):
+    global deletion_running
+    deletion_running = False
     logger.failure("Logging an uncaught exception", failure=failure)
     return
 
 
 def delete_expired_data():
-    logger.info("Expiring data")
-    contacts.move_expired_data_to_deletion_list()
-    function_to_run_in_thread = deferred_function(contacts.delete_from_deletion_list)
-    deferred = deferToThread(function_to_run_in_thread)
-    deferred.addCallback(delete_expired_data_success)
-    deferred.addErrback(delete_expired_data_failure)
+    """
+    Called every EXPIRY_PERIOD seconds, expires a small slice of data so that requests are not held up,
+    and starts a thread to delete the files if there are any
+    """
+    global deletion_running
+    moved = contacts.move_expired_data_to_deletion_list(maximum_items=config.getint('expiry_batch_size', 1000),
+                                                        maximum_seconds=config.getfloat('expiry_batch_milliseconds', 20) / 1000)
+    if moved:
+        logger.info('Expired {moved} items', moved=moved)
+    if (not deletion_running) and contacts.deletion_list_length():
+        deletion_running = True
+        function_to_run_in_thread = deferred_function(contacts.delete_from_deletion_list)
+        deferred = deferToThread(function_to_run_in_thread)
+        deferred.addCallback(delete_expired_data_success)
+        deferred.addErrback(delete_expired_data_failure)
     return
 
 
-if 0 != len(servers):
+compaction_running = False
+
+
+def compact_cold_data_success(moved):
+    global compaction_running
+    compaction_running = False
+    if moved:
+        logger.info('Moved {moved} items into cold segments', moved=moved)
+    return
+
+
+def compact_cold_data_failure(failure):
+    global compaction_running
+    compaction_running = False
+    logger.failure("Logging an uncaught exception", failure=failure)
+    return
+
+
+def compact_cold_data():
+    """
+    Called every COLD_PERIOD seconds, if COLD_AFTER is set, chooses data older than COLD_AFTER minutes and starts a
+    thread to move it into compressed cold segments
+    """
+    global compaction_running
+    if compaction_running:
+        return
+    selections = contacts.select_cold_data(maximum_items=config.getint('cold_batch_size', 100000))
+    if selections:
+        compaction_running = True
+        function_to_run_in_thread = deferred_function(lambda: contacts.compact_cold_data(selections))
+        deferred = deferToThread(function_to_run_in_thread)
+        deferred.addCallback(compact_cold_data_success)
+        deferred.addErrback(compact_cold_data_failure)
+    return
+
+
+def write_route_profiles_failure(failure):
+    logger.failure("Logging an uncaught exception", failure=failure)
+    return
+
+
+def write_route_profiles():
+    """
+    Called every PROFILE_WRITE_PERIOD seconds if PROFILE_ROUTES is set, copies the stats of routes profiled since last
+    called on the reactor, where they are collected, and writes them in a thread
+    """
+    collected = route_profiler.collect()
+    if collected:
+        deferred = deferToThread(deferred_function(lambda: route_profiler.write(collected)))
+        deferred.addErrback(write_route_profiles_failure)
+    return
+
+
+primary_file_path = '%s/.primary' % config['directory']
+# The last sequence number applied from the primary's change log
+try:
+    primary_state = json.load(open(primary_file_path))
+    if primary_state.get('url') != primary_url:
+        primary_state = {'url': primary_url, 'last': 0}
+except (json.JSONDecodeError, FileNotFoundError):
+    primary_state = {'url': primary_url, 'last': 0}
+# True while a request to the primary is outstanding, so only one runs at once
+tailing = False
+
+
+def tail_primary_body(body):
+    deferred = deferToThread(deferred_function(lambda: json.loads(body)))  # Pages can be large, decode off the reactor
+    deferred.addCallback(tail_primary_data)
+    return deferred
+
+
+def tail_primary_data(data):
+    """
+    Apply a page of the primary's change log on the reactor thread, as every other write to the dicts is, in batches of
+    REPLICA_APPLY_BATCH_SIZE so requests are served between them
+    """
+    changes = data.get('changes', [])
+    if changes and changes[0]['seq'] != primary_state['last'] + 1:
+        logger.error('missed changes {first} to {last} from primary, they are no longer in its change log',
+                     first=primary_state['last'] + 1, last=changes[0]['seq'] - 1)
+    batch_size = config.getint('replica_apply_batch_size', 100)
+    applied = []
+
+    def apply_batches():
+        for i in range(0, len(changes), batch_size):
+            applied.append(contacts.apply_replicated_changes(changes[i:i + batch_size]))
+            yield
+
+    deferred = task.cooperate(apply_batches()).whenDone()
+    deferred.addCallback(lambda _: tail_primary_applied(sum(applied), data))
+    return deferred
+
+
+def tail_primary_applied(applied, data):
+    global tailing
+    tailing = False
+    if applied:
+        logger.info('applied {applied} changes from primary', applied=applied)
+    primary_state['last'] = data['last']
+    write_json_atomically(primary_file_path, primary_state)
+    if data['more_data']:
+        tail_primary()
+    return
+
+
+def tail_primary_error(failure):
+    global tailing
+    tailing = False
+    logger.error("Error in tailing primary '{value}'", value=failure.value)
+    return
+
+
+def tail_primary():
+    """
+    In a replica, fetch and apply the next page of the primary's change log
+    """
+    global tailing
+    if tailing:
+        return
+    tailing = True
+    url = '%s/changes?after=%d' % (primary_url, primary_state['last'])
+    deferred = Agent(reactor).request(b'GET', url.encode(), Headers({'X-Self-String': [self_string]}), None)
+    deferred.addCallback(readBody)
+    deferred.addCallback(tail_primary_body)
+    deferred.addErrback(tail_primary_error)
+    return
+
+
+def apply_changes():
+    applied = contacts.apply_changes()
+    if applied:
+        logger.info('applied {applied} changes from writer', applied=applied)
+    return
+
+
+if (0 != len(servers)) and not read_only and not primary_url:
     l1 = task.LoopingCall(get_data_from_neighbors)
     l1.start(float(config.get('neighbor_sync_period', 600.0)))
 
+# In a read worker this only drops expired data from memory, the writer deletes the files
 l2 = task.LoopingCall(delete_expired_data)
-l2.start(24*60*60)
+l2.start(float(config.get('expiry_period', 1.0)))
+
+if read_only:
+    l3 = task.LoopingCall(apply_changes)
+    l3.start(float(config.get('change_log_poll_period', 0.5)))
+elif primary_url:
+    l4 = task.LoopingCall(tail_primary)
+    l4.start(float(config.get('replica_poll_period', 1.0)))
+
+if config.getfloat('cold_after', 0) and not read_only:
+    l5 = task.LoopingCall(compact_cold_data)
+    l5.start(float(config.get('cold_period', 600.0)))
 
-site = twserver.Site(Simple())
+if route_profiler.profiles:
+    l6 = task.LoopingCall(write_route_profiles)
+    l6.start(float(config.get('profile_write_period', 60.0)), now=False)
+    atexit.register(lambda: route_profiler.write(route_profiler.collect()))
+
+
+class Site(twserver.Site):
+    """
+    Writes the access log to ACCESS_LOG_FILE_PATH in batches from a background thread, without it access log lines go to
+    the main log and are only built if it is at info level or below
+    """
+
+    def _openLogFile(self, path):
+        return BatchedLogFile(path, flush_seconds=config.getfloat('access_log_flush_seconds', 1.0),
+                              rotate_length=config.getint('access_log_rotate_bytes', 10000000),
+                              max_rotated_files=config.getint('access_log_max_files', 10))
+
+    def log(self, request):
+        if self.logPath or log_level_enabled(LogLevel.info):
+            super().log(request)
+        return
+
+
+access_log_file_path = config.get('access_log_file_path')
+if access_log_file_path and read_only:
+    access_log_file_path = '%s.%d' % (access_log_file_path, os.getpid())  # Each read worker rotates its own file
+site = Site(Simple(), logPath=access_log_file_path)
 
 ON_HEROKU = os.environ.get('ON_HEROKU')
 
@@ -325,12 +742,55 @@ if ON_HEROKU:
 else:
     port = int(config.get('port', 8080))
 
-reactor.listenTCP(port, site)
+
+def listen_reuse_port(port_number, factory):
+    """
+    Listen with SO_REUSEPORT so that all the read workers share port_number, and the kernel spreads connections over them
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('', port_number))
+    sock.listen(50)
+    sock.setblocking(False)
+    listening_port = reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    sock.close()  # adoptStreamPort has its own copy
+    return listening_port
+
+
+reader_processes = []
+
+
+def stop_readers():
+    for process in reader_processes:
+        process.terminate()
+    return
+
+
+if read_only:
+    listen_reuse_port(port, site)
+elif workers:
+    # This process is the writer, it listens privately for requests forwarded from the readers, which share the port
+    writer_port = reactor.listenTCP(0, site, interface='127.0.0.1')
+    writer_url = 'http://127.0.0.1:%d' % writer_port.getHost().port
+    reader_args = [sys.executable, sys.argv[0], '--config_file', parsed_args.config_file, '--role', 'reader', '--writer_url', writer_url]
+    if parsed_args.log_level:
+        reader_args += ['--log_level', parsed_args.log_level]
+    for i in range(workers):
+        reader_processes.append(subprocess.Popen(reader_args))
+    reactor.addSystemEventTrigger('before', 'shutdown', stop_readers)
+    logger.info('started {workers} read workers, writer at {writer_url}', workers=workers, writer_url=writer_url)
+else:
+    reactor.listenTCP(port, site)
 
 # gack, we can't reset this... we will try at another time
 # l = task.LoopingCall(reset_log_file)
 # l.start(10, now = False)
 
+contacts.startup_statistics['phases'] = {name: round(seconds, 3) for name, seconds in startup_timer.phases.items()}
+contacts.startup_statistics['seconds'] = round(startup_timer.total(), 3)
+logger.warn('Startup took {seconds} seconds: {phases}', **contacts.startup_statistics)
+
 # This is intentionally at warn level to allow when debugging to wait for it to be ready
 logger.warn('Server alive and listening on port %s' % port)
 reactor.run()
@@ -0,0 +1,172 @@
+import argparse
+import configparser
+import json
+import os
+import tarfile
+import time
+from tempfile import TemporaryDirectory
+
+from contacts import ColdStore, FSBackedThreeLevelDict
+from lib import iso_time_from_seconds_since_epoch, write_json_atomically
+
+# Copies the data of a node to a new one, instead of the new node pulling everything from 1970 through /sync.
+#
+# python snapshot.py export --config_file config.ini --source http://node-a:8080 snapshot.tar
+# python snapshot.py import --config_file new_config.ini snapshot.tar
+#
+# export can run beside the server, it only reads DIRECTORY (and DATA_DIRECTORIES). It takes everything stored before
+# a time a little earlier than it started, and writes it, in time order, as the compressed cold segments of each dict
+# with their index of keys and update tokens, so the new node loads it as quickly as data it had compacted itself.
+# import puts the segments in the .cold directories of an empty DIRECTORY, and writes .servers so the new node syncs
+# from --source from that time on, and from the neighbours they share from where the source had got to.
+
+dict_names = ['contact_dict', 'spatial_dict', 'updates_dict']
+synced_dict_names = ['contact_dict', 'spatial_dict']  # /sync sends these, and the receiver adds itself to their path
+
+parser = argparse.ArgumentParser(description='Export the data of a bct server, or import it into a new one.')
+sub_parsers = parser.add_subparsers(dest='command', required=True)
+export_parser = sub_parsers.add_parser('export', help='write the data in DIRECTORY to an archive')
+export_parser.add_argument('--config_file', default='config.ini', help='config file of the server to export')
+export_parser.add_argument('--source', required=True, help='url the new server syncs from, as in its SERVERS')
+export_parser.add_argument('--margin', type=float, default=10, help='seconds before now to take the snapshot at, '
+                                                                    'so data still being written is left to /sync')
+export_parser.add_argument('--segment_items', type=int, default=100000, help='most items in each segment')
+export_parser.add_argument('output', help='archive file to write')
+import_parser = sub_parsers.add_parser('import', help='load an archive into an empty DIRECTORY')
+import_parser.add_argument('--config_file', default='config.ini', help='config file of the new server')
+import_parser.add_argument('--source', help='url to sync from after the snapshot, by default the one given to export')
+import_parser.add_argument('archive', help='archive file written by export')
+
+
+def get_dict_directories(config, name):
+    """
+    returns [directory of dict name on each volume], the first holds its .cold segments
+    """
+    volumes = [volume.strip() for volume in config.get('data_directories', '').split(',') if volume.strip()]
+    return ['%s/%s' % (volume, name) for volume in volumes or [config['directory']]]
+
+
+def _list_files(directories, until):
+    """
+    returns { (floating_seconds, serial_number): (key, full path) } of the item files from before until
+    """
+    files = {}
+    for directory in directories:
+        for root, sub_dirs, file_names in os.walk(directory):
+            sub_dirs[:] = [sub_dir for sub_dir in sub_dirs if '.cold' != sub_dir]
+            for file_name in file_names:
+                if file_name.endswith('.data'):
+                    key, floating_seconds_and_serial_number = FSBackedThreeLevelDict._get_parts_from_file_name(file_name)
+                    if floating_seconds_and_serial_number[0] < until:
+                        files[floating_seconds_and_serial_number] = (key, '/'.join([root, file_name]))
+    return files
+
+
+def _read_items(directories, until, source, append_path):
+    """
+    returns iter [(key, (floating_seconds, serial_number), update_token, blob)] in time order of the items from before
+    until in the dict stored in directories
+    The files are listed before the segments, a file compact_cold removes after it was listed is then in a segment
+    """
+    items = _list_files(directories, until)
+    cold_store = ColdStore(directories[0] + '/.cold', read_only=True)
+    for key, floating_seconds_and_serial_number, update_token in cold_store.load():
+        if floating_seconds_and_serial_number[0] < until:
+            items.setdefault(floating_seconds_and_serial_number, (key, None))
+    for floating_seconds_and_serial_number in sorted(items):
+        key, full_path = items[floating_seconds_and_serial_number]
+        blob = None
+        if full_path:
+            try:
+                with open(full_path) as file:
+                    blob = json.load(file)
+            except FileNotFoundError:  # Compacted or expired since listed
+                cold_store.refresh()
+            except json.JSONDecodeError:
+                continue  # As _load does, leave it for diagnosis
+        if blob is None:
+            blob = cold_store.get(floating_seconds_and_serial_number)
+            if blob is None:
+                continue  # Expired since listed
+        if append_path:
+            blob['path'] = (blob.get('path') or []) + [source]
+        yield key, floating_seconds_and_serial_number, blob.get('update_token'), blob
+    return
+
+
+def export_snapshot(config, source, output, margin=10, segment_items=100000):
+    """
+    Write the data of the server with config to the archive output
+    returns the description of the snapshot, as stored in it as snapshot.json
+    """
+    try:  # Read before the data, so everything synced from a neighbour up to its cursor is in the data
+        with open('%s/.servers' % config['directory']) as file:
+            servers = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        servers = {}
+    until = int(time.time() - margin)  # Whole seconds, so the ISO time /sync is given is exact
+    description = {'until': iso_time_from_seconds_since_epoch(until), 'source': source, 'servers': servers, 'items': {}}
+    with TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output))) as tmp_dir_name:
+        for name in dict_names:
+            cold_store = ColdStore('%s/%s/.cold' % (tmp_dir_name, name), config.getint('cold_block_size', 256),
+                                   config.get('cold_compression', 'zlib'))
+            count = 0
+            segment = []
+            for item in _read_items(get_dict_directories(config, name), until, source, name in synced_dict_names):
+                segment.append(item)
+                if len(segment) >= segment_items:
+                    cold_store.write(segment)
+                    count += len(segment)
+                    segment = []
+            if segment:
+                cold_store.write(segment)
+                count += len(segment)
+            description['items'][name] = count
+        write_json_atomically('%s/snapshot.json' % tmp_dir_name, description)
+        with tarfile.open(output + '.tmp', 'w') as archive:  # The segments are already compressed
+            for file_name in sorted(os.listdir(tmp_dir_name)):
+                archive.add('%s/%s' % (tmp_dir_name, file_name), file_name)
+        os.replace(output + '.tmp', output)
+    return description
+
+
+def import_snapshot(config, archive_file_path, source=None):
+    """
+    Load the archive written by export_snapshot into the empty DIRECTORY of the server with config, and set the
+    cursors of its SERVERS to match
+    returns the description of the snapshot
+    """
+    servers_file_path = '%s/.servers' % config['directory']
+    for directory in [servers_file_path] + [directory for name in dict_names for directory in get_dict_directories(config, name)]:
+        if os.path.exists(directory) and ((not os.path.isdir(directory)) or os.listdir(directory)):
+            raise ValueError('%s already has data, only import into an empty DIRECTORY' % directory)
+    with tarfile.open(archive_file_path) as archive:
+        description = json.load(archive.extractfile('snapshot.json'))
+        for member in archive.getmembers():
+            parts = member.name.split('/')
+            if member.isfile() and (3 == len(parts)) and (parts[0] in dict_names) and ('.cold' == parts[1]):
+                directory = '%s/.cold' % get_dict_directories(config, parts[0])[0]
+                os.makedirs(directory, 0o770, exist_ok=True)
+                with open('%s/%s' % (directory, parts[2]), 'wb') as file:
+                    file.write(archive.extractfile(member).read())
+    source = (source or description['source']).rstrip('/')
+    servers = {}
+    for server in (config.get('servers') or '').split(','):
+        if server:
+            servers[server] = description['until'] if source == server.rstrip('/') else description['servers'].get(server)
+    write_json_atomically(servers_file_path, {server: since for server, since in servers.items() if since})
+    return description
+
+
+if __name__ == '__main__':
+    parsed_args = parser.parse_args()
+    config_top = configparser.ConfigParser()
+    config_top.read(parsed_args.config_file)
+    start = time.time()
+    if 'export' == parsed_args.command:
+        snapshot = export_snapshot(config_top['DEFAULT'], parsed_args.source, parsed_args.output, parsed_args.margin,
+                                   parsed_args.segment_items)
+    else:
+        snapshot = import_snapshot(config_top['DEFAULT'], parsed_args.archive, parsed_args.source)
+    print('%s of data until %s from %s took %.1f seconds: %s' % (parsed_args.command, snapshot['until'], snapshot['source'],
+                                                                time.time() - start, json.dumps(snapshot['items'])))
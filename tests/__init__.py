@@ -33,6 +33,11 @@ class Server:
         logger.info('after sync call')
         return req
 
+    def changes(self, after=0):
+        resp = requests.get(self.url + '/changes', params={'after': after})
+        assert resp.status_code == 200
+        return resp.json()
+
     def _status(self, endpoint_name, seed, contacts, locations, **kwargs):
         # contacts and locations should already have update_tokens if want that functionality
         # logger.info('before %s call' % endpoint_name)
@@ -157,7 +162,7 @@ def get_free_port():
 
 # this can be run as a primary server or a secondary one syncing from a primary one
 #
-def run_server(server=None, server_urls=None, port=None):
+def run_server(server=None, server_urls=None, port=None, workers=0, primary=None, data_directories=0, extra_config=None):
     if server:
         yield Server(server, None, None)
         return
@@ -167,13 +172,19 @@ def run_server(server=None, server_urls=None, port=None):
         logger.info('created temporary directory %s' % tmp_dir_name)
         config_file_path = tmp_dir_name + '/config.ini'
         log_file_path = tmp_dir_name + '/log.txt'
-        config_data = '[DEFAULT]\nDIRECTORY = %s\nLOG_LEVEL = INFO\nPORT = %d\nTesting = True\n"BOUNDING_BOX_MINIMUM_DP = 2\nBOUNDING_BOX_MAXIMUM_SIZE = 0.001\nLOCATION_RESOLUTION = 4\nLOG_FILE_PATH = %s\n' % (
+        config_data = '[DEFAULT]\nDIRECTORY = %s\nLOG_LEVEL = INFO\nPORT = %d\nTesting = True\n"BOUNDING_BOX_MINIMUM_DP = 2\nBOUNDING_BOX_MAXIMUM_SIZE = 0.001\nLOCATION_RESOLUTION = 4\nLOG_FILE_PATH = %s\nSERVER_TIMING = True\nALLOW_PROFILING = True\n' % (
             tmp_dir_name, port, log_file_path)
         if server_urls:
             config_data += 'SERVERS = %s\nNEIGHBOR_SYNC_PERIOD = 1\n' % server_urls
+        if primary:
+            config_data += 'PRIMARY = %s\nREPLICA_POLL_PERIOD = 0.2\n' % primary
+        if data_directories:
+            config_data += 'DATA_DIRECTORIES = %s\n' % ', '.join('%s/volume%d' % (tmp_dir_name, i) for i in range(data_directories))
+        for key, value in (extra_config or {}).items():
+            config_data += '%s = %s\n' % (key, value)
         # config_data += '[APPS]\nTESTING_VERSION = 2.0\n'
         open(config_file_path, 'w').write(config_data)
-        with Popen([python, 'server.py', '--config_file', config_file_path]) as proc:
+        with Popen([python, 'server.py', '--config_file', config_file_path, '--workers', str(workers)]) as proc:
             logger.info('waiting for server to startup')
             # let's give the server some time to start
             # Note 2.0 was too short
@@ -193,8 +204,48 @@ def run_server(server=None, server_urls=None, port=None):
 
 
 @contextmanager
-def run_server_in_context(server_urls=None, port=None):
-    yield from run_server(server_urls=server_urls, port=port)
+def run_server_in_context(server_urls=None, port=None, workers=0, primary=None, data_directories=0, extra_config=None):
+    yield from run_server(server_urls=server_urls, port=port, workers=workers, primary=primary, data_directories=data_directories,
+                          extra_config=extra_config)
+
+
+@contextmanager
+def run_router_in_context(shards, extra_config=None):
+    """
+    shards: [(Server, CONTACT_RANGE [SPATIAL_RANGE])] e.g. [(server1, '00-7F'), (server2, '80-FF')], spatial ranges default to the same
+    """
+    port = get_free_port()
+    with TemporaryDirectory() as tmp_dir_name:
+        config_file_path = tmp_dir_name + '/router_config.ini'
+        log_file_path = tmp_dir_name + '/log.txt'
+        config_data = '[DEFAULT]\nLOG_LEVEL = INFO\nPORT = %d\nTesting = True\nBOUNDING_BOX_MINIMUM_DP = 2\nLOG_FILE_PATH = %s\nSHARDS = %s\n' % (
+            port, log_file_path, ', '.join('%s %s' % (shard.url, contact_range) for shard, contact_range in shards))
+        for key, value in (extra_config or {}).items():
+            config_data += '%s = %s\n' % (key, value)
+        open(config_file_path, 'w').write(config_data)
+        with Popen([python, 'router.py', '--config_file', config_file_path]) as proc:
+            logger.info('waiting for router to startup')
+            time.sleep(2.0)
+            url = 'http://localhost:%s' % port
+            yield Server(url, None, None)
+            proc.terminate()
+            for line in open(log_file_path).readlines():
+                line = line.replace('\n', '')
+                logger.info('%s output: %s' % (url, line))
+    return
+
+
+def wait_until(condition, timeout=10.0, interval=0.1):
+    """
+    Poll condition() until it is true, e.g. for read workers or replicas to catch up
+    returns the last value of condition()
+    """
+    deadline = time.time() + timeout
+    while True:
+        value = condition()
+        if value or time.time() > deadline:
+            return value
+        time.sleep(interval)
 
 
 def sort_list_of_dictionaries(input_list):
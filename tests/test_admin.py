@@ -1,3 +1,13 @@
+import os
+import pstats
+import time
+from tempfile import TemporaryDirectory
+
+import requests
+
+from profiler import RouteProfiler
+
+
 # noinspection PyUnusedLocal
 def test_admin_config(server, data):
     server.reset()
@@ -14,4 +24,58 @@ def test_admin_status(server, data):
     resp = server.admin_status()
     assert resp.status_code == 200
     assert resp.json().get('contacts_count') == 1
+    assert resp.json().get('expiry_backlog') == 0
+    assert resp.json().get('expiry_pending_deletion') == 0
+    startup = resp.json().get('startup')
+    assert set(startup['phases']) == {'config', 'log', 'load', 'servers'}
+    assert set(startup['dicts']) == {'contact_dict', 'spatial_dict', 'updates_dict'}
+    assert startup['dicts']['contact_dict']['json_errors'] == 0
+    return
+
+
+def test_admin_metrics(server, data):
+    server.reset()
+    server.send_status_json(contacts=[{'id': data.valid_ids[0]}])
+    server.scan_status_json(contact_prefixes=[data.valid_ids[0][0:3]], since="2007-04-05T14:30Z")
+    resp = requests.get(server.url + '/admin/metrics')
+    assert resp.status_code == 200
+    assert resp.headers['content-type'].startswith('text/plain')
+    assert 'bct_requests_total{route="/status/scan:POST",code="200"}' in resp.text
+    assert 'bct_request_duration_seconds_count{route="/status/send:POST"}' in resp.text
+    assert 'bct_index_items{dict="contact_dict"} 1' in resp.text
+    assert 'bct_thread_pool_queue_depth 0' in resp.text  # The scan's work has run
+    return
+
+
+def test_admin_profile(server, data):
+    server.reset()
+    resp = requests.get(server.url + '/admin/profile', params={'seconds': 0.5})
+    assert resp.status_code == 200
+    file_path = resp.json()['file_path']
+    time.sleep(1.5)
+    stacks = open(file_path).read()
+    # The reactor waiting for requests is always sampled
+    assert 'MainThread;' in stacks
+    return
+
+
+def test_admin_profile_bad_seconds(server, data):
+    for seconds in ['abc', '0', '-1', 'nan']:
+        resp = requests.get(server.url + '/admin/profile', params={'seconds': seconds})
+        assert resp.status_code == 400
+        assert resp.json()['error']
+    return
+
+
+def test_route_profiler():
+    with TemporaryDirectory() as directory:
+        route_profiler = RouteProfiler(directory, ['/status/scan:POST'], sample_every=2)
+        assert [route_profiler.should_profile('/status/scan:POST') for i in range(4)] == [False, True, False, True]
+        assert route_profiler.profile('/status/scan:POST', sorted, [2, 1]) == [1, 2]
+        assert not os.listdir(directory)  # Nothing written while serving
+        collected = route_profiler.collect()
+        assert route_profiler.collect() == []
+        route_profiler.write(collected)
+        stats = pstats.Stats('%s/status_scan_POST.pstats' % directory)
+        assert any('sorted' in function_name for file_name, line, function_name in stats.stats)
     return
@@ -0,0 +1,22 @@
+from tempfile import TemporaryDirectory
+
+from contacts import ColdStore
+
+
+def test_cold_store():
+    with TemporaryDirectory() as directory:
+        cold_store = ColdStore(directory + '/.cold', block_size=3, compression='lzma')
+        items = [('key%d' % i, (1600000000.0 + i, i), 'token%d' % i, {'id': 'key%d' % i}) for i in range(10)]
+        cold_store.write(items[:6])
+        cold_store.write(items[6:])
+        assert cold_store.get((1600000004.0, 4)) == {'id': 'key4'}
+        assert cold_store.get((1600000004.5, 4)) is None
+        assert cold_store.last() == (1600000009.0, 9)
+
+        reloaded = ColdStore(directory + '/.cold')  # The compression of each segment is in its index
+        assert [item[0] for item in reloaded.load()] == ['key%d' % i for i in range(10)]
+        assert reloaded.get((1600000008.0, 8)) == {'id': 'key8'}
+        assert 1 == reloaded.drop_before((1600000007.0, 7))
+        assert reloaded.get((1600000002.0, 2)) is None
+        assert reloaded.get((1600000007.0, 7)) == {'id': 'key7'}
+    return
@@ -0,0 +1,221 @@
+import configparser
+import os
+import time
+from itertools import count
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from contacts import ChangeLog, ChangeLogFollower, Contacts, UpdateTokenIndex, _good_dates
+from lib import get_update_token, get_update_token_ints, get_update_tokens, get_replacement_token, new_seed
+
+
+def make_contacts(directory, **config):
+    config_top = configparser.ConfigParser()
+    config_top['DEFAULT'] = dict({'directory': directory, 'expire_data': 100000}, **config)
+    return Contacts(config_top)
+
+
+def test_good_dates():
+    times = [(1.0, 0), (2.0, 0), (2.0, 1), (3.0, 0)]
+    assert list(_good_dates(times, 2.0, 3.0)) == [(2.0, 0), (2.0, 1)]
+    assert list(_good_dates(times)) == times
+    assert list(_good_dates(times, 4.0)) == []
+    return
+
+
+def test_sort_and_truncate():
+    with TemporaryDirectory() as directory:
+        contacts = make_contacts(directory)
+        contact_times = iter([(1.0, 0), (3.0, 0), (3.0, 2), (6.0, 0)])
+        location_times = iter([(2.0, 0), (3.0, 1), (5.0, 0)])
+        assert contacts._sort_and_truncate(5, contact_times, location_times) == (
+            [(1.0, 0), (3.0, 0), (3.0, 2)], [(2.0, 0), (3.0, 1)], 5.0)
+        assert contacts._sort_and_truncate(5, iter([(1.0, 0)]), iter([])) == ([(1.0, 0)], [], None)
+        # Lazy, so it only takes what it needs from endless iterators
+        endless = ((float(i), 0) for i in count())
+        assert contacts._sort_and_truncate(2, endless, iter([(0.5, 0)])) == ([(0.0, 0)], [(0.5, 0)], 1.0)
+    return
+
+
+def test_update_token_index():
+    index = UpdateTokenIndex(merge_size=4)
+    owner = index.register('contact_dict')
+    other_owner = index.register('spatial_dict')
+    seed = new_seed()
+    tokens = [get_update_token(get_replacement_token(seed, i)) for i in range(10)]
+    for i, token in enumerate(tokens):
+        index.add(owner, token, (1000.0 + i, i))
+    index.add(other_owner, tokens[0], (2000.0, 0))  # The same token in another dict is a separate entry
+    assert len(index.recent) < 10  # Some have been merged into the arrays
+    index.merge()
+    assert not index.recent
+    assert [index.get(owner, token) for token in tokens] == [(1000.0 + i, i) for i in range(10)]
+    assert index.get(other_owner, tokens[0]) == (2000.0, 0)
+    assert index.get(other_owner, tokens[1]) is None
+
+    index.add(owner, tokens[3], (3000.0, 0))  # Added again, the older entry is dropped at the merge
+    index.merge()
+    assert index.get(owner, tokens[3]) == (3000.0, 0)
+    assert len(index.arrays[0]) == 11
+
+    # Tokens not in the form get_update_token makes are kept as strings
+    for token in ['not-hex', '00AB', 'ab', '1' * 21]:
+        index.add(owner, token, (1004.0, 1))
+        assert index.get(owner, token) == (1004.0, 1)
+    assert 4 == len(index.other)
+
+    index.expire_before(owner, 1005.0)  # Left out as soon as expired, dropped at the next merge
+    assert index.get(owner, tokens[0]) is None
+    assert index.get_many(owner, tokens[0:4]) == [None, None, None, (3000.0, 0)]
+    index.merge()
+    assert [index.get(owner, token) is None for token in tokens] == [True, True, True, False, True] + [False] * 5
+    assert index.get(other_owner, tokens[0]) == (2000.0, 0)
+    assert not index.other
+    assert len(index) == 7
+    return
+
+
+def test_update_token_index_get_many():
+    index = UpdateTokenIndex(merge_size=1000)
+    owner = index.register('contact_dict')
+    other_owner = index.register('spatial_dict')
+    seed = new_seed()
+    token_ints = get_update_token_ints(seed, 20)
+    tokens = get_update_tokens(seed, 20)
+    for i in range(0, 10):
+        index.add(owner, tokens[i], (1000.0 + i, i))
+    index.merge()
+    for i in range(10, 15):  # Left in recent
+        index.add(owner, tokens[i], (1000.0 + i, i))
+    index.add(other_owner, tokens[15], (2000.0, 0))
+    index.add(owner, 'not-hex', (3000.0, 0))
+    probe = list(reversed(tokens)) + ['not-hex', None, '']
+    expected = [index.get(owner, token) for token in probe]
+    assert expected == [None] * 5 + [(1000.0 + i, i) for i in reversed(range(15))] + [(3000.0, 0), None, None]
+    assert index.get_many(owner, probe) == expected
+    assert index.get_many(owner, list(reversed(token_ints))) == expected[0:20]
+    assert index.get_many(owner, []) == []
+    return
+
+
+def test_update_token_index_remove():
+    index = UpdateTokenIndex(merge_size=4)
+    owner = index.register('updates_dict')
+    tokens = get_update_tokens(new_seed(), 12)
+    for i, token in enumerate(tokens):
+        index.add(owner, token, (1000.0 + i, i))
+        if 9 == i:
+            index.merge()  # The rest stay in recent
+    index.add(owner, 'not-hex', (2000.0, 0))
+    assert (len(index.arrays[0]), len(index.recent)) == (10, 2)
+    index.remove(owner, tokens[-1], (1000.0 + 11, 11))  # From recent
+    index.remove(owner, tokens[0], (1000.0, 0))  # From the arrays
+    index.remove(owner, tokens[1], (1.0, 0))  # Not its item, so kept
+    index.remove(owner, 'not-hex', (2000.0, 0))
+    assert len(index) == 10
+    assert [index.get(owner, token) is None for token in tokens] == [True] + [False] * 10 + [True]
+    for i in range(2, 6):  # Enough of the arrays deleted to merge them again
+        index.remove(owner, tokens[i], (1000.0 + i, i))
+    assert 0 == index.deleted_count
+    assert (len(index.arrays[0]), len(index.recent)) == (6, 0)  # The merge took in recent too
+    return
+
+
+def test_update_token_index_remove_item():
+    index = UpdateTokenIndex(merge_size=4)
+    owner = index.register('contact_dict')
+    tokens = get_update_tokens(new_seed(), 10)
+    for i, token in enumerate(tokens):
+        index.add(owner, token, (1000.0 + i, i))
+    index.merge()
+    index.remove_item(owner, (1003.0, 3))  # Its token isn't known
+    assert index.get(owner, tokens[3]) is None
+    assert index.get_many(owner, tokens[2:5]) == [(1002.0, 2), None, (1004.0, 4)]
+    for i in range(4, 7):  # Merged once more than merge_size are deleted
+        index.remove_item(owner, (1000.0 + i, i))
+    assert len(index.removed) == 4
+    index.expire_before(owner, 1002.0, 2)
+    assert not index.removed
+    assert len(index) == len(index.arrays[0]) == 4
+    assert [index.get(owner, token) is not None for token in tokens] == [False, False, True] + [False] * 4 + [True] * 3
+    return
+
+
+def test_updates_dict_delete():
+    with TemporaryDirectory() as directory:
+        contacts = make_contacts(directory)
+        seed = new_seed()
+        tokens = get_update_tokens(seed, 2)
+        contacts.unused_update_tokens.insert(tokens[0], {'status': 1, 'update_token': tokens[1]}, (time.time(), 0))
+        assert 1 == len(contacts.update_token_index)
+        assert [blob['status'] for blob in contacts.unused_update_tokens[tokens[0]]] == [1]
+        del contacts.unused_update_tokens[tokens[0]]
+        assert 0 == len(contacts.update_token_index)
+        assert contacts.unused_update_tokens.get_file_path_from_update_token(tokens[1]) is None
+    return
+
+
+def test_update_token_index_shared():
+    with TemporaryDirectory() as directory:
+        contacts = make_contacts(directory)
+        the_dicts = [contacts.contact_dict, contacts.spatial_dict, contacts.unused_update_tokens]
+        assert all(the_dict.update_token_index is contacts.update_token_index for the_dict in the_dicts)
+        assert 3 == len(set(the_dict.update_token_owner for the_dict in the_dicts))
+        contacts.send_or_sync({'contact_ids': [{'id': '123456', 'update_token': 'AB12'}],
+                               'locations': [{'lat': 37.7, 'long': -122.4, 'update_token': 'CD34'}]})
+        assert 2 == len(contacts.update_token_index)
+        assert contacts.contact_dict.get_file_path_from_update_token('AB12').startswith('12/34/56/123456:')
+        assert contacts.spatial_dict.get_file_path_from_update_token('CD34')
+        assert contacts.contact_dict.get_file_path_from_update_token('CD34') is None
+    return
+
+
+def test_change_log_index():
+    with TemporaryDirectory() as directory:
+        change_log = ChangeLog(directory, segment_size=25, index_interval=10)
+        for i in range(60):
+            change_log.append('contact_dict', 'key%d' % i, (float(i), 0), None)
+        assert change_log.segments() == [1, 26, 51]
+        with open(change_log.index_path(26)) as index:
+            assert [int(line.split()[0]) for line in index] == [36, 46]
+        assert change_log.checkpoint(26, 45) == change_log.checkpoint(26, 36)
+        assert change_log.checkpoint(26, 35) == (26, 0)
+        for after in range(60):
+            follower = ChangeLogFollower(change_log)
+            follower.start_after(after)
+            assert [(seq, entry[1]) for seq, entry in follower.read_new()] == [(seq, 'key%d' % (seq - 1)) for seq in range(after + 1, 61)]
+        follower = ChangeLogFollower(change_log)
+        follower.start_at_end()
+        change_log.append('contact_dict', 'key60', (60.0, 0), None)
+        assert [seq for seq, entry in follower.read_new()] == [61]
+        # Picks up the index where it left off after a restart
+        change_log = ChangeLog(directory, segment_size=25, index_interval=10)
+        for i in range(61, 75):
+            change_log.append('contact_dict', 'key%d' % i, (float(i), 0), None)
+        with open(change_log.index_path(51)) as index:
+            assert [int(line.split()[0]) for line in index] == [61, 71]
+        follower = ChangeLogFollower(change_log)
+        follower.start_after(72)
+        assert [seq for seq, entry in follower.read_new()] == [73, 74, 75]
+    return
+
+
+def test_volumes_can_not_change():
+    with TemporaryDirectory() as directory:
+        volumes = ['%s/volume%d' % (directory, i) for i in range(3)]
+        contacts = make_contacts(directory, data_directories=', '.join(volumes[0:2]))
+        for i in range(0, 256, 16):
+            contacts.contact_dict.insert('%02X%02X56' % (i, i), {'id': '%02X%02X56' % (i, i)}, (float(i), 0))
+        assert len(make_contacts(directory, data_directories=', '.join(volumes[0:2])).contact_dict) == 16
+        with pytest.raises(ValueError):
+            make_contacts(directory, data_directories=', '.join(volumes))
+        with pytest.raises(ValueError):
+            make_contacts(directory)
+        # Without the record, the files hashed to another volume by the new list are found
+        os.remove('%s/.volumes' % directory)
+        with pytest.raises(ValueError):
+            make_contacts(directory, data_directories=', '.join(volumes))
+        assert len(make_contacts(directory, data_directories=', '.join(volumes[0:2])).contact_dict) == 16
+        assert os.path.exists('%s/.volumes' % directory)
+    return
@@ -0,0 +1,26 @@
+import json
+import os
+from tempfile import TemporaryDirectory
+
+from lib import new_seed, get_update_token, get_replacement_token, get_replacement_and_update_tokens, get_update_tokens, \
+    get_update_token_ints, write_json_atomically
+
+
+def test_batch_token_chain():
+    seed = new_seed()
+    expected = [(get_replacement_token(seed, i), get_update_token(get_replacement_token(seed, i))) for i in range(5, 105)]
+    assert get_replacement_and_update_tokens(seed, 100, 5) == expected
+    assert get_update_tokens(seed, 100, 5) == [ut for rt, ut in expected]
+    assert get_update_tokens(seed, 0) == []
+    assert get_update_token_ints(seed, 100, 5) == [int(ut, 16) for rt, ut in expected]
+    return
+
+
+def test_write_json_atomically():
+    with TemporaryDirectory() as directory:
+        file_path = directory + '/blob.data'
+        write_json_atomically(file_path, {'id': '123456'})
+        write_json_atomically(file_path, {'id': '654321'})
+        assert json.load(open(file_path)) == {'id': '654321'}
+        assert os.listdir(directory) == ['blob.data']  # No temporary file left behind
+    return
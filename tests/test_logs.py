@@ -0,0 +1,40 @@
+import os
+import time
+from tempfile import TemporaryDirectory
+
+from twisted.logger import LogLevel
+from logs import LevelLogger, BatchedLogFile, set_log_level, set_log_payloads
+
+
+def test_level_logger():
+    events = []
+    logger = LevelLogger(observer=events.append)
+    try:
+        set_log_level('warn')
+        logger.info('dropped')
+        logger.warn('kept')
+        logger.payload('dropped {data}', data='payload')
+        set_log_level('info')
+        set_log_payloads(True)
+        logger.payload('kept {data}', data='payload')
+    finally:
+        set_log_level('debug')
+        set_log_payloads(False)
+    assert [(event['log_level'], event['log_format']) for event in events] == [
+        (LogLevel.warn, 'kept'), (LogLevel.info, 'kept {data}')]
+    return
+
+
+def test_batched_log_file():
+    with TemporaryDirectory() as directory:
+        path = directory + '/access_log.txt'
+        log_file = BatchedLogFile(path, flush_seconds=0.01, rotate_length=100, max_rotated_files=2)
+        for batch in range(4):  # Each batch is more than rotate_length, so each flush after the first rotates
+            for i in range(5):
+                log_file.write('line %d.%d of the access log\n' % (batch, i))
+            time.sleep(0.1)
+        log_file.close()
+        assert os.path.exists(path)
+        assert os.path.exists(path + '.1')
+        assert not os.path.exists(path + '.3')  # Only max_rotated_files are kept
+    return
@@ -0,0 +1,76 @@
+import requests
+
+from . import run_server_in_context, run_router_in_context
+
+
+def test_router(data):
+    low_id = '123456789'
+    high_id = '987654321'
+    # As in test_sync, assertions are checked after the with
+    with run_server_in_context() as shard_1:
+        with run_server_in_context() as shard_2:
+            with run_router_in_context([(shard_1, '00-7F'), (shard_2, '80-FF')]) as router:
+                router.send_status_json(contacts=[{"id": low_id}, {"id": high_id}], locations=data.locations_in, status=1)
+                scan_data = router.scan_status_json(contact_prefixes=[low_id[0:3], high_id[0:3]], since="2007-04-05T14:30Z")
+                location_data = router.scan_status_json(locations=[data.locations_box], since="2007-04-05T14:30Z")
+                sync_data = router.sync().json()
+                matches = [shard_1.get_data_from_id(low_id), shard_1.get_data_from_id(high_id),
+                           shard_2.get_data_from_id(low_id), shard_2.get_data_from_id(high_id)]
+    assert sorted(contact['id'] for contact in scan_data['contact_ids']) == [low_id, high_id]
+    assert [len(match) for match in matches] == [1, 0, 0, 1]
+    assert len(location_data['locations']) == 1
+    assert sorted(contact['id'] for contact in sync_data['contact_ids']) == [low_id, high_id]
+    assert len(sync_data['locations']) == 1
+    assert not sync_data['more_data']
+    return
+
+
+def test_router_sync_cached_page(data):
+    low_ids = ['1%05d' % i for i in range(2)]
+    high_ids = ['9%05d' % i for i in range(2)]
+    south_location = {"lat": -37.8, "long": 144.9}  # Spatial key 14..., data.locations_in is 31...
+    # As in test_sync, assertions are checked after the with
+    with run_server_in_context(extra_config={'MAX_SYNC_COUNT': 2}) as shard_1:
+        with run_server_in_context(extra_config={'MAX_SYNC_COUNT': 2}) as shard_2:
+            with run_router_in_context([(shard_1, '00-7F 00-1F'), (shard_2, '80-FF 20-FF')]) as router:
+                # Each at its own time, 3 on shard_2 then 3 on shard_1, so each has a page of 2 ending at its third
+                for contact_id in high_ids:
+                    router.send_status_json(contacts=[{"id": contact_id}])
+                router.send_status_json(locations=data.locations_in)
+                for contact_id in low_ids:
+                    router.send_status_json(contacts=[{"id": contact_id}])
+                router.send_status_json(locations=[south_location])
+                # shard_1 caches a page going past shard_2's until, it must not be the answer when asked again up to then
+                resp = requests.get(router.url + '/sync', timeout=10)
+    assert 200 == resp.status_code
+    sync_data = resp.json()
+    assert [contact['id'] for contact in sync_data['contact_ids']] == high_ids
+    assert sync_data['locations'] == []
+    assert sync_data['more_data']
+    return
+
+
+def test_router_merge_in_time_order(data):
+    low_ids = ['1%05d' % i for i in range(2)]
+    high_ids = ['9%05d' % i for i in range(2)]
+    # As in test_sync, assertions are checked after the with
+    with run_server_in_context(extra_config={'MAX_SYNC_COUNT': 2}) as shard_1:
+        with run_server_in_context(extra_config={'MAX_SYNC_COUNT': 2}) as shard_2:
+            with run_router_in_context([(shard_1, '00-7F 00-1F'), (shard_2, '80-FF 20-FF')], extra_config={'MAX_SYNC_COUNT': 2}) as router:
+                # Alternating between the shards, each at its own time, the location (spatial key 31...) is on shard_2
+                for high_id, low_id in zip(high_ids, low_ids):
+                    router.send_status_json(contacts=[{"id": high_id}])
+                    router.send_status_json(contacts=[{"id": low_id}])
+                router.send_status_json(locations=data.locations_in)
+                first_page = router.sync().json()
+                second_page = requests.get(router.url + '/sync', params={'since': first_page['until']}, timeout=10).json()
+                # Only shard_1 owns the prefix, but a scan without locations returns those on every shard
+                scan_data = router.scan_status_json(contact_prefixes=[low_ids[0][0:3]], since="2007-04-05T14:30Z")
+    assert [contact['id'] for contact in first_page['contact_ids']] == [high_ids[0], low_ids[0]]
+    assert first_page['locations'] == []
+    assert first_page['more_data']
+    assert [contact['id'] for contact in second_page['contact_ids']] == [high_ids[1], low_ids[1]]
+    assert second_page['more_data']
+    assert sorted(contact['id'] for contact in scan_data['contact_ids']) == low_ids
+    assert len(scan_data['locations']) == 1
+    return
@@ -1,5 +1,9 @@
 
 
+import os
+from . import run_server_in_context, wait_until
+
+
 def test_scan_status(server, data):
     server.reset()
     contact_id = data.valid_ids[0]
@@ -10,3 +14,41 @@ def test_scan_status(server, data):
     json_data = server.scan_status_json(contact_prefixes=[prefix], since="2007-04-05T14:30Z")
     assert json_data['contact_ids'] == expected
     return
+
+
+def test_scan_status_with_workers(data):
+    contact_id = data.valid_ids[0]
+    deleted_contact_id = '987654'
+    # As in test_sync, assertions are checked after the with
+    with run_server_in_context(workers=2) as server:
+        server.send_status_json(contacts=[{"id": contact_id}, {"id": deleted_contact_id}], status=2)
+
+        def scan(an_id):
+            resp = server._status('/status/scan', None, None, None, contact_prefixes=[an_id[0:3]], since="2007-04-05T14:30Z")
+            return resp.status_code, resp.json()['contact_ids'] if 200 == resp.status_code else None
+
+        # Several in a row, as each may go to either read worker
+        followed = wait_until(lambda: all(scan(contact_id)[1] for i in range(10)))
+        json_data = scan(contact_id)[1]
+        admin_status = server.admin_status().json()
+        # As if the writer deleted the file before the read workers expired it, the read workers skip and forget it
+        matches = [os.path.join(root, file_name) for root, dirs, file_names in os.walk(server.directory + '/contact_dict')
+                   for file_name in file_names if file_name.startswith(deleted_contact_id.upper())]
+        for file_path in matches:
+            os.remove(file_path)
+        deleted_scans = [scan(deleted_contact_id) for i in range(10)]
+    assert followed
+    assert json_data == [{'id': contact_id, 'status': 2}]
+    assert admin_status['contacts_count'] == 2
+    assert 1 == len(matches)
+    assert deleted_scans == [(200, [])] * 10
+    return
+
+
+def test_scan_status_server_timing(server, data):
+    server.reset()
+    server.send_status_json(contacts=[{"id": data.valid_ids[0]}], status=2)
+    resp = server._status('/status/scan', None, None, None, contact_prefixes=[data.valid_ids[0][0:3]], since="2007-04-05T14:30Z")
+    phases = [phase.split(';')[0] for phase in resp.headers['Server-Timing'].split(', ')]
+    assert phases == ['parse', 'index', 'route', 'blob_read', 'thread_wait', 'contact_ids', 'encode', 'total']
+    return
@@ -1,3 +1,7 @@
+import os
+from . import run_server_in_context
+
+
 def test_send_status(server, data):
     server.reset()
     contact_id = data.valid_ids[0]
@@ -39,3 +43,14 @@ def test_send_status_with_reset(server, data):
     server.reset(delete_files=False)
     # Now check it made it to the geo files
     server.send_status_json(locations=locations)
+
+
+def test_send_status_data_directories():
+    with run_server_in_context(data_directories=2) as server:
+        contacts = [{'id': '%02X%02X56' % (i, i)} for i in range(0, 256, 16)]
+        server.send_status_json(contacts=contacts)
+        resp = server.scan_status_json(contact_prefixes=[contact['id'][0:4] for contact in contacts], since='2007-04-05T14:30Z')
+        assert sorted(contact['id'] for contact in resp['contact_ids']) == sorted(contact['id'] for contact in contacts)
+        for i in range(2):  # Both volumes have some of the data
+            assert os.listdir('%s/volume%d/contact_dict' % (server.directory, i))
+    return
@@ -0,0 +1,42 @@
+import configparser
+import json
+import time
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from contacts import ContactDict
+from snapshot import export_snapshot, import_snapshot
+
+
+def get_config(directory, servers=''):
+    config_top = configparser.ConfigParser()
+    config_top.read_string('[DEFAULT]\nDIRECTORY = %s\nSERVERS = %s\n' % (directory, servers))
+    return config_top['DEFAULT']
+
+
+def test_export_import():
+    with TemporaryDirectory() as source_directory, TemporaryDirectory() as directory:
+        contact_dict = ContactDict(source_directory)
+        start = time.time() - 1000
+        for i in range(20):
+            contact_dict.insert(None, {'id': '%06X' % (i * 4099), 'update_token': 'token%d' % i}, (start + i, 0))
+        contact_dict.compact_cold(contact_dict.select_cold(start + 10, 100))  # Half in a cold segment, half in files
+        json.dump({'http://other:8080': '2020-06-01T00:00:00Z'}, open(source_directory + '/.servers', 'w'))
+
+        description = export_snapshot(get_config(source_directory), 'http://source:8080', directory + '/snapshot.tar')
+        assert description['items'] == {'contact_dict': 20, 'spatial_dict': 0, 'updates_dict': 0}
+        config = get_config(directory + '/data', 'http://source:8080,http://other:8080,http://new:8080')
+        import_snapshot(config, directory + '/snapshot.tar')
+        assert json.load(open(directory + '/data/.servers')) == {'http://source:8080': description['until'],
+                                                                 'http://other:8080': '2020-06-01T00:00:00Z'}
+        with pytest.raises(ValueError):
+            import_snapshot(config, directory + '/snapshot.tar')  # Only into an empty DIRECTORY
+
+        imported = ContactDict(directory + '/data')
+        assert imported.load_statistics['cold_items'] == 20
+        file_paths = [imported.time_and_serial_number_to_file_path_map[floating_seconds_and_serial_number]
+                      for floating_seconds_and_serial_number in imported.sorted_list_by_time_and_serial_number]
+        assert [blob['id'] for blob in imported.get_blob_from_file_paths(file_paths)] == ['%06X' % (i * 4099) for i in range(20)]
+        assert imported.get_blob_from_file_paths(file_paths[:1])[0]['path'] == ['http://source:8080']
+    return
@@ -1,7 +1,9 @@
 import time
 import logging
 import copy
-from . import run_server_in_context, get_free_port
+from contacts import SyncPageCache
+from lib import iso_time_from_seconds_since_epoch
+from . import run_server_in_context, get_free_port, wait_until
 
 logger = logging.getLogger(__name__)
 
@@ -49,3 +51,104 @@ def test_sync():
     assert [i["id"] for i in resp_2_2_data['contact_ids']] == ["987654321", "123456789"]
     assert resp_2_2_data['contact_ids'][1]['path'][0] == server_url1
     return
+
+
+def test_sync_page_cache(server, data):
+    server.reset()
+    server.send_status_json(contacts=[{"id": "123456789"}])
+    resp_1 = server.sync().json()
+    resp_2 = server.sync().json()
+    # The second sync is served from the cached page, but must have the same data
+    assert [i["id"] for i in resp_1['contact_ids']] == ["123456789"]
+    assert resp_2['contact_ids'] == resp_1['contact_ids']
+    assert resp_2['locations'] == resp_1['locations']
+    # A write invalidates the cached page
+    server.send_status_json(contacts=[{"id": "987654321"}], locations=[data.locations_in[0]])
+    resp_3 = server.sync().json()
+    assert [i["id"] for i in resp_3['contact_ids']] == ["123456789", "987654321"]
+    assert len(resp_3['locations']) == 1
+    return
+
+
+def test_sync_server_timing(server, data):
+    server.reset()
+    server.send_status_json(contacts=[{"id": "123456789"}])
+    resp_1 = server.sync()
+    resp_2 = server.sync()
+    phases_1 = [phase.split(';')[0] for phase in resp_1.headers['Server-Timing'].split(', ')]
+    phases_2 = [phase.split(';')[0] for phase in resp_2.headers['Server-Timing'].split(', ')]
+    assert phases_1 == ['index', 'route', 'blob_read', 'encode', 'thread_wait', 'contact_ids', 'locations', 'total']
+    # Served from the cached page, already encoded
+    assert phases_2 == ['route', 'encode', 'total']
+    return
+
+
+def store_sync_page(cache, since, now, latest_time=None):
+    """
+    Store a page of one contact for since, as Contacts.sync does, more_data if latest_time is set
+    """
+    ret = {'since': iso_time_from_seconds_since_epoch(since), 'until': iso_time_from_seconds_since_epoch(latest_time or now),
+           'more_data': latest_time is not None, 'contact_ids': [{'id': '123456789'}], 'locations': []}
+    ret = cache.encode_and_store(ret, since, 10, now)
+    ret['contact_ids']()
+    ret['locations']()
+    return
+
+
+def test_sync_page_cache_invalidation():
+    cache = SyncPageCache()
+    store_sync_page(cache, 1000.0, 2000.0, latest_time=1500.0)
+    store_sync_page(cache, 1500.0, 2000.0)
+    assert cache.get(1000.0, 10, 2100.0)['until'] == iso_time_from_seconds_since_epoch(1500.0)
+    assert cache.get(1500.0, 10, 2100.0)['until'] == iso_time_from_seconds_since_epoch(2100.0)
+    # Asking for data only until latest_time or earlier, e.g. with until from the router, must not get the page
+    assert cache.get(1000.0, 10, 1500.0) is None
+    assert cache.get(1500.0, 10, 1900.0) is None  # Nor the open page from before its now
+    # A write after a closed page only drops the open page
+    cache.note_write(1800.0)
+    assert cache.get(1000.0, 10, 2100.0) is not None
+    assert cache.get(1500.0, 10, 2100.0) is None
+    # A write inside the range of a closed page drops it
+    cache.note_write(1200.0)
+    assert cache.get(1000.0, 10, 2100.0) is None
+
+    store_sync_page(cache, 1000.0, 2000.0, latest_time=1500.0)
+    store_sync_page(cache, 1600.0, 2000.0, latest_time=1800.0)
+    cache.note_expiry(1100.0)  # Only pages from before until have data being expired
+    assert cache.get(1000.0, 10, 2100.0) is None
+    assert cache.get(1600.0, 10, 2100.0) is not None
+    return
+
+
+def test_changes(server, data):
+    server.reset()
+    server.send_status_json(contacts=[{"id": "123456789"}], locations=data.locations_in, status=1)
+    all_changes = server.changes()
+    server.send_status_json(contacts=[{"id": "987654321"}], status=1)
+    new_changes = server.changes(all_changes['last'])
+    assert [change['dict'] for change in all_changes['changes']] == ['contact_dict', 'spatial_dict']
+    assert all_changes['changes'][0]['data']['id'] == '123456789'
+    assert [change['seq'] for change in new_changes['changes']] == [all_changes['last'] + 1]
+    assert new_changes['changes'][0]['key'] == '987654321'
+    assert not new_changes['more_data']
+    return
+
+
+def test_replica(data):
+    contact_id = '123456789'
+    # As in test_sync, assertions are checked after the with
+    with run_server_in_context() as primary:
+        with run_server_in_context(primary=primary.url) as replica:
+            # Writes to the replica are forwarded to the primary, and come back through its change log
+            replica.send_status_json(contacts=[{"id": contact_id}], locations=data.locations_in, status=1)
+
+            def replicated():  # The contact and the location have come back from the primary
+                sync = replica.sync().json()
+                return sync if sync['contact_ids'] and sync['locations'] else None
+            sync_data = wait_until(replicated)
+            scan_data = replica.scan_status_json(contact_prefixes=[contact_id[0:3]], since="2007-04-05T14:30Z")
+            matches = [primary.get_data_from_id(contact_id), replica.get_data_from_id(contact_id)]
+    assert [contact['id'] for contact in scan_data['contact_ids']] == [contact_id]
+    assert len(sync_data['locations']) == 1
+    assert [len(match) for match in matches] == [1, 1]
+    return